@@ -0,0 +1,245 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, TypeVar, Union
+from urllib.parse import urljoin
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+# status codes worth retrying, everything else is handed back to the caller
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+
+
+class ApiError(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitOpenError(ApiError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout`
+    seconds, then lets a single probe through (half-open) before closing again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """Seconds until a call is allowed, 0 when the breaker is closed or half-open."""
+        with self.lock:
+            if self.failures < self.failure_threshold:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return "closed"
+        return "open" if self.retry_after() > 0 else "half-open"
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "avg_latency": self.total_latency / self.calls if self.calls else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+class ApiClient:
+    """
+    HTTP client shared by every call to one 0xScope service.
+
+    Connections are kept alive in a pooled requests.Session. Failed calls (connection errors and
+    the status codes in RETRY_STATUS_CODES) are retried with exponential backoff and full jitter,
+    and each endpoint has its own circuit breaker plus call, retry and latency counters.
+
+    `retries` is the number of extra attempts after the first one; -1 retries until the call goes
+    through, waiting out the circuit breaker instead of failing on it. When all attempts fail the
+    last response is returned if there was one, otherwise ApiError is raised. call() and
+    call_async() retry a whole call instead, for answers that only fail the caller's checks.
+    """
+
+    def __init__(self, base_url: str, pool_size: int = 10, timeout: float = 60, retries: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, failure_threshold: int = 5,
+                 reset_timeout: float = 60):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats: Dict[str, EndpointStats] = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint: str, retries: int = None, **kwargs) -> requests.Response:
+        return self.request("GET", endpoint, retries=retries, **kwargs)
+
+    def post(self, endpoint: str, retries: int = None, **kwargs) -> requests.Response:
+        return self.request("POST", endpoint, retries=retries, **kwargs)
+
+    def request(self, method: str, endpoint: str, retries: int = None, **kwargs) -> requests.Response:
+        retries = self.retries if retries is None else retries
+        kwargs.setdefault("timeout", self.timeout)
+        url = urljoin(self.base_url, endpoint)
+        breaker = self._breaker(endpoint)
+        attempt = 0
+        while True:
+            self._wait_breaker(endpoint, breaker, retries)
+            resp, error = None, None
+            start = time.monotonic()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                error = e
+            ok = error is None and resp.status_code not in RETRY_STATUS_CODES
+            self._record(endpoint, breaker, time.monotonic() - start, ok, attempt > 0)
+            if ok:
+                return resp
+            if retries >= 0 and attempt >= retries:
+                if resp is not None:
+                    return resp
+                raise ApiError(f"{method} {endpoint} failed after {attempt + 1} attempts: {error}") from error
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def request_async(self, session: aiohttp.ClientSession, method: str, endpoint: str,
+                            retries: int = None, **kwargs) -> Union[dict, list]:
+        """aiohttp counterpart of request() for concurrent pagers, returns the decoded json body."""
+        retries = self.retries if retries is None else retries
+        url = urljoin(self.base_url, endpoint)
+        breaker = self._breaker(endpoint)
+        attempt = 0
+        while True:
+            wait = breaker.retry_after()
+            if wait > 0:
+                if retries >= 0:
+                    raise CircuitOpenError(f"circuit open for {endpoint}, retry in {wait:.1f}s")
+                await asyncio.sleep(wait)
+            status, body, error = None, None, None
+            start = time.monotonic()
+            try:
+                async with session.request(method, url, **kwargs) as resp:
+                    status = resp.status
+                    if status not in RETRY_STATUS_CODES:
+                        body = await resp.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            ok = error is None and status not in RETRY_STATUS_CODES
+            self._record(endpoint, breaker, time.monotonic() - start, ok, attempt > 0)
+            if ok:
+                return body
+            if retries >= 0 and attempt >= retries:
+                raise ApiError(f"{method} {endpoint} failed after {attempt + 1} attempts: {error or status}")
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def call(self, func: Callable[[], T], retries: int = None) -> T:
+        """
+        Run `func`, a request plus the checks of its answer, again with backoff whenever it raises.
+        The last exception is raised once the retries are used up.
+        """
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception:
+                if retries >= 0 and attempt >= retries:
+                    raise
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def call_async(self, func: Callable[[], Awaitable[T]], retries: int = None) -> T:
+        """Coroutine counterpart of call()."""
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            try:
+                return await func()
+            except Exception:
+                if retries >= 0 and attempt >= retries:
+                    raise
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** min(attempt, 32)))
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            result = {endpoint: stats.to_dict() for endpoint, stats in self.stats.items()}
+        for endpoint, data in result.items():
+            data["circuit"] = self.breakers[endpoint].state
+        return result
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _breaker(self, endpoint: str) -> CircuitBreaker:
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.stats[endpoint] = EndpointStats()
+            return self.breakers[endpoint]
+
+    def _wait_breaker(self, endpoint: str, breaker: CircuitBreaker, retries: int) -> None:
+        wait = breaker.retry_after()
+        if wait > 0:
+            if retries >= 0:
+                raise CircuitOpenError(f"circuit open for {endpoint}, retry in {wait:.1f}s")
+            time.sleep(wait)
+
+    def _record(self, endpoint: str, breaker: CircuitBreaker, latency: float, ok: bool, retry: bool) -> None:
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        with self.lock:
+            stats = self.stats[endpoint]
+            stats.calls += 1
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            if retry:
+                stats.retries += 1
+            if not ok:
+                stats.failures += 1
@@ -18,25 +18,26 @@ from os.path import dirname, realpath
 from urllib.parse import urlparse
 
 import pandas as pd
-import requests
 from communex.compat.key import classic_load_key
 from communex.module.module import Module, endpoint  # type: ignore
 from communex.module.server import ModuleServer  # type: ignore
 from loguru import logger
-from retrying import retry
 
 sys.path.append(f'{dirname(dirname(dirname(dirname(realpath(__file__)))))}')
 from config import Config
+from src.openscope.api_client import ApiClient
 from src.openscope.constants import DEFAULT_SUPPORT_TOKENS
 
 
-@retry(wait_fixed=5000, stop_max_attempt_number=2)
 def get_user_trades():
-    response = requests.get(USER_TRADES_URL)
-    if response.status_code != 200:
-        raise Exception(
-            f'get_user_trades: error,response.status_code: {response.status_code}, response.text: {response.text}')
-    return response.json()
+    def fetch():
+        response = MINER_CLIENT.get('user_trades', retries=0)
+        if response.status_code != 200:
+            raise Exception(
+                f'get_user_trades: error,response.status_code: {response.status_code}, response.text: {response.text}')
+        return response.json()
+
+    return MINER_CLIENT.call(fetch, retries=1)
 
 
 def get_user_latest_trades() -> dict:
@@ -95,13 +96,15 @@ def get_strategy_trades(latest_trades) -> list:
     return result
 
 
-@retry(wait_fixed=5000, stop_max_attempt_number=2)
 def send_trade(trade):
-    logger.info(f'send_trade begin: {trade}')
-    response = requests.post(SIGNAL_TRADE_URL, json=trade)
-    if response.status_code != 200:
-        raise Exception(
-            f'send_trade: error,response.status_code: {response.status_code}, response.text: {response.text}')
+    def send():
+        logger.info(f'send_trade begin: {trade}')
+        response = MINER_CLIENT.post('trade', retries=0, json=trade)
+        if response.status_code != 200:
+            raise Exception(
+                f'send_trade: error,response.status_code: {response.status_code}, response.text: {response.text}')
+
+    MINER_CLIENT.call(send, retries=1)
 
 
 def send_trades(trades):
@@ -138,8 +141,7 @@ if __name__ == '__main__':
     keypair = classic_load_key(config.miner.get("keyfile"))
     url = config.miner.get("url")
     parsed_url = urlparse(url)
-    SIGNAL_TRADE_URL = f'http://{parsed_url.hostname}:{parsed_url.port}/trade'
-    USER_TRADES_URL = f'http://{parsed_url.hostname}:{parsed_url.port}/user_trades'
+    MINER_CLIENT = ApiClient(f'http://{parsed_url.hostname}:{parsed_url.port}/')
     logger.info(f"Running IQ 50 module with key {keypair.ss58_address}")
     os.environ["SIGNAL_TRADE_ADDRESS"] = keypair.ss58_address
     os.environ["SIGNAL_TRADE_PUBLIC_KEY"] = keypair.public_key.hex()
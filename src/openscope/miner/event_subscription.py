@@ -13,15 +13,13 @@ import os.path
 import sys
 import time
 from os.path import dirname, realpath
-from urllib.parse import urljoin
 
 import pandas as pd
-import requests
 from fastapi import HTTPException
-from retrying import retry
 
 sys.path.append(f'{dirname(dirname(dirname(dirname(realpath(__file__)))))}')
 from config import Config
+from src.openscope.api_client import ApiClient
 from src.openscope.utils import log
 
 
@@ -35,9 +33,7 @@ def subscription_realtime(begin_time):
         time.sleep(WAIT_TIME)
 
 
-@retry(wait_fixed=5000, stop_max_attempt_number=2)
 def get_events(begin_time=None, end_time=None):
-    url = urljoin(server_url, "getallevents")
     headers = {
         'Content-Type': 'application/json'
     }
@@ -48,11 +44,14 @@ def get_events(begin_time=None, end_time=None):
     if end_time is not None:
         params['end'] = end_time
 
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
-    if response.json().get('code') != 200:
-        raise HTTPException(status_code=response.json().get('code'), detail=response.json().get('msg'))
-    return response.json()
+    def fetch():
+        response = api_client.get("getallevents", retries=0, headers=headers, params=params)
+        response.raise_for_status()
+        if response.json().get('code') != 200:
+            raise HTTPException(status_code=response.json().get('code'), detail=response.json().get('msg'))
+        return response.json()
+
+    return api_client.call(fetch, retries=1)
 
 
 def subscription_history():
@@ -87,5 +86,6 @@ if __name__ == '__main__':
     config_file = args.config_file
     config = Config(config_file=config_file)
     server_url = config.api.get("url")
+    api_client = ApiClient(server_url)
     WAIT_TIME = args.wait_time
     main(args.history, args.begin_time)
@@ -16,9 +16,8 @@ import re
 import time
 from abc import ABC
 from os.path import dirname, realpath
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urlparse
 
-import requests
 import uvicorn
 from communex.compat.key import classic_load_key
 from communex.module.module import Module, endpoint  # type: ignore
@@ -32,6 +31,7 @@ from json.decoder import JSONDecodeError
 
 from config import Config
 from requests.exceptions import HTTPError
+from src.openscope.api_client import ApiClient
 from src.openscope.key import sign_message
 from src.openscope.utils import is_ethereum_address
 
@@ -46,8 +46,7 @@ class TradeModule(ABC, Module):
             server_url (str): The base URL of the server.
         """
         super().__init__()
-        self.trade_url = urljoin(server_url, 'createtrade')
-        self.user_trades_url = urljoin(server_url, 'getusertrades')
+        self.client = ApiClient(server_url)
 
     @staticmethod
     def _validate_required_params(data: dict, required_params: list[str]) -> None:
@@ -97,8 +96,10 @@ class TradeModule(ABC, Module):
             headers = {
                 'Content-Type': 'application/json'
             }
-            response = requests.post(
-                url=self.trade_url,
+            # a signed trade is not retried, the api may already have recorded it
+            response = self.client.post(
+                'createtrade',
+                retries=0,
                 headers=headers,
                 data=json.dumps(trade_data)
             )
@@ -122,7 +123,7 @@ class TradeModule(ABC, Module):
             sing_msg = f'{miner_id}{pub_key}{timestamp}'
             signature = sign_message(os.getenv('SIGNAL_TRADE_PRIVATE_KEY'), sing_msg)
             params = {'userId': miner_id, 'pubKey': pub_key, 'timestamp': timestamp, 'sig': signature}
-            response = requests.get(url=self.user_trades_url, params=params)
+            response = self.client.get('getusertrades', params=params)
             response.raise_for_status()
             if response.json().get('code') != 200:
                 raise HTTPException(status_code=response.json().get('code'), detail=response.json().get('msg'))
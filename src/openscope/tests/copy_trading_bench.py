@@ -0,0 +1,107 @@
+import argparse
+import json
+import random
+import sys
+import time
+from os.path import dirname, realpath
+
+# tests/trade.py shadows the validator's trade module, put the validator first
+sys.path.insert(0, f'{dirname(dirname(realpath(__file__)))}/validator')
+from loguru import logger
+
+from eliminate import CopyTrades, _lsh_candidates, copy_trading_elimination
+from trade import DEFAULT_TOKENS, Order, OrderWindow
+
+
+def make_window(miners: int, orders_per_miner: int, leaders: int, followers: int, hours: int, tokens: int,
+                rng: random.Random) -> tuple:
+    """
+    Random trades of `miners` miners in the last `hours` hours on the first `tokens` tokens. Each
+    of the first `leaders` miners is copied by up to `followers` of the others, a few seconds after
+    each trade, and some of those followers only copy part of the leader's trades.
+
+    Returns the order window and the planted follower -> leader map.
+    """
+    now = int(time.time())
+    addresses = [f'5{rng.getrandbits(256):064x}'[:48] for _ in range(miners)]
+    trades = {address: [] for address in addresses}
+    for address in addresses:
+        for _ in range(rng.randint(orders_per_miner // 2, orders_per_miner * 2)):
+            trades[address].append((rng.choice(DEFAULT_TOKENS[:tokens]), rng.random() < 0.3, rng.choice([1, -1]),
+                                    now - 60 - rng.randrange(hours * 3600 - 60), rng.choice([0.5, 1, 2])))
+    planted = {}
+    pool = addresses[leaders:]
+    rng.shuffle(pool)
+    for leader in addresses[:leaders]:
+        for _ in range(rng.randint(1, followers)):
+            follower = pool.pop()
+            share = rng.choice([1.0, 1.0, 0.5, 0.2])
+            copied = [trade for trade in trades[leader] if rng.random() < share]
+            if len(copied) >= 5:
+                trades[follower] = [trade[:3] + (trade[3] + rng.randint(1, 29),) + trade[4:] for trade in copied]
+                planted[follower] = leader
+    orders = [Order(address, token, is_close, direction, rng.getrandbits(40), 1.0, 1.0, timestamp, leverage)
+              for address, rows in trades.items() for token, is_close, direction, timestamp, leverage in rows]
+    orders.sort(key=lambda x: x.TimeStamp)
+    window = OrderWindow()
+    window.add(orders)
+    return window, planted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="copy trading elimination, MinHash LSH pre-filter against the full join")
+    parser.add_argument("--miners", type=int, default=5000)
+    parser.add_argument("--orders-per-miner", type=int, default=40)
+    parser.add_argument("--leaders", type=int, default=50, help="miners that are copied")
+    parser.add_argument("--followers", type=int, default=4, help="most followers of one leader")
+    parser.add_argument("--hours", type=int, default=167, help="hours the trades are spread over, at most a week")
+    parser.add_argument("--tokens", type=int, default=len(DEFAULT_TOKENS), help="tokens traded")
+    parser.add_argument("--output", type=str, default=None, help="write the report as json")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logger.remove()
+    window, planted = make_window(args.miners, args.orders_per_miner, args.leaders, args.followers, args.hours,
+                                  args.tokens, random.Random(args.seed))
+    df = window.frame()
+
+    tick = time.perf_counter()
+    trades = CopyTrades(df)
+    candidates, _ = _lsh_candidates(trades)
+    lsh_seconds = time.perf_counter() - tick
+
+    tick = time.perf_counter()
+    joined, _ = copy_trading_elimination(window, prefilter=False)
+    join_seconds = time.perf_counter() - tick
+    tick = time.perf_counter()
+    result, clusters = copy_trading_elimination(window, prefilter=True)
+    prefilter_seconds = time.perf_counter() - tick
+
+    found = {follower for follower in joined if follower in result}
+    report = {
+        "miners": args.miners,
+        "orders": len(df),
+        "planted": len(planted),
+        "candidate_pairs": len(candidates),
+        "all_pairs": args.miners * (args.miners - 1),
+        "join_seconds": join_seconds,
+        "prefilter_seconds": prefilter_seconds,
+        "lsh_seconds": lsh_seconds,
+        "copiers_join": len(joined),
+        "copiers_prefilter": len(result),
+        "recall": len(found) / len(joined) if joined else 1.0,
+        "planted_found": sum(1 for follower, leader in planted.items() if result.get(follower) == leader),
+        "clusters": len(clusters),
+        "largest_cluster": max((len(cluster) for cluster in clusters), default=0),
+    }
+    for name, value in report.items():
+        print(f"{name:>18}: {value:.3f}" if isinstance(value, float) else f"{name:>18}: {value}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    # the candidates are checked exactly, the pre-filter may only miss copiers, never add one
+    sys.exit(0 if set(result.items()) <= set(joined.items()) else 1)
+
+
+if __name__ == '__main__':
+    main()
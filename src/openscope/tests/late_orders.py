@@ -0,0 +1,98 @@
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from os.path import dirname, realpath
+
+# tests/trade.py shadows the validator's trade module, put the validator first
+sys.path.insert(0, f'{dirname(dirname(realpath(__file__)))}/validator')
+from loguru import logger
+
+import trade
+from replay import ReplayAccountManager
+from storage import OrderStore
+from trade import DEFAULT_TOKENS, Order
+
+
+class FakeApi:
+    """Stands in for get_recent_orders, answering from the orders the api has received so far."""
+
+    def __init__(self):
+        self.orders = []
+        self.tradetimes = []
+
+    def __call__(self, addr, pub_key, timestamp, signature, tradetime=0, backfill=False):
+        self.tradetimes.append(tradetime)
+        return sorted((order for order in self.orders if order.TimeStamp >= tradetime), key=lambda x: x.TimeStamp)
+
+
+def make_manager(prices: dict, directory: str, name: str) -> ReplayAccountManager:
+    account_manager = ReplayAccountManager(lambda last_update: prices[last_update // 86400], logger=logger)
+    account_manager.order_store = OrderStore(os.path.join(directory, f'{name}.db'))
+    return account_manager
+
+
+def main():
+    """
+    A trade for yesterday that reaches the api after the day rolled over must be fetched by the
+    catch-up, replayed into its closed checkpoint and show in the returns, exactly as if it had
+    come in on time.
+    """
+    logger.remove()
+    rng = random.Random(0)
+    day = int(time.time()) // 86400 - 1
+    prices = {}
+    price = {token: rng.uniform(1, 100) for token in DEFAULT_TOKENS}
+    for d in (day - 1, day, day + 1):
+        price = {token: value * math.exp(rng.gauss(0, 0.05)) for token, value in price.items()}
+        prices[d] = dict(price)
+
+    def order(miner, token, is_close, direction, nonce, timestamp):
+        value = prices[timestamp // 86400][token]
+        return Order(miner, token, is_close, direction, nonce, value, value, timestamp, 1)
+
+    token = DEFAULT_TOKENS[2]
+    on_time = [order('a', token, False, 1, 1, day * 86400 + 100), order('b', token, False, -1, 2, day * 86400 + 200),
+               order('a', token, True, 1, 3, (day + 1) * 86400 + 100)]
+    # b closes its position just before midnight, the api only has it after the day rolled over
+    late = order('b', token, True, -1, 4, (day + 1) * 86400 - 10)
+
+    api = FakeApi()
+    trade.get_recent_orders = api
+    errors = []
+    with tempfile.TemporaryDirectory() as directory:
+        account_manager = make_manager(prices, directory, 'live')
+        for address in ('a', 'b'):
+            account_manager.add_account(address)
+        for orders in (on_time[:2], on_time[2:], [late]):
+            api.orders.extend(orders)
+            if orders == [late]:
+                # the next step is a catch-up
+                account_manager.catchup_time = 0
+            account_manager.group_records_by_day(account_manager.fetch_orders('', '', 0, ''))
+            account_manager.process_orders_by_day('', '', None)
+        if api.tradetimes[-1] > late.TimeStamp:
+            errors.append(f'catch-up fetched from {api.tradetimes[-1]}, after the late trade at {late.TimeStamp}')
+
+        reference = make_manager(prices, directory, 'reference')
+        for address in ('a', 'b'):
+            reference.add_account(address)
+        reference.group_orders_by_day(sorted(on_time + [late], key=lambda x: x.TimeStamp))
+        reference.process_orders_by_day('', '', None)
+
+        got, want = account_manager.generate_returns(), reference.generate_returns()
+        if got != want:
+            errors.append(f'returns with the late trade {got} != {want}')
+        if account_manager.checkpoints[0].processed != len(account_manager.checkpoints[0].orders):
+            errors.append('the late trade was not replayed')
+
+    for error in errors:
+        print(error)
+    print(f"{len(errors)} errors")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
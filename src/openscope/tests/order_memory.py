@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from os.path import dirname, realpath
+
+# tests/trade.py shadows the validator's trade module, put the validator first
+sys.path.insert(0, f'{dirname(dirname(realpath(__file__)))}/validator')
+from storage import ORDER_COLUMNS, OrderStore
+from trade import (DEFAULT_TOKENS, ORDERS_PAGE_LIMIT, IdTable, Order, PositionCheckpoint, _parse_order, encode_orders,
+                   encode_rows)
+
+
+class DictOrder:
+    """Order as it used to be kept: a plain instance __dict__ and one string object per row."""
+
+    def __init__(self, MinerId="", Token="", isClose=False, Direction=0, Nonce=0, Price=0, Price4H=0, TimeStamp=0,
+                 Leverage=1):
+        self.MinerId = MinerId
+        self.Token = Token
+        self.isClose = isClose
+        self.Direction = Direction
+        self.Nonce = Nonce
+        self.Price = Price
+        self.Price4H = Price4H
+        self.TimeStamp = TimeStamp
+        self.Leverage = Leverage
+
+
+def parse_dict_order(order_data: dict) -> DictOrder:
+    return DictOrder(
+        MinerId=order_data.get("MinerID", ""),
+        Token=order_data.get("TokenAddress", ""),
+        isClose=(order_data.get("PositionManager", "") == "close"),
+        Direction=order_data.get("Direction", 0),
+        Nonce=order_data.get("Nonce", 0),
+        Price=order_data.get("TradePrice", 0),
+        Price4H=order_data.get("TradePrice4H", 0),
+        TimeStamp=order_data.get("Timestamp", 0),
+        Leverage=order_data.get("Leverage", 1),
+    )
+
+
+def make_pages(orders: int, miners: int, days: int):
+    """getalltrades pages as they come over the wire, oldest first."""
+    rng = random.Random(0)
+    miner_ids = [f'5{rng.getrandbits(256):064x}'[:48] for _ in range(miners)]
+    start = 1_700_000_000
+    rows = []
+    for i in range(orders):
+        timestamp = start + i * days * 86400 // orders
+        rows.append({
+            "MinerID": rng.choice(miner_ids),
+            "TokenAddress": rng.choice(DEFAULT_TOKENS),
+            "PositionManager": "close" if rng.random() < 0.3 else "open",
+            "Direction": rng.choice([1, -1]),
+            "Nonce": timestamp * 1000 + i % 1000,
+            "TradePrice": rng.uniform(0.1, 100),
+            "TradePrice4H": rng.uniform(0.1, 100),
+            "Timestamp": timestamp,
+            "Leverage": rng.choice([0.5, 1, 2]),
+        })
+    return [json.dumps(rows[i:i + ORDERS_PAGE_LIMIT]) for i in range(0, len(rows), ORDERS_PAGE_LIMIT)]
+
+
+def group_dict_orders(pages) -> dict:
+    """Checkpoints as they used to be: per day, a dict of order objects keyed by (MinerId, Nonce)."""
+    checkpoints = {}
+    for page in pages:
+        for order_data in json.loads(page):
+            order = parse_dict_order(order_data)
+            checkpoints.setdefault(order.TimeStamp // 86400, {})[(order.MinerId, order.Nonce)] = order
+    return checkpoints
+
+
+def group_records(pages) -> dict:
+    """Checkpoints as AccountManager.group_orders_by_day keeps them, one page at a time."""
+    ids = IdTable()
+    checkpoints = {}
+    for page in pages:
+        records = encode_orders([_parse_order(order_data) for order_data in json.loads(page)], ids)
+        days = records["TimeStamp"] // 86400
+        for day in set(days.tolist()):
+            if day not in checkpoints:
+                checkpoints[day] = PositionCheckpoint(last_update=day * 86400)
+            checkpoints[day].add_orders(records[days == day])
+    return {"ids": ids, "checkpoints": checkpoints}
+
+
+def load_objects(store: OrderStore) -> list:
+    """The cold start order history as it used to be read: one Order object per stored row."""
+    rows = list(store.iter_rows())
+    return [Order(**dict(zip(ORDER_COLUMNS, row), isClose=bool(row[2]))) for row in rows]
+
+
+def load_records(store: OrderStore):
+    """The cold start order history as AccountManager.fetch_orders reads it, straight into records."""
+    ids = IdTable()
+    return {"ids": ids, "records": encode_rows(store.iter_rows(), ids)}
+
+
+def measure(arg, fn) -> tuple:
+    """Peak and retained bytes of fn(arg)."""
+    tracemalloc.start()
+    result = fn(arg)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memory taken by a multi-day order history")
+    parser.add_argument("--orders", type=int, default=500000)
+    parser.add_argument("--miners", type=int, default=256)
+    parser.add_argument("--days", type=int, default=9)
+    args = parser.parse_args()
+
+    pages = make_pages(args.orders, args.miners, args.days)
+    print(f"orders: {args.orders}, miners: {args.miners}, days: {args.days}")
+    with tempfile.TemporaryDirectory() as directory:
+        store = OrderStore(os.path.join(directory, "orders.db"))
+        for page in pages:
+            store.add_orders([_parse_order(order_data) for order_data in json.loads(page)])
+        for title, arg, runs in (("grouping fetched pages", pages, (("dict", group_dict_orders),
+                                                                    ("records", group_records))),
+                                 ("cold start load from the order store", store, (("objects", load_objects),
+                                                                                  ("records", load_records)))):
+            print(title)
+            result = {}
+            for name, fn in runs:
+                peak, current = measure(arg, fn)
+                result[name] = (peak, current)
+                print(f"{name:>8}: retained {current / 2 ** 20:8.1f} MiB, peak {peak / 2 ** 20:8.1f} MiB, "
+                      f"{current / args.orders:6.1f} bytes/order")
+            before = result[runs[0][0]]
+            print(f"retained: {before[1] / result['records'][1]:.1f}x smaller, "
+                  f"peak: {before[0] / result['records'][0]:.1f}x smaller")
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import warnings
+from os.path import dirname, realpath
+
+import numpy as np
+import pandas as pd
+
+# tests/trade.py shadows the validator's trade module, put the validator first
+sys.path.insert(0, f'{dirname(dirname(realpath(__file__)))}/validator')
+from loguru import logger
+from substrateinterface import Keypair
+
+from eliminate import copy_trading_elimination, roi_elimination
+from replay import DryRunClient, ReplayAccountManager
+from stats import SerenityState, calculate_serenity, miners_serenity
+from trade import DEFAULT_TOKENS, Account, Order, apply_order, evaluate_account, init_account
+from validator import set_weights
+
+BENCHMARKS = ["process_order", "evaluate_account", "generate_returns", "calculate_serenity",
+              "serenity_incremental", "set_weights", "copy_trading_elimination", "roi_elimination"]
+
+
+def make_prices(days: int, rng: random.Random) -> list:
+    """Closing prices of every token, one dict per day, as a random walk."""
+    price = {token: rng.uniform(0.01, 100) for token in DEFAULT_TOKENS}
+    result = []
+    for _ in range(days):
+        price = {token: value * math.exp(rng.gauss(0, 0.05)) for token, value in price.items()}
+        result.append(dict(price))
+    return result
+
+
+def make_orders(miners: int, orders_per_miner: int, days: int, prices: list, start: int, rng: random.Random,
+                copiers: int = 0) -> list:
+    """
+    Orders of `miners` miners spread over `days` days from `start`, oldest first. The first
+    `copiers` miners only repeat the orders of the next `copiers` ones a few seconds later.
+    """
+    addresses = [f'5{rng.getrandbits(256):064x}'[:48] for _ in range(miners)]
+    orders = []
+    for address in addresses:
+        for _ in range(orders_per_miner):
+            timestamp = start + rng.randrange(days * 86400)
+            day = (timestamp - start) // 86400
+            token = rng.choice(DEFAULT_TOKENS)
+            price = prices[day][token] * math.exp(rng.gauss(0, 0.02))
+            orders.append(Order(address, token, rng.random() < 0.3, rng.choice([1, -1]), timestamp * 1000 + len(orders),
+                                price, price * math.exp(rng.gauss(0, 0.03)), timestamp, rng.choice([0.5, 1, 2])))
+    copiers = min(copiers, miners // 2)
+    orders = [order for order in orders if order.MinerId not in addresses[:copiers]]
+    for i in range(copiers):
+        copier, leader = addresses[i], addresses[i + copiers]
+        for order in [order for order in orders if order.MinerId == leader]:
+            delay = rng.randint(1, 20)
+            orders.append(Order(copier, order.Token, order.isClose, order.Direction, order.Nonce + delay, order.Price,
+                                order.Price4H, order.TimeStamp + delay, order.Leverage))
+    orders.sort(key=lambda x: x.TimeStamp)
+    return orders
+
+
+def timed(fn, *args):
+    tick = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - tick
+
+
+def reference_checkpoints(orders: list, prices: list, start: int, miners: list) -> list:
+    """
+    The per-checkpoint last_update, cur_ret, prev_ret and roi dicts that process_orders_by_day
+    filled as it was written, by replaying the orders into trade.Account objects, for `miners` in
+    the order they were added. Only the last 30 checkpoints are kept, as it did.
+    """
+    accounts = {address: init_account() for address in miners}
+    days = {}
+    for order in orders:
+        day_orders = days.setdefault(order.TimeStamp // 86400, [])
+        if order.MinerId in accounts:
+            day_orders.append(order)
+    checkpoints = []
+    for day in sorted(days):
+        day_prices = prices[day - start // 86400]
+        for order in days[day]:
+            apply_order(accounts[order.MinerId], order, day_prices)
+        checkpoint = {"last_update": day * 86400, "cur_ret": {}, "prev_ret": {}, "roi": {}}
+        for id, account in accounts.items():
+            if account.FirstTrade > 0:
+                roi, _, _ = evaluate_account(account, day_prices)
+                checkpoint["cur_ret"][id] = roi * account.InitialBalance / 100 + account.InitialBalance
+                checkpoint["roi"][id] = roi
+                checkpoint["prev_ret"][id] = checkpoints[-1]["cur_ret"].get(id, 10.0) if checkpoints else 10.0
+        checkpoints.append(checkpoint)
+    return checkpoints[-30:]
+
+
+def reference_generate_returns(checkpoints: list) -> tuple:
+    """generate_returns as it was written, over the reference_checkpoints dicts."""
+    result, result_change, mdd_list = {}, {}, []
+    for checkpoint in checkpoints:
+        cur_ret, prev_ret = checkpoint["cur_ret"], checkpoint["prev_ret"]
+        for id in cur_ret.keys():
+            if id not in result:
+                result[id] = []
+                result_change[id] = []
+            if id in mdd_list:
+                continue
+            if cur_ret[id] < 0:
+                mdd_list.append(id)
+            return_change = (cur_ret[id] - prev_ret.get(id, 10.0)) / prev_ret.get(id, 10.0)
+            return_value = (cur_ret[id] - prev_ret.get(id, 10.0))
+            result[id].append(return_value)
+            result_change[id].append(return_change)
+    return result, result_change, mdd_list
+
+
+def reference_roi_elimination(checkpoints: list) -> list:
+    """roi_elimination as it was written, over a DataFrame of the reference_checkpoints rois."""
+    data = []
+    for checkpoint in checkpoints:
+        for address, roi in checkpoint["roi"].items():
+            data.append({'address': address, 'last_update': checkpoint["last_update"],
+                         'last_update_day': checkpoint["last_update"] // 86400, 'roi': roi})
+    check_time = int(time.time()) // 86400 * 86400 - 30 * 86400
+    df = pd.DataFrame(data)
+    if df.empty:
+        return []
+
+    def filter_groups(group):
+        consecutive_count = 0
+        total_count = 0
+        for roi in group['roi']:
+            if roi < -50:
+                consecutive_count += 1
+                total_count += 1
+                if consecutive_count >= 2 or total_count >= 5:
+                    return True
+            else:
+                consecutive_count = 0
+        return False
+
+    df = df[df['last_update'] >= check_time]
+    df = df.sort_values(by='last_update', ascending=False).groupby(['address', 'last_update_day']).first()
+    return list(df.reset_index().groupby('address').filter(filter_groups)['address'].unique())
+
+
+def reference_check_copy_trading(df_1, df_2) -> bool:
+    check_rate = 0.95
+    row_num = len(df_1)
+    copy_num = 0
+    no_copy_num = 0
+    check_copy_num = math.ceil(row_num * check_rate)
+    check_no_copy_num = math.ceil(row_num * (1 - check_rate - 0.000001))
+    for index, row in df_1.iterrows():
+        filtered_df = df_2[
+            (df_2['Token'] == row.Token) &
+            (df_2['Direction'] == row.Direction) &
+            (df_2['Leverage'] == row.Leverage) &
+            (df_2['isClose'] == row.isClose) &
+            (df_2['TimeStamp'] < row.TimeStamp) &
+            (df_2['TimeStamp'] >= row.TimeStamp - 30)
+            ]
+        if filtered_df.empty:
+            no_copy_num += 1
+        else:
+            copy_num += 1
+        if copy_num >= check_copy_num:
+            return True
+        elif no_copy_num >= check_no_copy_num:
+            return False
+    raise Exception(f'check_copy_trading func error')
+
+
+def reference_copy_trading(order_window) -> dict:
+    """copy_trading_elimination as it was written, checking every ordered pair of miners."""
+    result = dict()
+    df = order_window.frame(since=int(time.time()) - 7 * 86400)
+    if df.empty:
+        return result
+    all_miner = list(df['MinerId'].unique())
+    for t1_miner in all_miner:
+        for t2_miner in all_miner:
+            if t1_miner == t2_miner:
+                continue
+            df_1 = df[df['MinerId'] == t1_miner]
+            df_2 = df[df['MinerId'] == t2_miner]
+            if df_1.shape[0] < 5 or df_2.shape[0] < 5:
+                continue
+            if reference_check_copy_trading(df_1, df_2):
+                result[t1_miner] = t2_miner
+    return result
+
+
+def reference_set_weights(score_dict: dict, elimated_ids: list) -> tuple:
+    """The votes and weights of set_weights as it was written, with the tier sums inside the miner loop."""
+    filtered_score_dict = {miner_id: score for miner_id, score in score_dict.items() if miner_id not in elimated_ids}
+    sorted_score = sorted(filtered_score_dict.items(), key=lambda x: x[1], reverse=True)
+    sorted_ids = [key for key, value in sorted_score]
+    total_miners = len(sorted_score)
+    if total_miners < 100:
+        thresholds = [int(total_miners * 0.03), int(total_miners * 0.1), int(total_miners * 0.25),
+                      int(total_miners * 0.5)]
+    else:
+        thresholds = [3, 10, 25, 50]
+    weighted_scores = {}
+    for i, (miner_uid, score) in enumerate(sorted_score):
+        for tier, threshold in enumerate(thresholds):
+            if i < threshold:
+                start = thresholds[tier - 1] if tier else 0
+                total_score_in_group = sum(filtered_score_dict[uid[0]] for uid in sorted_score[start:threshold])
+                weighted_scores[miner_uid] = int(score / total_score_in_group * 0.25 * 1000)
+                break
+        else:
+            weighted_scores[miner_uid] = 0
+    remain_weight = 1000 - sum(weighted_scores.values())
+    for item in sorted_score[:thresholds[-1]]:
+        uid = item[0]
+        weighted_scores[uid] = int(weighted_scores.get(uid, 0) + (remain_weight / thresholds[-1]))
+    weighted_scores = {k: v for k, v in weighted_scores.items() if v > 0}
+    votes = dict(weighted_scores)
+    for id in sorted_ids:
+        if id not in weighted_scores.keys():
+            weighted_scores[id] = 0
+    return votes, weighted_scores
+
+
+def check_weights(score_dict: dict, rng: random.Random) -> list:
+    """set_weights against the reference on the bench scores, ties and subnets below 100 miners."""
+    errors = []
+    key = Keypair.create_from_uri('//bench')
+    uids = list(score_dict)
+    cases = [(score_dict, []), ({uid: round(score, 1) for uid, score in score_dict.items()}, uids[:5])]
+    for size in (1, 2, 7, 33, 99, 100, 101):
+        cases.append(({uid: rng.choice([0.5, 1.0, rng.random() + 0.01]) for uid in rng.sample(range(5000), size)}, []))
+    for scores, eliminated in cases:
+        client = DryRunClient()
+        weighted_scores = set_weights(scores, 0, client, key, eliminated)
+        votes, expected = reference_set_weights(scores, eliminated)
+        if (list(weighted_scores.items()) != list(expected.items())
+                or list((client.votes or [{}])[-1].items()) != list(votes.items())):
+            errors.append(f'set_weights differs from the reference at {len(scores)} miners')
+    return errors
+
+
+def close(a, b, rtol: float = 1e-9) -> bool:
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(close(x, y, rtol) for x, y in zip(a, b))
+    return (np.isnan(a) and np.isnan(b)) or a == b or math.isclose(a, b, rel_tol=rtol, abs_tol=1e-12)
+
+
+def check_accounts(account_manager, orders: list, prices: list, start: int, sample: list) -> list:
+    """The account book against trade.Account / apply_order / evaluate_account for the sampled miners."""
+    errors = []
+    accounts = {address: init_account() for address in sample}
+    for order in orders:
+        if order.MinerId in accounts:
+            apply_order(accounts[order.MinerId], order, prices[(order.TimeStamp - start) // 86400])
+    book = account_manager.book
+    roi, value, _ = book.mark_to_market(prices[-1])
+    win_rates = book.win_rates()
+    for address, account in accounts.items():
+        row = book.index[address]
+        if account.FirstTrade == 0:
+            continue
+        ref_roi, ref_win, position = evaluate_account(account, prices[-1])
+        ref_value = [position[token]["value"] for token in book.tokens]
+        if not (close(ref_roi, roi[row]) and close(ref_win, win_rates[row]) and close(ref_value, value[row].tolist())):
+            errors.append(f'account {address}: roi {roi[row]} != {ref_roi} or win rate {win_rates[row]} != {ref_win}')
+    return errors
+
+
+def check_returns(checkpoints: list, miners: list, returns: tuple) -> list:
+    """generate_returns against the reference checkpoints of `miners`, the first miners of the book."""
+    expected = reference_generate_returns(checkpoints)
+    miners = set(miners)
+    returns = tuple({id: value for id, value in result.items() if id in miners} for result in returns[:2]) + (
+        [id for id in returns[2] if id in miners],)
+    errors = []
+    for name, got, want in zip(("returns", "changes"), returns[:2], expected[:2]):
+        if list(got.keys()) != list(want.keys()):
+            errors.append(f'generate_returns {name}: miner order differs')
+        elif not all(close(got[id], want[id]) for id in want):
+            errors.append(f'generate_returns {name}: values differ')
+    if returns[2] != expected[2]:
+        errors.append('generate_returns: mdd list differs')
+    return errors
+
+
+def check_serenity(items: dict, batch: dict, incremental: dict, sample: list) -> list:
+    """Batch and incremental serenity against stats.calculate_serenity on the sampled miners."""
+    errors = []
+    for address in sample:
+        if address not in items:
+            continue
+        returns, changes = items[address]
+        serenity, mdd = calculate_serenity(pd.Series(returns, dtype=float), pd.Series(changes, dtype=float))
+        expected = [0.0 if np.isnan(serenity) else float(serenity), float(mdd)]
+        for name, got in (("batch", batch), ("incremental", incremental)):
+            if not close(list(got[address]), expected, rtol=1e-7):
+                errors.append(f'serenity {name} {address}: {got[address]} != {expected}')
+    return errors
+
+
+def run(miners: int, args, rng: random.Random) -> tuple:
+    """Timings of every benchmark at `miners` miners, and the oracle mismatches."""
+    start = (int(time.time()) // 86400 - args.days + 1) * 86400
+    prices = make_prices(args.days, rng)
+    orders = make_orders(miners, args.orders_per_miner, args.days, prices, start, rng, copiers=args.copiers)
+    timings = {}
+    errors = []
+
+    account_manager = ReplayAccountManager(lambda last_update: prices[(last_update - start) // 86400], logger=logger)
+    for address in sorted({order.MinerId for order in orders}):
+        account_manager.add_account(address)
+    tick = time.perf_counter()
+    account_manager.group_orders_by_day(orders)
+    account_manager.process_orders_by_day('', '', None)
+    timings["process_order"] = time.perf_counter() - tick
+
+    _, timings["evaluate_account"] = timed(account_manager.book.evaluate, prices[-1])
+    returns, timings["generate_returns"] = timed(account_manager.generate_returns)
+    mdd = set(returns[2])
+    items = {id: (value, returns[1][id]) for id, value in returns[0].items() if id not in mdd}
+    batch, timings["calculate_serenity"] = timed(miners_serenity, items)
+    state = SerenityState()
+    epoch = account_manager.closed_epoch()
+    state.score(epoch, items)
+    (serenity, _), timings["serenity_incremental"] = timed(state.score, epoch, items)
+    incremental = dict(zip(items.keys(), zip(np.where(np.isnan(serenity), 0.0, serenity).tolist(),
+                                             state.score(epoch, items)[1].tolist())))
+
+    uids = {address: uid for uid, address in enumerate(items)}
+    score_dict = {uids[address]: max(value[0], 0.0) + 1e-3 for address, value in batch.items()}
+    key = Keypair.create_from_uri('//bench')
+    _, timings["set_weights"] = timed(set_weights, score_dict, 0, DryRunClient(), key, [])
+
+    window = ReplayAccountManager(None, logger=logger).order_window
+    window.add(orders)
+    (copiers, _), timings["copy_trading_elimination"] = timed(copy_trading_elimination, window)
+
+    eliminated, timings["roi_elimination"] = timed(roi_elimination, account_manager.checkpoints,
+                                                   account_manager.history, account_manager.book.addresses)
+
+    if args.oracle:
+        sample = sorted(items)[:args.oracle_miners]
+        errors += check_accounts(account_manager, orders, prices, start, sample)
+        miners = account_manager.book.addresses[:args.oracle_miners]
+        checkpoints = reference_checkpoints(orders, prices, start, miners)
+        errors += check_returns(checkpoints, miners, returns)
+        errors += check_serenity(items, batch, incremental, sample)
+        errors += check_weights(score_dict, rng)
+        if [address for address in eliminated if address in set(miners)] != reference_roi_elimination(checkpoints):
+            errors.append('roi_elimination differs from the DataFrame version')
+        # the pairwise reference grows with the square of the miners, it only sees the copiers found
+        # and the first other miners
+        copy_miners = set(sorted({order.MinerId for order in orders})[:args.copy_miners])
+        copy_miners |= set(copiers.keys()) | set(copiers.values())
+        window = ReplayAccountManager(None, logger=logger).order_window
+        window.add([order for order in orders if order.MinerId in copy_miners])
+        result, _ = copy_trading_elimination(window, prefilter=False)
+        if list(result.items()) != list(reference_copy_trading(window).items()):
+            errors.append('copy_trading_elimination differs from the pairwise version')
+    return timings, errors
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Benchmarks slower than the baseline by more than `threshold`, as messages."""
+    regressions = []
+    for miners, timings in results.items():
+        for name, seconds in timings.items():
+            base = baseline.get(miners, {}).get(name)
+            if base and seconds > base * (1 + threshold):
+                regressions.append(f'{name} at {miners} miners: {seconds:.3f}s, baseline {base:.3f}s')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark and cross-check the validator scoring")
+    parser.add_argument("--miners", type=str, default="1000,10000,50000", help="comma separated miner counts")
+    parser.add_argument("--orders-per-miner", type=int, default=10)
+    parser.add_argument("--days", type=int, default=10)
+    parser.add_argument("--copiers", type=int, default=5, help="miners copying another miner's orders")
+    parser.add_argument("--copy-miners", type=int, default=100, help="miners the copy trading oracle checks")
+    parser.add_argument("--oracle", action=argparse.BooleanOptionalAction, default=True,
+                        help="compare against the reference implementations")
+    parser.add_argument("--oracle-miners", type=int, default=200, help="miners checked by the oracle")
+    parser.add_argument("--baseline", type=str, default=None, help="fail on regressions against this json")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--output", type=str, default=None, help="write the timings as json, e.g. a new baseline")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    warnings.simplefilter("ignore", RuntimeWarning)
+
+    results = {}
+    errors = []
+    for miners in [int(value) for value in args.miners.split(",")]:
+        timings, mismatches = run(miners, args, random.Random(args.seed))
+        results[str(miners)] = timings
+        errors += [f'{miners} miners: {message}' for message in mismatches]
+        print(f"miners: {miners}")
+        for name in BENCHMARKS:
+            print(f"{name:>26}: {timings[name]:8.3f}s")
+
+    failed = False
+    if errors:
+        failed = True
+        print(f"{len(errors)} oracle mismatches, first: {errors[0]}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            failed = True
+            print(f"{len(regressions)} regressions beyond {args.threshold:.0%}:")
+            for message in regressions:
+                print(f"  {message}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from orders import IdTable, iter_orders
+
+
+class AccountBook:
+    """
+    Accounts of every miner as dense miner x token arrays.
+
+    Row i belongs to addresses[i] and the columns follow `tokens`. asset, usd, avg_price and
+    leverage hold what trade.Account keeps in its Portfolio, AvgPrice and Leverage dicts, so a
+    checkpoint marks all accounts to market in one vectorized pass. Open orders are counted in
+    trades/wins and per token in token_trades/token_wins. apply_order and mark_to_market give
+    the same results as trade.apply_order and trade.evaluate_account.
+    """
+
+    def __init__(self, tokens: List[str], main_tokens: List[str], balance: float = 10.0, capacity: int = 256):
+        self.tokens = list(tokens)
+        self.columns = {token: col for col, token in enumerate(self.tokens)}
+        self.main_tokens = set(main_tokens)
+        self.balance = balance
+        self.index: Dict[str, int] = {}
+        self.addresses: List[str] = []
+        self._allocate(max(capacity, 1))
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.index
+
+    def _allocate(self, capacity: int) -> None:
+        n, k = len(self.addresses), len(self.tokens)
+        arrays = {
+            "asset": np.zeros((capacity, k)),
+            "usd": np.full((capacity, k), self.balance),
+            "avg_price": np.zeros((capacity, k)),
+            "leverage": np.ones((capacity, k)),
+            "profit": np.zeros(capacity),
+            "initial": np.full(capacity, self.balance),
+            "first_trade": np.zeros(capacity, dtype=np.int64),
+            "trades": np.zeros(capacity, dtype=np.int64),
+            "wins": np.zeros(capacity, dtype=np.int64),
+            "token_trades": np.zeros((capacity, k), dtype=np.int64),
+            "token_wins": np.zeros((capacity, k), dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            if n:
+                array[:n] = getattr(self, name)[:n]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    STATE_ARRAYS = ("asset", "usd", "avg_price", "leverage", "profit", "initial", "first_trade", "trades", "wins",
+                    "token_trades", "token_wins")
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """The book as plain arrays, for AccountManager's snapshot."""
+        n = len(self.addresses)
+        state = {name: getattr(self, name)[:n] for name in self.STATE_ARRAYS}
+        state["addresses"] = np.array(self.addresses, dtype=str)
+        state["tokens"] = np.array(self.tokens, dtype=str)
+        return state
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> None:
+        if state["tokens"].tolist() != self.tokens:
+            raise ValueError("account book state was saved for other tokens")
+        addresses = state["addresses"].tolist()
+        self.index = {}
+        self.addresses = []
+        self._allocate(max(len(addresses), 1))
+        for address in addresses:
+            self.add_account(address)
+        for name in self.STATE_ARRAYS:
+            getattr(self, name)[:len(addresses)] = state[name]
+
+    def clear(self) -> None:
+        """Drop every account."""
+        self.index = {}
+        self.addresses = []
+        # nothing to copy once the addresses are gone, the arrays come back fresh
+        self._allocate(self.capacity)
+
+    def add_account(self, address: str) -> int:
+        """Row of the address, appending a fresh account the first time it is seen."""
+        row = self.index.get(address)
+        if row is not None:
+            return row
+        row = len(self.addresses)
+        if row == self.capacity:
+            self._allocate(self.capacity * 2)
+        self.index[address] = row
+        self.addresses.append(address)
+        return row
+
+    def reset_account(self, address: str) -> int:
+        """Put the account back to its initial state, keeping its row."""
+        row = self.add_account(address)
+        self.asset[row] = 0.0
+        self.usd[row] = self.balance
+        self.avg_price[row] = 0.0
+        self.leverage[row] = 1.0
+        self.profit[row] = 0.0
+        self.initial[row] = self.balance
+        self.first_trade[row] = 0
+        self.trades[row] = 0
+        self.wins[row] = 0
+        self.token_trades[row] = 0
+        self.token_wins[row] = 0
+        return row
+
+    def active_rows(self) -> np.ndarray:
+        """Rows of the accounts that have traded, in the order they were added."""
+        return np.flatnonzero(self.first_trade[:len(self.addresses)] > 0)
+
+    def price_vector(self, prices: Dict[str, float]) -> np.ndarray:
+        return np.array([prices.get(token, 0) for token in self.tokens], dtype=np.float64)
+
+    def apply_order(self, order, latest_price: Dict[str, float]) -> None:
+        row = self.index.get(order.MinerId)
+        if row is None:
+            return
+        token = order.Token
+        if self.first_trade[row] == 0 or self.first_trade[row] > order.TimeStamp:
+            self.first_trade[row] = order.TimeStamp
+        col = self.columns.get(token)
+        # calculate winrate, only calculate open order
+        if not order.isClose:
+            if order.Price4H == 0:
+                order.Price4H = latest_price.get(token, 0)
+            win = ((order.Price < order.Price4H and order.Direction == 1) or
+                   (order.Price > order.Price4H and order.Direction == -1))
+            self.trades[row] += 1
+            self.wins[row] += win
+            if col is not None:
+                self.token_trades[row, col] += 1
+                self.token_wins[row, col] += win
+
+        if col is None:
+            return
+        if token in self.main_tokens:
+            fee = 0.05 / 100
+        else:
+            fee = 0.1 / 100 * order.Leverage
+
+        balance = float(self.asset[row, col])
+        avg_price = float(self.avg_price[row, col])
+        leverage = float(self.leverage[row, col])
+        if order.isClose:
+            if avg_price == 0:
+                return
+            if balance > 0:
+                usd = balance * avg_price * (1 + leverage * (order.Price - avg_price) / avg_price)
+                cost = balance * avg_price
+            else:
+                usd = (-balance) * avg_price * (1 - leverage * (order.Price - avg_price) / avg_price)
+                cost = (-balance) * avg_price
+            self.asset[row, col] = 0.0
+            self.avg_price[row, col] = 0
+            self.leverage[row, col] = 1
+            # realized profit moves into the usd balance of every flat token, the closed one included
+            self.profit[row] = float(self.profit[row]) + (usd - cost)
+            flat = self.asset[row] == 0
+            self.usd[row, flat] = float(self.profit[row]) + float(self.initial[row])
+            return
+
+        usd_balance = float(self.usd[row, col])
+        if usd_balance > 0:
+            amount = usd_balance * (1 - fee) / order.Price
+        elif (order.Direction == 1 and balance < 0) or (order.Direction != 1 and balance > 0):
+            # flip the position
+            if avg_price == 0:
+                return
+            if balance > 0:
+                usd = balance * avg_price * (1 + leverage * (order.Price - avg_price) / avg_price)
+            else:
+                usd = (-balance) * avg_price * (1 - leverage * (order.Price - avg_price) / avg_price)
+            amount = usd * (1 - fee) / order.Price
+        else:
+            return
+        self.asset[row, col] = amount if order.Direction == 1 else amount * (-1)
+        self.usd[row, col] = 0.0
+        self.avg_price[row, col] = order.Price
+        self.leverage[row, col] = order.Leverage
+
+    def mark_to_market(self, prices: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Value every account at the given prices.
+
+        Returns the roi of each row, and the value and status (0 flat, 1 long, 2 short) of each
+        row's position per token.
+        """
+        n = len(self.addresses)
+        price = self.price_vector(prices)
+        asset, avg_price, leverage = self.asset[:n], self.avg_price[:n], self.leverage[:n]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            move = leverage * (price - avg_price) / avg_price
+            long_usd = asset * avg_price * (1 + move)
+            short_usd = (-asset) * avg_price * (1 - move)
+            long_gain = long_usd - asset * avg_price
+            short_gain = short_usd - (-asset) * avg_price
+        is_long, is_short = asset > 0, asset < 0
+        value = np.where(is_long, long_usd, np.where(is_short, short_usd, self.usd[:n]))
+        status = np.where(is_long, 1, np.where(is_short, 2, 0))
+        gain = np.where(is_long, long_gain, np.where(is_short, short_gain, 0.0))
+        # add token by token, a pairwise sum would round differently from the per-account loop
+        unrealized = np.zeros(n)
+        for col in range(len(self.tokens)):
+            unrealized += gain[:, col]
+        roi = (self.profit[:n] + unrealized) / self.initial[:n] * 100
+        return roi, value, status
+
+    def win_rates(self) -> np.ndarray:
+        n = len(self.addresses)
+        trades = self.trades[:n]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(trades > 0, self.wins[:n] / trades, 0.0)
+
+    def apply_records(self, records: np.ndarray, ids: IdTable, latest_price: Dict[str, float]) -> None:
+        """apply_order for ORDER_DTYPE records, in their order."""
+        for order in iter_orders(records, ids):
+            self.apply_order(order, latest_price)
+
+    def evaluate(self, prices: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Rows of the accounts that have traded with their roi, position value and win rate."""
+        roi, _, _ = self.mark_to_market(prices)
+        rows = self.active_rows()
+        roi = roi[rows]
+        initial = self.initial[rows]
+        return rows, roi, roi * initial / 100 + initial, self.win_rates()[rows]
+
+    def map_miners(self, fn: Callable, items: Dict[str, object]) -> Dict[str, object]:
+        """fn over an address -> item dict, giving an address -> result dict in the same order."""
+        return fn(items)
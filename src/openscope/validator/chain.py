@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+
+from communex.client import CommuneClient
+from loguru import logger
+
+DEFAULT_CHAIN_LOCATION = "data/chain.json"
+
+
+def get_block_number(client: CommuneClient) -> int:
+    block = client.get_block()
+    if not block:
+        return 0
+    return int(block["header"]["number"])
+
+
+def get_max_weight_age(client: CommuneClient, netuid: int) -> int:
+    """Blocks a vote stays valid on the subnet before the chain drops it."""
+    return int(client.query("MaxWeightAge", params=[netuid]))
+
+
+class ChainCache:
+    """
+    The subnet's uid -> key map, kept fresh by a background thread so the scoring path never
+    waits on a substrate RPC.
+
+    The refresher polls the block height and, on a new block, the uid -> registration block map;
+    the full query_map_key is only repeated when a uid was added, removed or registered again,
+    so a uid reused by a deregistration and registration within one poll gets its new key.
+    """
+
+    def __init__(self, client: CommuneClient, netuid: int, poll_interval: float = 12):
+        self.client = client
+        self.netuid = netuid
+        self.poll_interval = poll_interval
+        self.keys = {}
+        self.registrations = None
+        self.block = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get_keys(self) -> dict[int, str]:
+        """Latest known uid -> ss58 key map, loaded synchronously on first use."""
+        with self.lock:
+            keys = self.keys
+        if not keys:
+            self.refresh(force=True)
+            with self.lock:
+                keys = self.keys
+        return keys
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload the key map if the chain shows it may have changed. Returns True if it was reloaded."""
+        block = get_block_number(self.client)
+        if not force and block == self.block:
+            return False
+        registrations = self.client.query_map_registration_blocks(self.netuid)
+        self.block = block
+        if not force and registrations == self.registrations:
+            return False
+        keys = self.client.query_map_key(self.netuid)
+        with self.lock:
+            self.keys = keys
+            self.registrations = registrations
+        logger.info(f'chain cache refreshed at block {block}, modules: {len(keys)}')
+        return True
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def _run(self) -> None:
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f'chain cache refresh error: {e}')
+
+
+def get_netuid(client: CommuneClient, subnet_name: str = "OpenScope", location: str = DEFAULT_CHAIN_LOCATION,
+               network: str = "mainnet"):
+    """
+    Retrieves the network UID of the subnet.
+
+    The uid found is saved to `location` and on the next start only checked with a single
+    get_subnet_name query instead of scanning every subnet name.
+
+    Args:
+        client (CommuneClient): The CommuneX client.
+        subnet_name (str, optional): The name of the subnet. Defaults to "OpenScope".
+        location (str, optional): File the resolved uids are kept in.
+        network (str, optional): Network the uid belongs to, testnet and mainnet differ.
+
+    Returns:
+        int: The network UID of the subnet.
+    """
+    cache_key = f'{network}:{subnet_name}'
+    cached = {}
+    if os.path.exists(location):
+        with open(location, 'r') as f:
+            cached = json.load(f)
+    netuid = cached.get(cache_key)
+    if netuid is not None and client.get_subnet_name(netuid) == subnet_name:
+        return netuid
+
+    subnets = client.query_map_subnet_names()
+    for netuid, name in subnets.items():
+        if name == subnet_name:
+            cached[cache_key] = netuid
+            if os.path.dirname(location):
+                os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, 'w') as f:
+                json.dump(cached, f)
+            return netuid
+    raise ValueError(f"Subnet {subnet_name} not found")
@@ -23,7 +23,15 @@ class Config:
             "keyfile": config.get("validator", "keyfile"),
             "interval": config.get("validator", "interval"),
             "testnet": config.get("validator", "isTestnet"),
+            "processes": config.get("validator", "processes", fallback="1"),
+            "weight_tiers": config.get("validator", "weight_tiers", fallback="3,10,25,50"),
+            "weight_shares": config.get("validator", "weight_shares", fallback="0.25,0.25,0.25,0.25"),
+            "vote_min_change": config.get("validator", "vote_min_change", fallback="0"),
+            "vote_max_age": config.get("validator", "vote_max_age", fallback=""),
+            "vote_retries": config.get("validator", "vote_retries", fallback="3"),
+            "vote_timeout": config.get("validator", "vote_timeout", fallback="60"),
         }
         self.api = {
             "url": config.get("api","url"),
+            "concurrency": config.get("api", "concurrency", fallback="4"),
         }
@@ -9,16 +9,22 @@
 # @Desc    :
 # @Cmd     :
 import json
-import math
 import os
+import threading
 import time
-from datetime import datetime, timezone
 from os.path import dirname, realpath
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 import sr25519
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from communex.compat.key import classic_load_key
-from trade import get_miner_registertime, get_recent_orders
+from loguru import logger
+from history import CheckpointHistory
+from storage import RegisterStore
+from trade import AccountManager, OrderWindow, get_miner_registertime
 
 
 def get_miners(keypair, timestamp, starttime=0):
@@ -30,29 +36,54 @@ def get_miners(keypair, timestamp, starttime=0):
     return result
 
 
-def get_orders(keypair, timestamp, tradetime=0):
-    val_ss58 = keypair.ss58_address
-    pub_key = keypair.public_key.hex()
-    msg = f'{val_ss58}{pub_key}{timestamp}'.encode()
-    signature = sr25519.sign((keypair.public_key, keypair.private_key), msg).hex()  # type: ignore
-    orders = get_recent_orders(val_ss58, pub_key, timestamp, signature, tradetime)
-    result = list()
-    for order in orders:
-        result.append(order.__dict__)
-    return result
-
-
-def not_active_elimination(keypair):
+class RegisterTimeCache:
+    """
+    Miner register times backed by a RegisterStore.
+
+    A register time does not change once set, so after the first window has been loaded a
+    refresh only asks for registrations newer than the latest one stored, and at most once
+    every `ttl` seconds.
+    """
+
+    def __init__(self, keypair, store: RegisterStore = None, ttl: int = 300):
+        self.keypair = keypair
+        self.store = RegisterStore() if store is None else store
+        self.ttl = ttl
+        self.covered_from = None
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def get(self, starttime: int) -> dict:
+        """Register times of the miners registered since starttime, {address: register_time}."""
+        with self.lock:
+            timestamp = int(time.time())
+            if self.covered_from is None or starttime < self.covered_from:
+                fetch_from = starttime
+            elif timestamp - self.refreshed_at >= self.ttl:
+                fetch_from = max(self.store.get_latest_register_time(), self.covered_from)
+            else:
+                fetch_from = None
+            if fetch_from is not None:
+                register_times = get_miners(self.keypair, timestamp, fetch_from)
+                if register_times is not None:
+                    self.store.save_register_times(register_times)
+                    if self.covered_from is None or fetch_from < self.covered_from:
+                        self.covered_from = fetch_from
+                    self.refreshed_at = timestamp
+        return self.store.load_register_times(starttime)
+
+
+def not_active_elimination(register_cache: RegisterTimeCache, order_window: OrderWindow):
     '''Screen miners that have just passed the protection period and are inactive during the protection period.'''
     result = list()
     timestamp = int(time.time())
     timestamp_day = timestamp // 86400 * 86400
     tradetime = timestamp_day - 8 * 86400
     starttime = timestamp_day - 8 * 86400
-    orders = get_orders(keypair, timestamp, tradetime)
-    if not orders:
+    df = order_window.frame(since=tradetime)
+    if df.empty:
         return result
-    all_miner = get_miners(keypair, timestamp, starttime)
+    all_miner = register_cache.get(starttime)
     check_time_begin = timestamp_day - 8 * 86400
     check_time_end = timestamp_day - 7 * 86400 - 1
 
@@ -62,7 +93,6 @@ def not_active_elimination(keypair):
     if not miner_expired:
         return result
     df_miner = pd.DataFrame(miner_expired)
-    df = pd.DataFrame(orders)
     merged_df = df.merge(df_miner, left_on='MinerId', right_on='address')
     filtered_df = merged_df[
         (merged_df['TimeStamp'] >= merged_df['register_time']) & (merged_df['TimeStamp'] <= merged_df['expired_time'])]
@@ -74,111 +104,259 @@ def not_active_elimination(keypair):
     return list(result)
 
 
-def ceil_to_integer(num):
-    return math.ceil(num)
-
-
-def check_copy_trading(df_1, df_2):
-    check_rate = 0.95
-    row_num = len(df_1)
-    copy_num = 0
-    no_copy_num = 0
-    check_copy_num = ceil_to_integer(row_num * check_rate)
-    check_no_copy_num = ceil_to_integer(row_num * (1 - check_rate - 0.000001))
-    for index, row in df_1.iterrows():
-        token = row.Token
-        close = row.isClose
-        direction = row.Direction
-        timestamp = row.TimeStamp
-        leverage = row.Leverage
-        b_timestamp = timestamp - 30
-
-        filtered_df = df_2[
-            (df_2['Token'] == token) &
-            (df_2['Direction'] == direction) &
-            (df_2['Leverage'] == leverage) &
-            (df_2['isClose'] == close) &
-            (df_2['TimeStamp'] < timestamp) &
-            (df_2['TimeStamp'] >= b_timestamp)
-            ]
-        if filtered_df.empty:
-            no_copy_num += 1
-        else:
-            copy_num += 1
-        if copy_num >= check_copy_num:
-            return True
-        elif no_copy_num >= check_no_copy_num:
-            return False
-        else:
-            continue
+# a trade copies another miner's trade on the same token, direction, leverage and open/close side
+# made at most COPY_WINDOW seconds before it; a miner copying COPY_RATE of its trades is a copier
+COPY_WINDOW = 30
+COPY_RATE = 0.95
+COPY_MIN_ORDERS = 5
+COPY_KEYS = ['Token', 'Direction', 'Leverage', 'isClose']
+# from this many miners on only the candidate pairs of a MinHash LSH are checked, with
+# COPY_LSH_BANDS bands of COPY_LSH_ROWS hashes
+COPY_LSH_MIN_MINERS = 1000
+COPY_LSH_BANDS = 4
+COPY_LSH_ROWS = 3
+COPY_LSH_SEEDS = np.random.default_rng(0).integers(0, 2 ** 63, COPY_LSH_BANDS * COPY_LSH_ROWS, dtype=np.uint64)
+
+
+class CopyTrades:
+    """
+    The trades of a window as arrays for the copy trading checks.
+
+    Miners are numbered in the order of their first trade. Only the trades of miners with at
+    least COPY_MIN_ORDERS of them are kept, ordered by TimeStamp as in the window.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        codes, miners = pd.factorize(df['MinerId'])
+        self.miners = np.asarray(miners)
+        self.counts = np.bincount(codes, minlength=len(miners))
+        keep = self.counts[codes] >= COPY_MIN_ORDERS
+        self.codes = codes[keep]
+        trades = df[keep]
+        # the trades of every miner are by_miner[starts[miner]:starts[miner] + counts[miner]]
+        self.by_miner = np.argsort(self.codes, kind="stable")
+        self.starts = np.searchsorted(self.codes[self.by_miner], np.arange(len(miners)))
+        self.rank = np.empty(len(self.codes), dtype=np.int64)
+        self.rank[self.by_miner] = np.arange(len(self.codes)) - self.starts[self.codes[self.by_miner]]
+        self.groups = trades.groupby(COPY_KEYS, sort=False).ngroup().to_numpy(dtype=np.int64)
+        self.timestamp = trades['TimeStamp'].to_numpy(dtype=np.int64)
+        self.base = (self.timestamp.min() if len(self.timestamp) else 0) - COPY_WINDOW
+        self.copy_num = np.ceil(self.counts * COPY_RATE).astype(np.int64)
+        self.no_copy_num = np.ceil(self.counts * (1 - COPY_RATE - 0.000001)).astype(np.int64)
+
+    @property
+    def eligible(self) -> int:
+        return int((self.counts >= COPY_MIN_ORDERS).sum())
+
+    def key(self, trades: np.ndarray, prefix: np.ndarray) -> np.ndarray:
+        """Sort key of the trades by (prefix, timestamp)."""
+        return prefix * 2 ** 32 + (self.timestamp[trades] - self.base)
+
+    def miner_trades(self, miners: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The trades of the given miners one after the other, and the position of their miner."""
+        owner, offset = _expand(self.counts[miners])
+        return owner, self.by_miner[self.starts[miners][owner] + offset]
+
+
+def _expand(lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """For ranges of the given lengths, the range and the offset in it of every element."""
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    return owner, np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, a cheap well spread hash of uint64 values."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _copying(trades: CopyTrades, follower: np.ndarray, leader: np.ndarray,
+             rank: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The copying pairs among the copied trades, one (follower, leader, rank of the trade) each.
+
+    The follower's trades are checked in TimeStamp order: a pair counts as copying once
+    ceil(95%) of them copy a leader trade, and not once ceil(5%) of them do not, whichever
+    comes first. So the rank of the ceil(95%)-th copied trade decides it.
+    """
+    order = np.lexsort((rank, leader, follower))
+    follower, leader, rank = follower[order], leader[order], rank[order]
+    start = np.ones(len(follower), dtype=bool)
+    start[1:] = (follower[1:] != follower[:-1]) | (leader[1:] != leader[:-1])
+    index = np.arange(len(follower))
+    nth = index - np.maximum.accumulate(np.where(start, index, 0))
+    decided = nth == trades.copy_num[follower] - 1
+    copying = decided & (rank - nth < trades.no_copy_num[follower])
+    return follower[copying], leader[copying]
+
+
+def _join_pairs(trades: CopyTrades) -> Tuple[np.ndarray, np.ndarray]:
+    """Copying pairs among all miners, joining every trade with the trades of the window before it."""
+    # sort the trades by (token, direction, leverage, side, timestamp) and find the trades of
+    # the COPY_WINDOW seconds before each one in the same group with two binary searches
+    everything = np.arange(len(trades.codes))
+    key = trades.key(everything, trades.groups)
+    by_key = np.argsort(key, kind="stable")
+    sorted_key = key[by_key]
+    lo = np.searchsorted(sorted_key, key - COPY_WINDOW, side="left")
+    hi = np.where(trades.groups >= 0, np.searchsorted(sorted_key, key, side="left"), lo)
+
+    # every (trade, earlier trade) match, reduced to the other miners a trade copies
+    miners = len(trades.miners)
+    trade, offset = _expand(hi - lo)
+    leader = trades.codes[by_key[lo[trade] + offset]]
+    other = trades.codes[trade] != leader
+    pairs = np.unique(trade[other] * miners + leader[other])
+    trade, leader = pairs // miners, pairs % miners
+    return _copying(trades, trades.codes[trade], leader, trades.rank[trade])
+
+
+def _lsh_candidates(trades: CopyTrades) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (follower, leader) pairs of miners where the leader may have made the follower's trades first.
+
+    A trade's signature is its (group, COPY_WINDOW-second bucket); a leader also gets the
+    signature of the next bucket for every trade, so the bucket of a copy is always among the
+    leader's. The follower's signatures are sampled by MinHash, one per hash, and a miner whose
+    signatures contain every sample of a band of COPY_LSH_ROWS hashes is a candidate leader. A
+    follower copying 95% of its trades shares a band with its leader with probability of at
+    least 1 - (1 - 0.95 ** COPY_LSH_ROWS) ** COPY_LSH_BANDS.
+    """
+    valid = trades.groups >= 0
+    codes = trades.codes[valid]
+    signature = trades.groups[valid] * 2 ** 32 + trades.timestamp[valid] // COPY_WINDOW
+    _, signature = np.unique(np.concatenate([signature, signature + 1]), return_inverse=True)
+    miners = len(trades.miners)
+    # the leader signatures sorted by signature, so the miners having one are a range of them
+    leader_key = np.unique(signature * miners + np.concatenate([codes, codes]))
+    leader_signature, leader = leader_key // miners, leader_key % miners
+    # the follower signatures of every miner together
+    order = np.argsort(codes, kind="stable")
+    owner, signature = codes[order], signature[:len(codes)][order]
+    followers, starts, sizes = np.unique(owner, return_index=True, return_counts=True)
+    if len(followers) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    pairs = []
+    for band in range(COPY_LSH_BANDS):
+        samples = []
+        for seed in COPY_LSH_SEEDS[band * COPY_LSH_ROWS:(band + 1) * COPY_LSH_ROWS]:
+            # the signature of smallest hash of every follower, the first one on a tie
+            hashed = _mix(signature.astype(np.uint64) ^ seed)
+            hit = np.flatnonzero(hashed == np.repeat(np.minimum.reduceat(hashed, starts), sizes))
+            first = np.ones(len(hit), dtype=bool)
+            first[1:] = owner[hit[1:]] != owner[hit[:-1]]
+            samples.append(signature[hit[first]])
+        lo = np.searchsorted(leader_signature, samples[0], side="left")
+        hi = np.searchsorted(leader_signature, samples[0], side="right")
+        follower, offset = _expand(hi - lo)
+        candidate = leader[lo[follower] + offset]
+        keep = followers[follower] != candidate
+        for sample in samples[1:]:
+            key = sample[follower] * miners + candidate
+            found = np.minimum(np.searchsorted(leader_key, key), len(leader_key) - 1)
+            keep &= leader_key[found] == key
+        pairs.append(followers[follower[keep]] * miners + candidate[keep])
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // miners, pairs % miners
+
+
+def _candidate_pairs(trades: CopyTrades, follower: np.ndarray, leader: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Copying pairs among the given (follower, leader) candidates, joining each follower with its leader only."""
+    result_follower, result_leader = [], []
+    groups = int(trades.groups.max(initial=0)) + 1
+    # keep the (pair, group, timestamp) sort keys within int64
+    chunk = max(1, 2 ** 30 // groups)
+    for begin in range(0, len(follower), chunk):
+        pair_follower, pair_leader = follower[begin:begin + chunk], leader[begin:begin + chunk]
+        pair, leader_trades = trades.miner_trades(pair_leader)
+        leader_trades, pair = leader_trades[trades.groups[leader_trades] >= 0], pair[trades.groups[leader_trades] >= 0]
+        sorted_key = np.sort(trades.key(leader_trades, pair * groups + trades.groups[leader_trades]))
+        pair, follower_trades = trades.miner_trades(pair_follower)
+        key = trades.key(follower_trades, pair * groups + trades.groups[follower_trades])
+        copied = ((np.searchsorted(sorted_key, key, side="left") > np.searchsorted(sorted_key, key - COPY_WINDOW))
+                  & (trades.groups[follower_trades] >= 0))
+        found = _copying(trades, pair_follower[pair[copied]], pair_leader[pair[copied]],
+                         trades.rank[follower_trades[copied]])
+        result_follower.append(found[0])
+        result_leader.append(found[1])
+    if not result_follower:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(result_follower), np.concatenate(result_leader)
+
+
+def copy_trading_pairs(df: pd.DataFrame, prefilter: bool = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Every (follower, leader) pair of miners in which the follower copies the leader.
+
+    With `prefilter`, by default from COPY_LSH_MIN_MINERS miners on, only the pairs found by
+    _lsh_candidates are checked. The check is exact, but a copying pair is missed in the rare
+    case that it does not become a candidate.
+
+    Returns the miners in order of their first trade, and the follower and leader of every
+    pair as positions in it.
+    """
+    trades = CopyTrades(df)
+    if prefilter is None:
+        prefilter = trades.eligible >= COPY_LSH_MIN_MINERS
+    if prefilter:
+        follower, leader = _candidate_pairs(trades, *_lsh_candidates(trades))
     else:
-        raise Exception(f'check_copy_trading func error')
-
-
-def copy_trading_elimination(keypair) -> dict:
-    result = dict()
+        follower, leader = _join_pairs(trades)
+    return trades.miners, follower, leader
+
+
+def copy_trading_clusters(miners: np.ndarray, follower: np.ndarray, leader: np.ndarray) -> List[List[str]]:
+    """Groups of miners linked by copying, in order of their first trade as are the miners of each group."""
+    graph = coo_matrix((np.ones(len(follower)), (follower, leader)), shape=(len(miners), len(miners)))
+    count, labels = connected_components(graph, directed=True, connection="weak")
+    linked = np.zeros(len(miners), dtype=bool)
+    linked[follower] = True
+    linked[leader] = True
+    clusters = {}
+    for code in np.flatnonzero(linked).tolist():
+        clusters.setdefault(int(labels[code]), []).append(miners[code])
+    return list(clusters.values())
+
+
+def copy_trading_elimination(order_window: OrderWindow, prefilter: bool = None) -> Tuple[dict, List[List[str]]]:
+    """
+    Copy trading in the last 7 days: follower -> leader, the leader that comes last when a
+    follower copies several, and the clusters of miners linked by copying.
+    """
     timestamp = int(time.time())
     tradetime = timestamp - 7 * 86400
-    orders = get_orders(keypair, timestamp, tradetime)
-    df = pd.DataFrame(orders)
+    df = order_window.frame(since=tradetime)
     if df.empty:
-        return result
-    all_miner = list(df['MinerId'].unique())
-    for t1_miner in all_miner:
-        for t2_miner in all_miner:
-            if t1_miner == t2_miner:
-                continue
-            df_1 = df[df['MinerId'] == t1_miner]
-            df_2 = df[df['MinerId'] == t2_miner]
-            if df_1.shape[0] < 5 or df_2.shape[0] < 5:
-                continue
-            if check_copy_trading(df_1, df_2):
-                # print(t1_miner, t2_miner)
-                result[t1_miner] = t2_miner
-    return result
-
-
-def filter_groups_roi_elimination(group):
-    consecutive_count = 0
-    total_count = 0
-    for roi in group['roi']:
-        if roi < -50:
-            consecutive_count += 1
-            total_count += 1
-            if consecutive_count >= 2 or total_count >= 5:
-                return True
-        else:
-            consecutive_count = 0
-    return False
-
-
-def roi_elimination(checkpoints) -> list:
-    data = list()
-    for value in checkpoints:
-        last_update = value.last_update
-        rois = value.roi
-        if not last_update or not rois:
-            continue
-        formatted_date = datetime.fromtimestamp(last_update, tz=timezone.utc).strftime('%Y-%m-%d')
-        for address, roi in rois.items():
-            tmp_data = dict()
-            tmp_data['address'] = address
-            tmp_data['last_update'] = last_update
-            tmp_data['last_update_day'] = formatted_date
-            tmp_data['roi'] = roi
-            data.append(tmp_data)
+        return dict(), []
+    miners, follower, leader = copy_trading_pairs(df, prefilter)
+    order = np.lexsort((leader, follower))
+    follower, leader = follower[order], leader[order]
+    last = np.ones(len(follower), dtype=bool)
+    last[:-1] = follower[1:] != follower[:-1]
+    result = {miners[f]: miners[l] for f, l in zip(follower[last].tolist(), leader[last].tolist())}
+    return result, copy_trading_clusters(miners, follower, leader)
+
+
+def roi_elimination(checkpoints, history: CheckpointHistory, addresses: List[str]) -> list:
+    """
+    Miners whose checkpoint roi of the last 30 days was below -50% on 2 checkpoints in a row, or
+    on 5 checkpoints in all, in address order. Checkpoints that did not evaluate a miner are
+    skipped, they neither count nor break a streak.
+    """
     current_time = int(time.time()) // 86400 * 86400
     check_time = current_time - 30 * 86400
-    # columns = ['address', 'last_update', 'last_update_day', 'roi']
-    df = pd.DataFrame(data)
-    if df.empty:
-        return []
-    filtered_df = df[df['last_update'] >= check_time]
-    filtered_df = filtered_df.sort_values(by='last_update', ascending=False).groupby(
-        ['address', 'last_update_day']).first().reset_index()
-    filtered_result = filtered_df.groupby('address').filter(filter_groups_roi_elimination)
-    unique_miner_ids = list(filtered_result['address'].unique())
-    return unique_miner_ids
+    days = np.array([checkpoint.last_update >= check_time for checkpoint in checkpoints], dtype=bool)
+    miners = len(addresses)
+    history.reserve(miners)
+    present = history.present[days, :miners].T
+    low = present & (history.roi[days, :miners].T < -50)
+    # the present checkpoints of every miner moved to the front, in checkpoint order
+    low = np.take_along_axis(low, np.argsort(~present, axis=1, kind="stable"), axis=1)
+    streak = (low[:, 1:] & low[:, :-1]).any(axis=1)
+    eliminated = np.flatnonzero(streak | (low.sum(axis=1) >= 5))
+    return sorted(addresses[column] for column in eliminated.tolist())
 
 
 def mdd_elimination(mdd_data) -> list:
@@ -186,11 +364,11 @@ def mdd_elimination(mdd_data) -> list:
     return unique_miner_ids
 
 
-def get_protected_miner(keypair) -> list:
+def get_protected_miner(register_cache: RegisterTimeCache) -> set:
     timestamp = int(time.time())
     starttime = timestamp - 7 * 86400
-    protect_miner = get_miners(keypair, timestamp, starttime)
-    return list(protect_miner.keys())
+    protect_miner = register_cache.get(starttime)
+    return set(protect_miner.keys())
 
 
 def save_eliminate_data(eliminate_data, file=None):
@@ -222,7 +400,10 @@ def main():
     # print(get_eliminate_data())
     # print(copy_trading_elimination(keypair))
     # save_eliminate_data({'a':True,'b':False})
-    print(roi_elimination([]))
+    # roi elimination over the checkpoints of the last saved snapshot
+    account_manager = AccountManager(logger=logger)
+    account_manager.restore()
+    print(roi_elimination(account_manager.checkpoints, account_manager.history, account_manager.book.addresses))
 
 
 if __name__ == '__main__':
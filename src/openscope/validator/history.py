@@ -0,0 +1,126 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class CheckpointHistory:
+    """
+    cur_ret, prev_ret and roi of every checkpoint as day x miner arrays.
+
+    Row i belongs to AccountManager.checkpoints[i] and column j to row j of the account book, so
+    the history of a miner is a column and a checkpoint is a row. `present` marks the cells a
+    checkpoint has evaluated, and `rank` the order they were first evaluated in, which keeps
+    generate_returns and its mdd list in the order the per-checkpoint address dicts had.
+    """
+
+    STATE_ARRAYS = ("cur_ret", "prev_ret", "roi", "present", "rank")
+
+    def __init__(self, capacity: int = 256):
+        self.cur_ret = np.zeros((0, capacity))
+        self.prev_ret = np.zeros((0, capacity))
+        self.roi = np.zeros((0, capacity))
+        self.present = np.zeros((0, capacity), dtype=bool)
+        self.rank = np.full((0, capacity), -1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.cur_ret.shape[0]
+
+    @property
+    def capacity(self) -> int:
+        return self.cur_ret.shape[1]
+
+    def reserve(self, miners: int) -> None:
+        """Make room for the first `miners` book rows."""
+        if miners <= self.capacity:
+            return
+        capacity = max(self.capacity * 2, miners)
+        for name in self.STATE_ARRAYS:
+            array = getattr(self, name)
+            grown = np.full((len(self), capacity), -1 if name == "rank" else 0, dtype=array.dtype)
+            grown[:, :array.shape[1]] = array
+            setattr(self, name, grown)
+
+    def insert(self, position: int) -> None:
+        """An empty row for a checkpoint inserted at `position`."""
+        for name in self.STATE_ARRAYS:
+            array = getattr(self, name)
+            setattr(self, name, np.insert(array, position, -1 if name == "rank" else 0, axis=0))
+
+    def keep_last(self, days: int) -> None:
+        for name in self.STATE_ARRAYS:
+            setattr(self, name, getattr(self, name)[-days:])
+
+    def clear(self, column: int) -> None:
+        """Forget a miner, as if no checkpoint had evaluated it."""
+        if column >= self.capacity:
+            return
+        self.present[:, column] = False
+        self.rank[:, column] = -1
+
+    def record(self, day: int, columns: np.ndarray, value: np.ndarray, roi: np.ndarray) -> None:
+        """
+        Position value and roi of the given miners at checkpoint `day`; prev_ret is the miner's
+        value at the checkpoint before, 10.0 when that one did not evaluate it.
+        """
+        self.reserve(int(columns.max()) + 1 if len(columns) else 0)
+        if day > 0:
+            prev = np.where(self.present[day - 1, columns], self.cur_ret[day - 1, columns], 10.0)
+        else:
+            prev = np.full(len(columns), 10.0)
+        new = columns[~self.present[day, columns]]
+        self.rank[day, new] = self.rank[day].max() + 1 + np.arange(len(new))
+        self.cur_ret[day, columns] = value
+        self.roi[day, columns] = roi
+        self.prev_ret[day, columns] = prev
+        self.present[day, columns] = True
+
+    def columns(self, day: int) -> np.ndarray:
+        """Columns evaluated at checkpoint `day`, in the order they were first evaluated."""
+        columns = np.flatnonzero(self.present[day])
+        return columns[np.argsort(self.rank[day, columns], kind="stable")]
+
+    def returns(self, miners: int) -> Tuple[List[int], List[List[float]], List[List[float]], List[int]]:
+        """
+        Per miner, the checkpoint returns and relative changes up to and including its first
+        negative position value, as generate_returns gives them.
+
+        Returns the columns in the order the miners were first evaluated, their return and change
+        lists, and the columns that went negative in the order they did.
+        """
+        self.reserve(miners)
+        present = self.present[:, :miners]
+        cur, prev = self.cur_ret[:, :miners], self.prev_ret[:, :miners]
+        days = np.arange(len(self))[:, None]
+        negative = present & (cur < 0)
+        first_negative = np.where(negative.any(axis=0), negative.argmax(axis=0), len(self))
+        keep = present & (days <= first_negative)
+
+        seen = present.any(axis=0)
+        order = np.flatnonzero(seen)
+        first = present.argmax(axis=0)[order]
+        order = order[np.lexsort((self.rank[first, order], first))]
+        failed = np.flatnonzero(first_negative < len(self))
+        failed = failed[np.lexsort((self.rank[first_negative[failed], failed], first_negative[failed]))]
+
+        # left-align the kept cells of every miner, a stable sort keeps them in checkpoint order
+        keep = keep[:, order].T
+        index = np.argsort(~keep, axis=1, kind="stable")
+        lengths = keep.sum(axis=1).tolist()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = np.take_along_axis((cur - prev)[:, order].T, index, axis=1).tolist()
+            change = np.take_along_axis(((cur - prev) / prev)[:, order].T, index, axis=1).tolist()
+        return (order.tolist(), [row[:n] for row, n in zip(value, lengths)],
+                [row[:n] for row, n in zip(change, lengths)], failed.tolist())
+
+    def get_state(self, miners: int) -> Dict[str, np.ndarray]:
+        self.reserve(miners)
+        return {f"history_{name}": getattr(self, name)[:, :miners] for name in self.STATE_ARRAYS}
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> None:
+        days, miners = state["history_cur_ret"].shape
+        self.__init__(max(miners, 1))
+        for name in self.STATE_ARRAYS:
+            array = getattr(self, name)
+            grown = np.full((days, array.shape[1]), -1 if name == "rank" else 0, dtype=array.dtype)
+            grown[:, :miners] = state[f"history_{name}"]
+            setattr(self, name, grown)
@@ -0,0 +1,78 @@
+import sys
+from typing import Iterable, List
+
+import numpy as np
+
+from storage import ORDER_COLUMNS
+
+# checkpoint orders are kept as records of this type, MinerId and Token are IdTable codes
+ORDER_DTYPE = np.dtype([("MinerId", np.int32), ("Token", np.int32), ("isClose", np.bool_), ("Direction", np.int8),
+                        ("Nonce", np.int64), ("Price", np.float64), ("Price4H", np.float64),
+                        ("TimeStamp", np.int64), ("Leverage", np.float64)])
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Order:
+    # keep orders in flight free of a per-instance __dict__ and share the miner and token strings
+    __slots__ = tuple(ORDER_COLUMNS)
+
+    def __init__(self, MinerId="", Token="", isClose=False, Direction=0, Nonce=0, Price=0, Price4H=0, TimeStamp=0,
+                 Leverage=1):
+        self.MinerId = _intern(MinerId)
+        self.Token = _intern(Token)
+        self.isClose = isClose
+        self.Direction = Direction
+        self.Nonce = Nonce
+        self.Price = Price
+        self.Price4H = Price4H
+        self.TimeStamp = TimeStamp
+        self.Leverage = Leverage
+
+
+class IdTable:
+    """Miner and token ids as int32 codes, so order records hold no Python strings."""
+    __slots__ = ("ids", "codes")
+
+    def __init__(self, ids: List[str] = None):
+        self.ids = [] if ids is None else [_intern(id) for id in ids]
+        self.codes = {id: code for code, id in enumerate(self.ids)}
+
+    def code(self, id: str) -> int:
+        code = self.codes.get(id)
+        if code is None:
+            code = len(self.ids)
+            self.ids.append(id)
+            self.codes[id] = code
+        return code
+
+
+def encode_orders(orders: List[Order], ids: IdTable) -> np.ndarray:
+    code = ids.code
+    return np.array([(code(order.MinerId), code(order.Token), order.isClose, order.Direction, order.Nonce,
+                      order.Price, order.Price4H, order.TimeStamp, order.Leverage) for order in orders],
+                    dtype=ORDER_DTYPE)
+
+
+def encode_rows(rows: Iterable[tuple], ids: IdTable) -> np.ndarray:
+    """Records of order tuples in ORDER_COLUMNS order, as OrderStore.iter_rows reads them."""
+    code = ids.code
+    return np.fromiter(((code(row[0]), code(row[1])) + row[2:] for row in rows), dtype=ORDER_DTYPE)
+
+
+def decode_ids(codes: np.ndarray, ids: IdTable) -> np.ndarray:
+    """The miner or token ids of record codes, as an object array of the shared id strings."""
+    return np.array(ids.ids, dtype=object)[codes]
+
+
+def iter_orders(records: np.ndarray, ids: IdTable, batch: int = 5000):
+    """Order objects for the records, built a batch at a time."""
+    for start in range(0, len(records), batch):
+        chunk = records[start:start + batch]
+        columns = [chunk[column].tolist() for column in ORDER_COLUMNS]
+        columns[0] = [ids.ids[code] for code in columns[0]]
+        columns[1] = [ids.ids[code] for code in columns[1]]
+        for row in zip(*columns):
+            yield Order(*row)
@@ -0,0 +1,175 @@
+import argparse
+import bisect
+import json
+import sys
+import time
+import warnings
+from typing import Callable, Dict, List
+
+import numpy as np
+from loguru import logger
+from substrateinterface import Keypair
+
+from orders import IdTable, decode_ids, encode_rows
+from storage import DEFAULT_ORDERS_LOCATION, DEFAULT_PRICES_LOCATION, OrderStore, PriceStore
+from shard import ShardedBook
+from trade import DEFAULT_TOKENS, MAIN_TOKENS, AccountManager
+from validator import TradeValidator
+
+STAGES = ["group", "process", "returns", "serenity", "vote"]
+
+
+class StoredPrices:
+    """
+    Price source backed by a PriceStore: the closing prices of the checkpoint's day, or of the
+    closest earlier day with a full price set when that day was not recorded.
+    """
+
+    def __init__(self, store: PriceStore):
+        prices = store.load_all_prices()
+        self.prices = {day: value for day, value in prices.items() if len(value) == len(DEFAULT_TOKENS)}
+        self.days = sorted(self.prices)
+
+    def __call__(self, last_update: int) -> Dict[str, float]:
+        i = bisect.bisect_right(self.days, last_update // 86400)
+        if i == 0:
+            raise ValueError(f"no recorded prices on or before {last_update}")
+        return self.prices[self.days[i - 1]]
+
+
+class DryRunClient:
+    """Stands in for the CommuneClient, keeping the votes instead of sending them."""
+
+    def __init__(self):
+        self.votes = []
+
+    def vote(self, key, uids: List[int], weights: List[int], netuid: int) -> None:
+        self.votes.append(dict(zip(uids, weights)))
+
+
+class ReplayAccountManager(AccountManager):
+    """AccountManager that takes its prices from `price_source` and keeps nothing on disk."""
+
+    def __init__(self, price_source: Callable[[int], Dict[str, float]], logger=None, book=None):
+        super().__init__(logger=logger, book=book)
+        self.price_source = price_source
+        # never pick up the live validator's snapshot
+        self.restored = True
+
+    def get_checkpoint_price(self, addr: str, pub_key: str, keypair: Keypair, last_update: int) -> Dict[str, float]:
+        return self.price_source(last_update)
+
+    def save_snapshot(self) -> None:
+        pass
+
+
+def scale_records(records: np.ndarray, ids: IdTable, scale: int) -> np.ndarray:
+    """Clone every miner `scale` times, the copies trade exactly like the original."""
+    if scale <= 1:
+        return records
+    miners = np.unique(records["MinerId"])
+    clones = np.array([[code] + [ids.code(f'{ids.ids[code]}-{i}') for i in range(1, scale)]
+                       for code in miners.tolist()], dtype=np.int32)
+    result = np.repeat(records, scale)
+    result["MinerId"] = clones[np.searchsorted(miners, records["MinerId"])].ravel()
+    return result
+
+
+def replay(records: np.ndarray, ids: IdTable, price_source: Callable[[int], Dict[str, float]], step: int = 3600,
+           processes: int = 1) -> Dict:
+    """
+    Run recorded order records, coded by `ids`, through the scoring pipeline, one validator step
+    per `step` seconds of order history, and report the scores, the votes and the time spent in
+    every stage.
+    """
+    records = records[np.argsort(records["TimeStamp"], kind="stable")]
+    timestamps = records["TimeStamp"]
+    book = ShardedBook(DEFAULT_TOKENS, MAIN_TOKENS, processes) if processes > 1 else None
+    account_manager = ReplayAccountManager(price_source, logger=logger, book=book)
+    account_manager.ids = ids
+    client = DryRunClient()
+    key = Keypair.create_from_uri('//replay')
+    validator = TradeValidator(key, 0, client, account_manager)
+    miners = sorted(decode_ids(np.unique(records["MinerId"]), ids).tolist())
+    uid_map = {address: uid for uid, address in enumerate(miners)}
+    for address in miners:
+        account_manager.add_account(address)
+
+    timings = {stage: 0.0 for stage in STAGES}
+    score_dict = {}
+    steps = 0
+    start = 0
+    while start < len(records):
+        end = int(np.searchsorted(timestamps, timestamps[start] // step * step + step, side="left"))
+        tick = time.perf_counter()
+        account_manager.group_records_by_day(records[start:end])
+        timings["group"] += time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        account_manager.process_orders_by_day('', '', key)
+        timings["process"] += time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        return_data, change_data, mdd_list = account_manager.generate_returns()
+        timings["returns"] += time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        score_dict = validator.score_miners(return_data, change_data, mdd_list, uid_map)
+        timings["serenity"] += time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        if score_dict:
+            validator.vote(score_dict, uid_map)
+        timings["vote"] += time.perf_counter() - tick
+        steps += 1
+        start = end
+
+    if book is not None:
+        book.close()
+    accounting = timings["group"] + timings["process"]
+    scoring = timings["returns"] + timings["serenity"] + timings["vote"]
+    return {
+        "orders": len(records),
+        "miners": len(miners),
+        "processes": processes,
+        "steps": steps,
+        "timings": timings,
+        "orders_per_sec": len(records) / accounting if accounting else 0.0,
+        "miners_per_sec": len(miners) * steps / scoring if scoring else 0.0,
+        "scores": score_dict,
+        "weights": client.votes[-1] if client.votes else {},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded orders through the validator scoring offline")
+    parser.add_argument("--orders", type=str, default=DEFAULT_ORDERS_LOCATION, help="order store to replay")
+    parser.add_argument("--prices", type=str, default=DEFAULT_PRICES_LOCATION, help="price store to replay")
+    parser.add_argument("--since", type=int, default=0, help="first order timestamp to replay")
+    parser.add_argument("--step", type=int, default=3600, help="seconds of order history per validator step")
+    parser.add_argument("--scale", type=int, default=1, help="clone every miner this many times")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to shard the miners over")
+    parser.add_argument("--output", type=str, default=None, help="write the report as json to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the validator's info logs")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO" if args.verbose else "WARNING")
+    if not args.verbose:
+        warnings.simplefilter("ignore", RuntimeWarning)
+
+    ids = IdTable()
+    records = scale_records(encode_rows(OrderStore(args.orders).iter_rows(args.since), ids), ids, args.scale)
+    report = replay(records, ids, StoredPrices(PriceStore(args.prices)), step=args.step, processes=args.processes)
+
+    print(f"orders: {report['orders']}, miners: {report['miners']}, steps: {report['steps']}")
+    for stage in STAGES:
+        print(f"{stage:>10}: {report['timings'][stage]:8.3f}s")
+    print(f"orders/s: {report['orders_per_sec']:.0f}, miners/s: {report['miners_per_sec']:.0f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import multiprocessing
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from book import AccountBook
+from orders import IdTable
+
+# the book and id table of the shard a worker process serves
+_book: AccountBook = None
+_ids: IdTable = None
+
+
+def _init_worker(tokens: List[str], main_tokens: List[str], balance: float) -> None:
+    global _book, _ids
+    _book = AccountBook(tokens, main_tokens, balance=balance)
+    _ids = IdTable()
+
+
+def _call(ops: List[Tuple[str, str]], ids: Tuple[bool, List[str]], method: str, *args):
+    """Catch up on the queued account changes and new ids, then run one AccountBook method."""
+    global _ids
+    reset, new_ids = ids
+    if reset:
+        _ids = IdTable()
+    for id in new_ids:
+        _ids.code(id)
+    for op, address in ops:
+        getattr(_book, op)(address)
+    if method == "apply_records":
+        records, latest_price = args
+        return _book.apply_records(records, _ids, latest_price)
+    return getattr(_book, method)(*args)
+
+
+def shard_of(address: str, shards: int) -> int:
+    """The shard a miner belongs to, stable across restarts and processes."""
+    return zlib.crc32(address.encode()) % shards
+
+
+class ShardedBook:
+    """
+    AccountBook split over `processes` worker processes by a hash of the miner address.
+
+    Every shard is a worker holding a plain AccountBook of its miners, so orders are replayed and
+    accounts marked to market on all shards at once. Rows are numbered globally in the order the
+    addresses were added, exactly as a single AccountBook numbers them, and every result is put
+    back in that order, so AccountManager gets the same output either way.
+    """
+
+    def __init__(self, tokens: List[str], main_tokens: List[str], processes: int, balance: float = 10.0):
+        self.tokens = list(tokens)
+        self.main_tokens = list(main_tokens)
+        self.balance = balance
+        self.processes = processes
+        # one single-worker pool per shard, so a shard's book always lives in the same process; the
+        # workers are spawned, a forked one could inherit a lock held by one of the validator's threads
+        context = multiprocessing.get_context("spawn")
+        self.pools = [ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                          initargs=(self.tokens, self.main_tokens, balance))
+                      for _ in range(processes)]
+        self.index: Dict[str, int] = {}
+        self.addresses: List[str] = []
+        # shard of every global row, a shard numbers its own rows in the same order
+        self.shards: List[int] = []
+        # account changes not sent to the workers yet, they go with the next call; the lock keeps
+        # a reset queued from another thread from landing in a queue that is being sent
+        self.ops: List[List[Tuple[str, str]]] = [[] for _ in range(processes)]
+        self.lock = threading.RLock()
+        # the id table the workers mirror, and the shard of every id in it
+        self.ids: IdTable = None
+        self.id_shards = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.index
+
+    def close(self) -> None:
+        for pool in self.pools:
+            pool.shutdown()
+
+    def _sync_ids(self, ids: IdTable) -> Tuple[bool, List[str]]:
+        """Whether the workers must start a new id table, and the ids they have not seen yet."""
+        reset = ids is not self.ids
+        if reset:
+            self.ids = ids
+            self.id_shards = np.zeros(0, dtype=np.int64)
+        new_ids = ids.ids[len(self.id_shards):]
+        self.id_shards = np.append(self.id_shards, [shard_of(id, self.processes) for id in new_ids]).astype(np.int64)
+        return reset, new_ids
+
+    def _submit(self, shard: int, method: str, *args, ids: Tuple[bool, List[str]] = (False, ())):
+        with self.lock:
+            ops, self.ops[shard] = self.ops[shard], []
+            return self.pools[shard].submit(_call, ops, ids, method, *args)
+
+    def _shard_rows(self) -> List[np.ndarray]:
+        """The global rows of every shard, in the shard's row order."""
+        shards = np.array(self.shards, dtype=np.int64)
+        return [np.flatnonzero(shards == shard) for shard in range(self.processes)]
+
+    def _gather(self, method: str, *args) -> list:
+        futures = [self._submit(shard, method, *args) for shard in range(self.processes)]
+        return [future.result() for future in futures]
+
+    def add_account(self, address: str) -> int:
+        with self.lock:
+            row = self.index.get(address)
+            if row is not None:
+                return row
+            shard = shard_of(address, self.processes)
+            row = len(self.addresses)
+            self.index[address] = row
+            self.addresses.append(address)
+            self.shards.append(shard)
+            self.ops[shard].append(("add_account", address))
+            return row
+
+    def reset_account(self, address: str) -> int:
+        with self.lock:
+            row = self.add_account(address)
+            self.ops[self.shards[row]].append(("reset_account", address))
+            return row
+
+    def clear(self) -> None:
+        with self.lock:
+            self.index = {}
+            self.addresses = []
+            self.shards = []
+            self.ops = [[] for _ in range(self.processes)]
+        self._gather("clear")
+
+    def apply_order(self, order, latest_price: Dict[str, float]) -> None:
+        row = self.index.get(order.MinerId)
+        if row is None:
+            return
+        self._submit(self.shards[row], "apply_order", order, latest_price).result()
+
+    def apply_records(self, records: np.ndarray, ids: IdTable, latest_price: Dict[str, float]) -> None:
+        """Send every shard the records of its miners, kept in their order."""
+        update = self._sync_ids(ids)
+        shards = self.id_shards[records["MinerId"]]
+        futures = [self._submit(shard, "apply_records", records[shards == shard], latest_price, ids=update)
+                   for shard in range(self.processes)]
+        for future in futures:
+            future.result()
+
+    def evaluate(self, prices: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        rows, roi, value, win = [], [], [], []
+        shard_rows = self._shard_rows()
+        for shard, result in enumerate(self._gather("evaluate", prices)):
+            local_rows, shard_roi, shard_value, shard_win = result
+            rows.append(shard_rows[shard][local_rows])
+            roi.append(shard_roi)
+            value.append(shard_value)
+            win.append(shard_win)
+        rows = np.concatenate(rows)
+        order = np.argsort(rows, kind="stable")
+        return (rows[order], np.concatenate(roi)[order], np.concatenate(value)[order],
+                np.concatenate(win)[order])
+
+    def map_miners(self, fn: Callable, items: Dict[str, object]) -> Dict[str, object]:
+        """fn over the items of every shard in its worker, merged back in the order given."""
+        parts = [{} for _ in range(self.processes)]
+        for address, args in items.items():
+            parts[shard_of(address, self.processes)][address] = args
+        futures = [self.pools[shard].submit(fn, part) for shard, part in enumerate(parts) if part]
+        results = {}
+        for future in futures:
+            results.update(future.result())
+        return {address: results[address] for address in items}
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        n = len(self.addresses)
+        state = {}
+        shard_rows = self._shard_rows()
+        for shard, shard_state in enumerate(self._gather("get_state")):
+            rows = shard_rows[shard]
+            for name in AccountBook.STATE_ARRAYS:
+                array = shard_state[name]
+                if name not in state:
+                    state[name] = np.zeros((n,) + array.shape[1:], dtype=array.dtype)
+                state[name][rows] = array
+        state["addresses"] = np.array(self.addresses, dtype=str)
+        state["tokens"] = np.array(self.tokens, dtype=str)
+        return state
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> None:
+        if state["tokens"].tolist() != self.tokens:
+            raise ValueError("account book state was saved for other tokens")
+        with self.lock:
+            self.clear()
+            for address in state["addresses"].tolist():
+                self.add_account(address)
+            # the adds are queued for the workers, set_state replaces them with the saved rows
+            self.ops = [[] for _ in range(self.processes)]
+            futures = []
+            for shard, rows in enumerate(self._shard_rows()):
+                shard_state = {name: state[name][rows] for name in AccountBook.STATE_ARRAYS}
+                shard_state["addresses"] = state["addresses"][rows]
+                shard_state["tokens"] = state["tokens"]
+                futures.append(self._submit(shard, "set_state", shard_state))
+        for future in futures:
+            future.result()
@@ -1,6 +1,6 @@
 import pandas
 import numpy as np
-import inspect
+import sys
 from scipy.stats import norm
 
 def calculate_serenity(returns, changes, rf=0):
@@ -12,6 +12,313 @@ def calculate_serenity(returns, changes, rf=0):
     dd2 = to_drawdown_series(changes)
     return (returns.sum() - rf) / (ulcer_index(returns) * pitfall), np.min(dd2)
 
+def calculate_serenity_batch(returns, changes, lengths=None, rf=0):
+    """
+    calculate_serenity for many miners at once
+
+    returns and changes are miners x days arrays, row i holding lengths[i] values followed by
+    NaN padding; lengths defaults to the columns up to the last non-NaN value of each returns row.
+    Gives the serenity and mdd of every row.
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    changes = np.asarray(changes, dtype=np.float64)
+    if lengths is None:
+        present = ~np.isnan(returns)
+        lengths = np.where(present.any(axis=1), returns.shape[1] - np.argmax(present[:, ::-1], axis=1), 0)
+    lengths = np.asarray(lengths)
+    valid = np.arange(returns.shape[1]) < lengths[:, None]
+    with np.errstate(all="ignore"):
+        dd = _drawdown_batch(returns, valid)
+        prepared = _prepare_returns_batch(dd, valid)
+        var = _value_at_risk_batch(_prepare_returns_batch(prepared, valid), valid, lengths)
+        tail = valid & (prepared < var[:, None])
+        c_var = np.where(tail, prepared, 0).sum(axis=1) / tail.sum(axis=1)
+        c_var = np.where(np.isnan(c_var), var, c_var)
+        pitfall = -c_var / _std_batch(returns, valid)
+        ulcer = np.sqrt(np.divide(np.nansum(np.where(valid, dd ** 2, np.nan), axis=1), lengths - 1))
+        serenity = (np.nansum(np.where(valid, returns, np.nan), axis=1) - rf) / (ulcer * pitfall)
+        mdd = _nanmin_batch(_drawdown_batch(changes, valid), valid)
+    return serenity, mdd
+
+def _pad(lists, lengths):
+    """NaN-padded rows, at least one column wide so that every row has a last column to index"""
+    matrix = np.full((len(lists), max(int(lengths.max()) if len(lists) else 0, 1)), np.nan)
+    for i, values in enumerate(lists):
+        matrix[i, :len(values)] = values
+    return matrix
+
+def miners_serenity(items):
+    """
+    Serenity and max drawdown of every address -> (return_list, change_list) item, a nan serenity
+    counts as 0
+    """
+    lists = list(items.values())
+    lengths = np.array([len(return_list) for return_list, _ in lists], dtype=np.int64)
+    returns = _pad([return_list for return_list, _ in lists], lengths)
+    changes = _pad([change_list for _, change_list in lists], lengths)
+    serenity, mdd = calculate_serenity_batch(returns, changes, lengths)
+    serenity = np.where(np.isnan(serenity), 0.0, serenity)
+    return dict(zip(items.keys(), zip(serenity.tolist(), mdd.tolist())))
+
+# running serenity statistics of the miners scored in this process
+SERENITY_STATE = None
+
+def incremental_serenity(epoch, items):
+    """
+    miners_serenity through the process's SerenityState, `epoch` names the set of closed
+    checkpoints behind all but the last value of every list
+    """
+    global SERENITY_STATE
+    if SERENITY_STATE is None:
+        SERENITY_STATE = SerenityState()
+    serenity, mdd = SERENITY_STATE.score(epoch, items)
+    serenity = np.where(np.isnan(serenity), 0.0, serenity)
+    return dict(zip(items.keys(), zip(serenity.tolist(), mdd.tolist())))
+
+class SerenityState:
+    """
+    calculate_serenity_batch kept as running statistics of every miner's closed checkpoints.
+
+    The closed returns are folded in once per set of checkpoints (`epoch`), after that a call
+    only adds the provisional last return of each miner. Per _prepare_prices branch the state
+    holds the growth and peak of the closed prices, the sum of squared drawdowns, the Welford
+    mean/M2 of the prepared drawdowns and, as the CVaR tail buffer, the sorted drawdowns with
+    their running sums; the branch is picked once the last return is known. Miners with
+    non-finite returns, or whose drawdowns would go through pct_change, are scored by
+    calculate_serenity_batch.
+    """
+
+    # 2-D tail buffers are padded with inf, the comparison against the VaR never counts it
+    FILL = {"tail": np.inf, "tail_sum": np.inf}
+
+    def __init__(self):
+        self.epoch = None
+        self.rows = {}
+        # number of closed returns folded into each row
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.state = {}
+
+    def score(self, epoch, items, rf=0):
+        """
+        Serenity and mdd of every address -> (return_list, change_list) item, the last value of
+        each list being the provisional one.
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.rows = {}
+            self.lengths = np.zeros(0, dtype=np.int64)
+            self.state = {}
+        addresses = list(items.keys())
+        lists = list(items.values())
+        if not lists:
+            return np.zeros(0), np.zeros(0)
+        lengths = np.array([len(return_list) for return_list, _ in lists], dtype=np.int64)
+        rows = np.array([self.rows.get(address, -1) for address in addresses], dtype=np.int64)
+        # a miner is folded again when its closed history is not the one folded, after del_account
+        known = rows >= 0
+        stale = ~known
+        stale[known] = self.lengths[rows[known]] != lengths[known] - 1
+        if stale.any():
+            index = np.flatnonzero(stale).tolist()
+            self._fold([addresses[i] for i in index], [lists[i] for i in index])
+            rows = np.array([self.rows[address] for address in addresses], dtype=np.int64)
+        last = np.array([return_list[-1] for return_list, _ in lists], dtype=np.float64)
+        last_change = np.array([change_list[-1] for _, change_list in lists], dtype=np.float64)
+        with np.errstate(all="ignore"):
+            serenity, mdd, exact = self._add_last(rows, lengths, last, last_change, rf)
+        if not exact.all():
+            index = np.flatnonzero(~exact)
+            returns = _pad([lists[i][0] for i in index], lengths[index])
+            changes = _pad([lists[i][1] for i in index], lengths[index])
+            serenity[index], mdd[index] = calculate_serenity_batch(returns, changes, lengths[index], rf)
+        return serenity, mdd
+
+    def _fold(self, addresses, lists):
+        lengths = np.array([len(return_list) - 1 for return_list, _ in lists], dtype=np.int64)
+        returns = _pad([return_list[:-1] for return_list, _ in lists], lengths)
+        changes = _pad([change_list[:-1] for _, change_list in lists], lengths)
+        valid = np.arange(returns.shape[1]) < lengths[:, None]
+        with np.errstate(all="ignore"):
+            state = self._closed_state(returns, changes, valid, lengths)
+        rows = []
+        for address in addresses:
+            if address not in self.rows:
+                self.rows[address] = len(self.rows)
+            rows.append(self.rows[address])
+        n = len(self.rows)
+        self.lengths = np.concatenate([self.lengths, np.zeros(n - len(self.lengths), dtype=np.int64)])
+        self.lengths[rows] = lengths
+        for name, values in state.items():
+            fill = self.FILL.get(name, 0)
+            current = self.state.get(name)
+            if current is None:
+                current = np.full((0,) + values.shape[1:], fill, dtype=values.dtype)
+            shape = (n,) + tuple(int(size) for size in np.maximum(current.shape[1:], values.shape[1:]))
+            if current.shape != shape:
+                grown = np.full(shape, fill, dtype=values.dtype)
+                grown[tuple(slice(0, size) for size in current.shape)] = current
+                current = self.state[name] = grown
+            if values.ndim == 3:
+                current[rows] = fill
+                current[rows, :, :values.shape[2]] = values
+            else:
+                current[rows] = values
+
+    def _closed_state(self, returns, changes, valid, lengths):
+        """The running statistics of the closed returns, per branch where the branch matters."""
+        state = {}
+        rows = np.arange(len(lengths))
+        end = np.maximum(lengths - 1, 0)
+        has = lengths > 0
+        state["finite"] = (np.isfinite(returns) | ~valid).all(axis=1) & (np.isfinite(changes) | ~valid).all(axis=1)
+        state["r_sum"] = np.where(valid, returns, 0).sum(axis=1)
+        state["r_mean"] = np.where(has, state["r_sum"] / np.maximum(lengths, 1), 0.0)
+        state["r_m2"] = np.where(valid, (returns - state["r_mean"][:, None]) ** 2, 0).sum(axis=1)
+        state["r_min"] = _nanmin_batch(returns, valid)
+        state["r_max"] = _nanmax_batch(returns, valid)
+        state["c_min"] = _nanmin_batch(changes, valid)
+        state["c_max"] = _nanmax_batch(changes, valid)
+        branches = {name: [] for name in ("peak", "dd2", "dd_min", "dd_max", "p_mean", "p_m2", "p_min", "p_max",
+                                          "tail", "tail_sum", "c_peak", "c_dd_min")}
+        for to_price in (True, False):
+            prices, growth = _prices_batch(returns, np.full(len(lengths), to_price))
+            peak = np.maximum.accumulate(prices, axis=1)
+            dd = _clean_drawdown(prices / peak - 1.0)
+            prepared = np.where(valid & np.isfinite(dd), dd, 0.0)
+            mean = np.where(has, prepared.sum(axis=1) / np.maximum(lengths, 1), 0.0)
+            tail = np.sort(np.where(valid, prepared, np.inf), axis=1)
+            branches["peak"].append(np.where(has, peak[rows, end], -np.inf))
+            branches["dd2"].append(np.nansum(np.where(valid, dd ** 2, np.nan), axis=1))
+            branches["dd_min"].append(_nanmin_batch(dd, valid))
+            branches["dd_max"].append(_nanmax_batch(dd, valid))
+            branches["p_mean"].append(mean)
+            branches["p_m2"].append(np.where(valid, (prepared - mean[:, None]) ** 2, 0).sum(axis=1))
+            branches["p_min"].append(_nanmin_batch(prepared, valid))
+            branches["p_max"].append(_nanmax_batch(prepared, valid))
+            branches["tail"].append(tail)
+            branches["tail_sum"].append(np.cumsum(np.where(np.isinf(tail), 0, tail), axis=1))
+            if to_price:
+                state["growth"] = np.where(has, growth[rows, end], 1.0)
+            prices, growth = _prices_batch(changes, np.full(len(lengths), to_price))
+            peak = np.maximum.accumulate(prices, axis=1)
+            branches["c_peak"].append(np.where(has, peak[rows, end], -np.inf))
+            branches["c_dd_min"].append(_nanmin_batch(_clean_drawdown(prices / peak - 1.0), valid))
+            if to_price:
+                state["c_growth"] = np.where(has, growth[rows, end], 1.0)
+        for name, values in branches.items():
+            state[name] = np.stack(values, axis=1)
+        return state
+
+    def _add_last(self, rows, lengths, last, last_change, rf):
+        """Serenity and mdd with the last returns added, and which rows the running statistics fit."""
+        state = self.state
+        exact = state["finite"][rows] & np.isfinite(last) & np.isfinite(last_change)
+        # column 0 of the branch statistics is the to_prices branch, column 1 the returns-as-prices one
+        to_price = (np.fmin(state["r_min"][rows], last) < 0) | (np.fmax(state["r_max"][rows], last) < 1)
+        branch = np.where(to_price, 0, 1)
+        c_to_price = (np.fmin(state["c_min"][rows], last_change) < 0) | (np.fmax(state["c_max"][rows], last_change) < 1)
+        c_branch = np.where(c_to_price, 0, 1)
+        state = {name: values[rows] if values.ndim == 1 else values[rows, c_branch if name.startswith("c_") else branch]
+                 for name, values in state.items()}
+
+        dd = self._last_drawdown(to_price, state["growth"], state["peak"], last)
+        dd_min = np.fmin(state["dd_min"], dd)
+        dd_max = np.fmax(state["dd_max"], dd)
+        prepared = np.where(np.isfinite(dd), dd, 0.0)
+        p_min = np.fmin(state["p_min"], prepared)
+        p_max = np.fmax(state["p_max"], prepared)
+        # a drawdown series that looks like prices goes through pct_change, leave it to the batch
+        exact &= ~((dd_min >= 0) & (dd_max > 1)) & ~((p_min >= 0) & (p_max > 1))
+
+        # Welford update of the prepared drawdowns for the value at risk
+        delta = prepared - state["p_mean"]
+        mean = state["p_mean"] + delta / lengths
+        m2 = state["p_m2"] + delta * (prepared - mean)
+        sigma = np.where(lengths > 1, np.sqrt(m2 / (lengths - 1)), np.nan)
+        var = np.where(sigma > 0, norm.ppf(1 - 0.95) * sigma + mean, np.nan)
+        count = (state["tail"] < var[:, None]).sum(axis=1)
+        total = np.take_along_axis(state["tail_sum"], np.maximum(count - 1, 0)[:, None], axis=1)[:, 0]
+        total = np.where(count > 0, total, 0)
+        below = prepared < var
+        c_var = (total + np.where(below, prepared, 0)) / (count + below)
+        c_var = np.where(np.isnan(c_var), var, c_var)
+
+        delta = last - state["r_mean"]
+        r_mean = state["r_mean"] + delta / lengths
+        r_m2 = state["r_m2"] + delta * (last - r_mean)
+        std = np.where(lengths > 1, np.sqrt(r_m2 / (lengths - 1)), np.nan)
+        pitfall = -c_var / std
+        ulcer = np.sqrt(np.divide(state["dd2"] + np.where(np.isnan(dd), 0, dd ** 2), lengths - 1))
+        serenity = (state["r_sum"] + last - rf) / (ulcer * pitfall)
+
+        c_dd = self._last_drawdown(c_to_price, state["c_growth"], state["c_peak"], last_change)
+        mdd = np.fmin(state["c_dd_min"], c_dd)
+        return serenity, mdd, exact
+
+    @staticmethod
+    def _last_drawdown(to_price, growth, peak, last):
+        prices = np.where(to_price, 1.0 + 1.0 * (growth * (last + 1) - 1), last)
+        prices = np.where(np.isnan(prices), 0, prices)
+        prices = np.where(np.isinf(prices), np.nan, prices)
+        return _clean_drawdown(prices / np.maximum(peak, prices) - 1.0)
+
+def _nanmin_batch(data, valid):
+    present = valid & ~np.isnan(data)
+    result = np.where(present, data, np.inf).min(axis=1, initial=np.inf)
+    return np.where(present.any(axis=1), result, np.nan)
+
+def _nanmax_batch(data, valid):
+    present = valid & ~np.isnan(data)
+    result = np.where(present, data, -np.inf).max(axis=1, initial=-np.inf)
+    return np.where(present.any(axis=1), result, np.nan)
+
+def _std_batch(data, valid):
+    """Row-wise pandas std: NaN skipped, ddof=1"""
+    present = valid & ~np.isnan(data)
+    count = present.sum(axis=1)
+    mean = np.where(present, data, 0).sum(axis=1) / count
+    var = np.where(present, (data - mean[:, None]) ** 2, 0).sum(axis=1) / (count - 1)
+    return np.where(count > 1, np.sqrt(var), np.nan)
+
+def _drawdown_batch(returns, valid):
+    """Row-wise to_drawdown_series, the branch of _prepare_prices chosen per row"""
+    to_price = (_nanmin_batch(returns, valid) < 0) | (_nanmax_batch(returns, valid) < 1)
+    prices, _ = _prices_batch(returns, to_price)
+    return _clean_drawdown(prices / np.maximum.accumulate(prices, axis=1) - 1.0)
+
+def _prices_batch(returns, to_price):
+    """Row-wise _prepare_prices with the branch given per row, and the compounded growth"""
+    # to_prices with base 1.0, cumprod skips the NaN of an inf return
+    cleaned = np.where(np.isnan(returns), 0, returns)
+    cleaned = np.where(np.isinf(cleaned), np.nan, cleaned)
+    growth = np.cumprod(np.where(np.isnan(cleaned), 1, cleaned + 1), axis=1)
+    growth = np.where(np.isnan(cleaned), np.nan, growth)
+    prices = np.where(to_price[:, None], 1.0 + 1.0 * (growth - 1), returns)
+    prices = np.where(np.isnan(prices), 0, prices)
+    return np.where(np.isinf(prices), np.nan, prices), growth
+
+def _clean_drawdown(dd):
+    return np.where(np.isinf(dd) | (dd == 0), 0.0, dd)
+
+def _prepare_returns_batch(data, valid):
+    """Row-wise _prepare_returns, with pct_change on the rows that look like prices"""
+    pct = (_nanmin_batch(data, valid) >= 0) & (_nanmax_batch(data, valid) > 1)
+    if pct.any():
+        # pct_change pads missing values forward first
+        index = np.where(np.isnan(data), 0, np.arange(data.shape[1]))
+        filled = np.take_along_axis(data, np.maximum.accumulate(index, axis=1), axis=1)
+        change = np.full(data.shape, np.nan)
+        change[:, 1:] = filled[:, 1:] / filled[:, :-1] - 1
+        data = np.where(pct[:, None], change, data)
+    return np.where(np.isfinite(data), data, 0.0)
+
+def _value_at_risk_batch(returns, valid, lengths):
+    """Row-wise value_at_risk of prepared returns at 95% confidence"""
+    mu = np.where(valid, returns, 0).sum(axis=1) / lengths
+    sigma = _std_batch(returns, valid)
+    # norm.ppf(q, mu, sigma) is ppf(q) * sigma + mu, and nan unless sigma > 0
+    return np.where(sigma > 0, norm.ppf(1 - 0.95) * sigma + mu, np.nan)
+
 def to_drawdown_series(returns):
     """Convert returns series to drawdown series"""
     prices = _prepare_prices(returns)
@@ -85,7 +392,8 @@ def compsum(returns):
 def _prepare_returns(data, rf=0.0, nperiods=None):
     """Converts price data into returns + cleanup"""
     data = data.copy()
-    function = inspect.stack()[1][3]
+    # name of the caller, without the full frame walk and source reads of inspect.stack()
+    function = sys._getframe(1).f_code.co_name
     if isinstance(data, pandas.DataFrame):
         for col in data.columns:
             if data[col].dropna().min() >= 0 and data[col].dropna().max() > 1:
@@ -1,55 +1,239 @@
-import json
-from typing import Dict
-from datetime import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_SNAPSHOT_LOCATION = "data/state.npz"
+DEFAULT_ORDERS_LOCATION = "data/orders.db"
+DEFAULT_PRICES_LOCATION = "data/prices.db"
+DEFAULT_REGISTERS_LOCATION = "data/registers.db"
+DEFAULT_VOTES_LOCATION = "data/votes.db"
+
+# bump when the layout of the snapshot arrays changes, older snapshots are then ignored
+SNAPSHOT_VERSION = 2
+
+ORDER_COLUMNS = ["MinerId", "Token", "isClose", "Direction", "Nonce", "Price", "Price4H", "TimeStamp", "Leverage"]
 
-DEFAULT_ACCOUNTS_LOCATION = "data/accounts.json"
 
 class LocalStorage:
     def __init__(self, config=None, logger=None):
         self.config = config
         self.logger = logger
         self.update_time = 0
-        self.accounts = {}
+        self.order_store = OrderStore(DEFAULT_ORDERS_LOCATION)
+        self.price_store = PriceStore(DEFAULT_PRICES_LOCATION)
+        self.snapshot_store = SnapshotStore(DEFAULT_SNAPSHOT_LOCATION)
 
     def get_update_time(self):
         return self.update_time
 
-    def load_positions_in_memory(self):
-        location = DEFAULT_ACCOUNTS_LOCATION
-        data = self._get_json_file(location)
-        if data:
-            self.accounts = data.get("accounts", {})
-        return data
 
-    def write_positions_to_disk(self, data:str):
-        # miners that have already been deregistered.
-        location = DEFAULT_ACCOUNTS_LOCATION
-        self._write_from_memory_to_disk(location, data)
+class SnapshotStore:
+    """
+    Versioned state snapshot as a single .npz file.
 
-    def _get_json_file(self, location: str) -> Dict:
-        try:
-            with open(location, 'r') as f:
-                data = json.load(f)
-                return data
-        except FileNotFoundError:
-            self.logger.info(f"File not found: {location}")
-            return {}
-
-    def _write_from_memory_to_disk(self, location: str, data:str) -> None:
+    save() writes to a temporary file in the same directory and renames it over the old
+    snapshot, so a crash mid-write never leaves a truncated file behind.
+    """
+
+    def __init__(self, location: str = DEFAULT_SNAPSHOT_LOCATION, version: int = SNAPSHOT_VERSION):
+        self.location = location
+        self.version = version
+
+    def save(self, arrays: Dict[str, np.ndarray]) -> None:
+        directory = os.path.dirname(self.location)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory or ".", suffix=".tmp")
         try:
-            with open(location, 'r') as f:
-                old_data = json.load(f)
-                old_timestamp = old_data.get("timestamp", 0)
-        except FileNotFoundError:
-            old_timestamp = 0
-
-        current_timestamp = datetime.now().timestamp()
-        if current_timestamp > old_timestamp:
-            try:
-                with open(location, 'w') as f:
-                    json.dump({"accounts": self.accounts, "timestamp": current_timestamp, "data": data}, f, indent=4)
-                self.logger.info(f"Updated file: {location}")
-            except FileNotFoundError:
-                self.logger.error(f"File not found: {location}")
-        else:
-            self.logger.info(f"File {location} already exists and is newer.")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, version=np.array(self.version), **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.location)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def load(self) -> Optional[Dict[str, np.ndarray]]:
+        """The saved arrays, None if there is no snapshot or it was written by another version."""
+        if not os.path.exists(self.location):
+            return None
+        with np.load(self.location, allow_pickle=False) as data:
+            if "version" not in data.files or int(data["version"]) != self.version:
+                return None
+            return {name: data[name] for name in data.files if name != "version"}
+
+
+class SqliteStore:
+    """Lazily opened SQLite database in WAL mode, shared between threads behind a lock."""
+    SCHEMA = ""
+
+    def __init__(self, location: str):
+        self.location = location
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            if os.path.dirname(self.location):
+                os.makedirs(os.path.dirname(self.location), exist_ok=True)
+            conn = sqlite3.connect(self.location, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(self.SCHEMA)
+            self.conn = conn
+        return self.conn
+
+    def close(self) -> None:
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class OrderStore(SqliteStore):
+    """
+    On-disk order history keyed by (TimeStamp, Nonce, MinerId).
+
+    Rows are kept in timestamp order, so a cold start reads the history back in one scan
+    and only asks the api for orders past the high-water mark.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS orders ("
+        "TimeStamp INTEGER NOT NULL, Nonce INTEGER NOT NULL, MinerId TEXT NOT NULL, Token TEXT, "
+        "isClose INTEGER, Direction INTEGER, Price REAL, Price4H REAL, Leverage NUMERIC, "
+        "PRIMARY KEY (TimeStamp, Nonce, MinerId)) WITHOUT ROWID"
+    )
+
+    def __init__(self, location: str = DEFAULT_ORDERS_LOCATION):
+        super().__init__(location)
+
+    def add_orders(self, orders: List) -> None:
+        """Insert orders, filling in Price4H for rows that were stored before it was known."""
+        if not orders:
+            return
+        rows = [(order.TimeStamp, order.Nonce, order.MinerId, order.Token, int(order.isClose), order.Direction,
+                 order.Price, order.Price4H, order.Leverage) for order in orders]
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO orders (TimeStamp, Nonce, MinerId, Token, isClose, Direction, Price, Price4H, Leverage) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (TimeStamp, Nonce, MinerId) DO UPDATE SET Price4H = excluded.Price4H "
+                    "WHERE orders.Price4H = 0 AND excluded.Price4H != 0",
+                    rows
+                )
+
+    def iter_rows(self, since: int = 0, batch: int = 10000):
+        """
+        Stored orders with TimeStamp >= since as tuples in ORDER_COLUMNS order, oldest first, read
+        `batch` rows at a time. The store stays locked until the scan is done.
+        """
+        with self.lock:
+            cursor = self._connect().execute(
+                f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders WHERE TimeStamp >= ? ORDER BY TimeStamp, Nonce, MinerId",
+                (since,)
+            )
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    return
+                yield from rows
+
+    def get_high_water_mark(self) -> int:
+        """Latest stored order timestamp, 0 if the store is empty."""
+        with self.lock:
+            row = self._connect().execute("SELECT MAX(TimeStamp) FROM orders").fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+
+class PriceStore(SqliteStore):
+    """Closing token prices of finished UTC days, keyed by (day number, token)."""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS prices ("
+        "Day INTEGER NOT NULL, Token TEXT NOT NULL, Price REAL, "
+        "PRIMARY KEY (Day, Token)) WITHOUT ROWID"
+    )
+
+    def __init__(self, location: str = DEFAULT_PRICES_LOCATION):
+        super().__init__(location)
+
+    def load_prices(self, day: int) -> Dict[str, float]:
+        with self.lock:
+            rows = self._connect().execute("SELECT Token, Price FROM prices WHERE Day = ?", (day,)).fetchall()
+        return dict(rows)
+
+    def load_all_prices(self) -> Dict[int, Dict[str, float]]:
+        """Every stored day, oldest first."""
+        with self.lock:
+            rows = self._connect().execute("SELECT Day, Token, Price FROM prices ORDER BY Day").fetchall()
+        result = {}
+        for day, token, price in rows:
+            result.setdefault(day, {})[token] = price
+        return result
+
+    def save_prices(self, day: int, prices: Dict[str, float]) -> None:
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO prices (Day, Token, Price) VALUES (?, ?, ?)",
+                                 [(day, token, price) for token, price in prices.items()])
+
+
+class RegisterStore(SqliteStore):
+    """Miner register times keyed by address."""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS registers ("
+        "Address TEXT NOT NULL PRIMARY KEY, RegisterTime INTEGER NOT NULL) WITHOUT ROWID"
+    )
+
+    def __init__(self, location: str = DEFAULT_REGISTERS_LOCATION):
+        super().__init__(location)
+
+    def load_register_times(self, starttime: int = 0) -> Dict[str, int]:
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT Address, RegisterTime FROM registers WHERE RegisterTime >= ?", (starttime,)).fetchall()
+        return dict(rows)
+
+    def save_register_times(self, register_times: Dict[str, int]) -> None:
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO registers (Address, RegisterTime) VALUES (?, ?)",
+                                 list(register_times.items()))
+
+    def get_latest_register_time(self) -> int:
+        with self.lock:
+            row = self._connect().execute("SELECT MAX(RegisterTime) FROM registers").fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+
+class VoteStore(SqliteStore):
+    """The last weight vote sent to the chain, one row per uid, and the block it was sent at."""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS votes ("
+        "Uid INTEGER NOT NULL PRIMARY KEY, Weight INTEGER NOT NULL, Block INTEGER NOT NULL) WITHOUT ROWID"
+    )
+
+    def __init__(self, location: str = DEFAULT_VOTES_LOCATION):
+        super().__init__(location)
+
+    def load_vote(self) -> Tuple[Dict[int, int], int]:
+        """The uid -> weight map of the last vote and its block, empty and 0 if none was stored."""
+        with self.lock:
+            rows = self._connect().execute("SELECT Uid, Weight, Block FROM votes").fetchall()
+        return {uid: weight for uid, weight, _ in rows}, max((block for _, _, block in rows), default=0)
+
+    def save_vote(self, weights: Dict[int, int], block: int) -> None:
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM votes")
+                conn.executemany("INSERT INTO votes (Uid, Weight, Block) VALUES (?, ?, ?)",
+                                 [(uid, weight, block) for uid, weight in weights.items()])
@@ -1,15 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from os.path import dirname, realpath
+import asyncio
+import bisect
 import json
+import sys
+import threading
 import time
 from typing import Dict, List, Union
-import requests
-from dateutil.tz import UTC
+import aiohttp
+import numpy as np
+import pandas as pd
 import sr25519
 from substrateinterface import Keypair 
 from config import Config
-from storage import LocalStorage
-import urllib3
-from urllib3.util.retry import Retry
+from storage import LocalStorage, ORDER_COLUMNS
+from book import AccountBook
+from history import CheckpointHistory
+from orders import ORDER_DTYPE, IdTable, Order, decode_ids, encode_orders, encode_rows, iter_orders
+
+sys.path.append(f'{dirname(dirname(dirname(dirname(realpath(__file__)))))}')
+from src.openscope.api_client import ApiClient, ApiError
 
 DEFAULT_TOKENS = ['0xc011a73ee8576fb46f5e1c5751ca3b9fe0af2a6f', '0xfaba6f8e4a5e8ab82f62fe7c39859fa577269be3',
                   '0x4d224452801aced8b2f0aebe155379bb5d594381', '0x5283d291dbcf85356a21ba090e6db59121208b44',
@@ -24,17 +35,41 @@ DEFAULT_TOKENS = ['0xc011a73ee8576fb46f5e1c5751ca3b9fe0af2a6f', '0xfaba6f8e4a5e8
 
 MAIN_TOKENS = ['0x0000000000000000000000000000000000000000', '0x2260fac5e5542a773aa44fbcfedf7c193bc2c599']
 
+ORDERS_PAGE_LIMIT = 5000
+# retries of one getalltrades page before the whole fetch is given up
+ORDERS_PAGE_RETRIES = 5
+
+API_CLIENT = None
+API_CONCURRENCY = 4
+
+# a closed day's price is cached once it is this many seconds old
+PRICE_SETTLE_TIME = 300
+
+# the elimination tasks look back at most 8 days, keep one more day in the order window
+ORDER_WINDOW_SPAN = 9 * 86400
+# columns that identify an order in the order window
+ORDER_WINDOW_KEYS = ['MinerId', 'TimeStamp', 'Nonce']
+
+# seconds re-read before the high-water mark, for trades that reach the api slightly late
+ORDER_FETCH_OVERLAP = 60
+# seconds between catch-up fetches that re-read the high-water mark's day and the day before, for
+# trades that reach the api later than the overlap
+ORDER_CATCHUP_INTERVAL = 3600
+
 
 class Account:
-    def __init__(self, Portfolio={}, AvgPrice=None, WinRate=None, TokenRate=None, Leverage=None, Balance=10,
-                 TimeStamp=0):
+    def __init__(self, Portfolio={}, AvgPrice=None, TokenTrades=None, TokenWins=None, Leverage=None, Balance=10,
+                 TimeStamp=0, Trades=0, Wins=0):
         self.Portfolio = Portfolio
         self.InitialBalance = Balance
         self.Profit = 0.0
         self.AvgPrice = {} if AvgPrice is None else AvgPrice.copy()
         self.FirstTrade = TimeStamp
-        self.WinRate = {} if WinRate is None else WinRate.copy()
-        self.TokenRate = {} if TokenRate is None else TokenRate.copy()
+        # open orders and winning open orders, in total and per token
+        self.Trades = Trades
+        self.Wins = Wins
+        self.TokenTrades = {} if TokenTrades is None else TokenTrades.copy()
+        self.TokenWins = {} if TokenWins is None else TokenWins.copy()
         self.Leverage = {} if Leverage is None else Leverage.copy()
 
     def update_balance(self, profit: float):
@@ -60,268 +95,545 @@ def init_account():
     return account
 
 
-class Order:
-    def __init__(self, MinerId="", Token="", isClose=False, Direction=0, Nonce=0, Price=0, Price4H=0, TimeStamp=0,
-                 Leverage=1):
-        self.MinerId = MinerId
-        self.Token = Token
-        self.isClose = isClose
-        self.Direction = Direction
-        self.Nonce = Nonce
-        self.Price = Price
-        self.Price4H = Price4H
-        self.TimeStamp = TimeStamp
-        self.Leverage = Leverage
+class OrderWindow:
+    """
+    The orders of the last `span` seconds as one columnar DataFrame, unique on ORDER_WINDOW_KEYS.
+
+    The main loop adds every new order it fetches, and the elimination tasks read their
+    multi-day windows from here instead of downloading them again.
+    """
+
+    def __init__(self, span: int = ORDER_WINDOW_SPAN):
+        self.span = span
+        self.chunks = []
+        self.frame_cache = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def add(self, orders: List[Order]) -> None:
+        """Append new orders; the first call marks the window as primed, even when empty."""
+        if orders:
+            self._append(pd.DataFrame({column: [getattr(order, column) for order in orders]
+                                       for column in ORDER_COLUMNS}))
+        self.ready.set()
+
+    def add_records(self, records: np.ndarray, ids: IdTable) -> None:
+        """add() for ORDER_DTYPE records coded by `ids`."""
+        if len(records):
+            chunk = pd.DataFrame({column: records[column] for column in ORDER_COLUMNS})
+            chunk['MinerId'] = decode_ids(records['MinerId'], ids)
+            chunk['Token'] = decode_ids(records['Token'], ids)
+            chunk['Direction'] = chunk['Direction'].astype(np.int64)
+            self._append(chunk)
+        self.ready.set()
+
+    def _append(self, chunk: pd.DataFrame) -> None:
+        chunk = chunk[chunk['TimeStamp'] >= int(time.time()) - self.span]
+        with self.lock:
+            self.chunks.append(chunk)
+            self.frame_cache = None
+
+    def frame(self, since: int = 0, timeout: float = None) -> pd.DataFrame:
+        """Orders with TimeStamp >= since sorted by TimeStamp, waiting for the main loop's first fetch."""
+        self.ready.wait(timeout)
+        with self.lock:
+            if self.frame_cache is None:
+                if self.chunks:
+                    df = pd.concat(self.chunks, ignore_index=True)
+                else:
+                    df = pd.DataFrame(columns=ORDER_COLUMNS)
+                df = df[df['TimeStamp'] >= int(time.time()) - self.span]
+                # an order can come in twice, from the store when the window is primed and again
+                # from the api when the run before stopped between storing it and the snapshot
+                df = df.drop_duplicates(ORDER_WINDOW_KEYS)
+                df = df.sort_values('TimeStamp', kind='stable', ignore_index=True)
+                self.chunks = [df]
+                self.frame_cache = df
+            df = self.frame_cache
+        return df[df['TimeStamp'] >= since].reset_index(drop=True)
+
 
 class PositionCheckpoint:
-    def __init__(self, last_update: int, cur_ret: Dict[str, float] = None, prev_ret: Dict[str, float] = None, roi: Dict[str, float] = None, orders: List[Order] = [],  processed: List[str] = []):
+    # the returns of the checkpoint are a row of AccountManager.history
+    __slots__ = ("last_update", "orders", "processed", "is_update")
+
+    def __init__(self, last_update: int, orders: np.ndarray = None, processed: int = 0):
         self.last_update = last_update
-        self.cur_ret = {} if cur_ret is None else cur_ret.copy()
-        self.prev_ret = {} if prev_ret is None else prev_ret.copy()
-        self.roi = {} if roi is None else roi.copy()
-        self.orders = orders
+        # ORDER_DTYPE records of the day in arrival order, unique on (MinerId, Nonce); the first
+        # `processed` of them have been replayed into the accounts
+        self.orders = np.empty(0, dtype=ORDER_DTYPE) if orders is None else orders
         self.processed = processed
         self.is_update = False
+
+    def add_orders(self, orders: np.ndarray) -> np.ndarray:
+        """Append the orders not known yet. Returns a mask of the ones added."""
+        known = len(self.orders)
+        merged = np.concatenate([self.orders, orders])
+        # stable, so of equal (MinerId, Nonce) keys the one that came first is kept
+        index = np.lexsort((merged["Nonce"], merged["MinerId"]))
+        miner, nonce = merged["MinerId"][index], merged["Nonce"][index]
+        first = np.ones(len(merged), dtype=bool)
+        first[1:] = (miner[1:] != miner[:-1]) | (nonce[1:] != nonce[:-1])
+        keep = np.zeros(len(merged), dtype=bool)
+        keep[index[first]] = True
+        added = keep[known:]
+        self.orders = merged[keep]
+        return added
+
+    def take_pending(self) -> np.ndarray:
+        """Orders added since the checkpoint was last processed, marking them as processed."""
+        orders = self.orders[self.processed:]
+        self.processed = len(self.orders)
+        return orders
         
 class AccountManager(LocalStorage):
-    def __init__(self, config=None, logger=None):
+    def __init__(self, config=None, logger=None, book=None):
         super().__init__(config=config, logger=logger)
         self.checkpoints = []
+        # the same checkpoints keyed by UTC day number (last_update // 86400)
+        self.checkpoint_days: Dict[int, PositionCheckpoint] = {}
+        # cur_ret, prev_ret and roi of the checkpoints, one row per checkpoint and one column per book row
+        self.history = CheckpointHistory()
+        # (TimeStamp, Nonce) of the latest order seen
+        self.last_order = (0, 0)
+        # time of the last catch-up fetch that went through
+        self.catchup_time = 0
+        self.order_window = OrderWindow()
+        # an AccountBook, or a shard.ShardedBook spreading the accounts over worker processes
+        self.book = AccountBook(DEFAULT_TOKENS, MAIN_TOKENS) if book is None else book
+        self.ids = IdTable()
+        self.restored = False
+        # held while the book, the checkpoints or their history change, the elimination timer
+        # thread resets accounts while the main loop replays orders
+        self.lock = threading.RLock()
+
+    def add_account(self, address: str):
+        with self.lock:
+            self.restore()
+            self.book.add_account(address)
     
     def del_account(self, address:str):
-        account = init_account()
-        self.accounts[address] = account
-        for checkpoint in self.checkpoints:
-            checkpoint.cur_ret.pop(address, None)
-            checkpoint.prev_ret.pop(address, None)
-            checkpoint.roi.pop(address, None) 
-    
-    def group_orders_by_day(self, orders: List[Order]) -> None:
-        for order in orders:
-            timestamp = order.TimeStamp
-            utc_datetime = datetime.fromtimestamp(timestamp, tz=UTC)
-            date = utc_datetime.date()
-            matching_checkpoint = next((checkpoint for checkpoint in self.checkpoints 
-                                        if datetime.fromtimestamp(checkpoint.last_update, tz=UTC).date() == date), None)
-            if matching_checkpoint:
-                matching_checkpoint.orders.append(order)
+        with self.lock:
+            self.restore()
+            self.history.clear(self.book.reset_account(address))
+
+    def fetch_orders(self, addr: str, pub_key: str, timestamp: int, signature: str) -> np.ndarray:
+        """
+        Fetch the orders to group for this step, persist them to the local order store and
+        return them as ORDER_DTYPE records coded by self.ids.
+
+        On cold start the stored history is read back as records, never as Order objects, and
+        the api is asked for everything since the start of the day before the store's high-water
+        mark. Afterwards each step resumes from the latest (TimeStamp, Nonce) seen, and every
+        ORDER_CATCHUP_INTERVAL seconds from the start of the day before it again, so trades that
+        come in late also reach a day that has closed; group_records_by_day drops the orders
+        already known.
+
+        A fetch that fails is neither stored nor moves the high-water mark, the next step asks
+        for the same range.
+        """
+        self.restore()
+        now = int(time.time())
+        if self.last_order[0] > 0:
+            catchup = now - self.catchup_time >= ORDER_CATCHUP_INTERVAL
+            if catchup:
+                tradetime = max(catchup_start(self.last_order[0]), 1)
             else:
-                last_update = int(datetime.combine(date, datetime.min.time(), tzinfo=UTC).timestamp())
-                current_checkpoint = PositionCheckpoint(last_update=last_update, orders=[order])
-                self.checkpoints.append(current_checkpoint)
-        
-        self.checkpoints = sorted(self.checkpoints, key=lambda checkpoint: checkpoint.last_update)
-        return
+                tradetime = max(self.last_order[0] - ORDER_FETCH_OVERLAP, 1)
+            try:
+                orders = get_recent_orders(addr, pub_key, timestamp, signature, tradetime, backfill=catchup)
+            except ApiError as e:
+                self.logger.error(f'fetch orders error: {e}')
+                return np.empty(0, dtype=ORDER_DTYPE)
+            self.order_store.add_orders(orders)
+            records = encode_orders(orders, self.ids)
+            self._update_last_order(records)
+            if catchup:
+                self.catchup_time = now
+            return records
+
+        stored = encode_rows(self.order_store.iter_rows(), self.ids)
+        tradetime = catchup_start(self.order_store.get_high_water_mark())
+        self.logger.info(f'order store loaded: {len(stored)}, fetch delta from: {tradetime}')
+        try:
+            orders = get_recent_orders(addr, pub_key, timestamp, signature, tradetime, backfill=True)
+            self.catchup_time = now
+        except ApiError as e:
+            # the stored orders are complete up to the high-water mark, go on with those alone
+            self.logger.error(f'fetch orders error: {e}')
+            orders = []
+        self.order_store.add_orders(orders)
+
+        # the delta starts a day before the high-water mark's day and repeats stored orders,
+        # the checkpoints keep the stored copy as it comes first
+        records = np.concatenate([stored, encode_orders(orders, self.ids)])
+        records = records[np.argsort(records["TimeStamp"], kind="stable")]
+        self._update_last_order(records)
+        return records
+
+    def _update_last_order(self, records: np.ndarray) -> None:
+        if len(records):
+            latest = records["TimeStamp"].max()
+            nonce = records["Nonce"][records["TimeStamp"] == latest].max()
+            self.last_order = max(self.last_order, (int(latest), int(nonce)))
+
+    def group_orders_by_day(self, orders: List[Order]) -> int:
+        """group_records_by_day for Order objects."""
+        with self.lock:
+            return self.group_records_by_day(encode_orders(orders, self.ids))
+
+    def group_records_by_day(self, records: np.ndarray) -> int:
+        """
+        Add order records to their day checkpoint, skipping the ones already known, and feed the
+        new ones to the order window. Returns the number added.
+        """
+        with self.lock:
+            days = records["TimeStamp"] // 86400
+            accepted = np.zeros(len(records), dtype=bool)
+            for day in np.unique(days).tolist():
+                checkpoint = self.checkpoint_days.get(day)
+                if checkpoint is None:
+                    checkpoint = PositionCheckpoint(last_update=day * 86400)
+                    self.checkpoint_days[day] = checkpoint
+                    position = bisect.bisect_right(self.checkpoints, checkpoint.last_update,
+                                                   key=lambda x: x.last_update)
+                    self.checkpoints.insert(position, checkpoint)
+                    self.history.insert(position)
+                index = np.flatnonzero(days == day)
+                accepted[index] = checkpoint.add_orders(records[index])
+
+        self.order_window.add_records(records[accepted], self.ids)
+        return int(accepted.sum())
 
     def process_orders_by_day(self, addr: str, pub_key: str, keypair: Keypair):
         if len(self.checkpoints) == 0:
-            return {}, {}, {}
-        
+            return {}, {}
+
+        # fetch the prices of every checkpoint to replay up front and in parallel
+        stale = [checkpoint.last_update for checkpoint in self.checkpoints[:-1]
+                 if not checkpoint.is_update or checkpoint.processed < len(checkpoint.orders)]
+        stale.append(self.checkpoints[-1].last_update)
+        day_prices = self.prefetch_checkpoint_prices(addr, pub_key, keypair, stale)
+        with self.lock:
+            return self._replay_checkpoints(day_prices)
+
+    def _replay_checkpoints(self, day_prices: Dict[int, Dict[str, float]]):
+        """
+        Replay the pending orders of every checkpoint at its day's prices and evaluate the accounts.
+
+        A closed checkpoint that was processed before only has pending orders when trades came in
+        late, those are replayed and only the miners that made them are evaluated again.
+        """
         if len(self.checkpoints) > 1:
             for i in range(len(self.checkpoints) - 1):
                 checkpoint = self.checkpoints[i]
-                if checkpoint.is_update:
+                if checkpoint.is_update and checkpoint.processed == len(checkpoint.orders):
                     continue
-                timestamp = int(time.time())
-                msg = f'{addr}{pub_key}{timestamp}'
-                message = format_data(msg)
-                signature = sr25519.sign(  # type: ignore
-                    (keypair.public_key, keypair.private_key), message).hex()
-                # max_timestamp = max(checkpoint.orders, key=lambda order: order.TimeStamp).TimeStamp
-                max_timestamp = checkpoint.last_update + 24*3600
-                current_price = get_latest_price(addr, pub_key, timestamp, signature, max_timestamp)
+                current_price = day_prices[checkpoint.last_update]
                 if len(current_price.keys()) != len(DEFAULT_TOKENS):
                     self.logger.error(f'get token price error')
-                for order in checkpoint.orders:
-                    self.process_order(order, current_price)
-                for id, account in self.accounts.items():
-                    if account.FirstTrade > 0:
-                        formatted_time = datetime.fromtimestamp(float(checkpoint.last_update)).strftime('%Y-%m-%d %H:%M:%S')
-                        roi, _, _ = evaluate_account(account, current_price)
-                        position_value = roi * account.InitialBalance / 100 + account.InitialBalance
-                        checkpoint.cur_ret[id] = position_value
-                        checkpoint.roi[id] = roi
-                        if i == 0:
-                            checkpoint.prev_ret[id] = 10.0
-                        else:
-                            prev_point = self.checkpoints[i-1]
-                            checkpoint.prev_ret[id] = prev_point.cur_ret.get(id, 10.0)
-                        self.logger.info(f"{id} position_value: {position_value}, time: {formatted_time}")
+                late = checkpoint.is_update
+                records = checkpoint.take_pending()
+                self.book.apply_records(records, self.ids, current_price)
+                ids, position_values, _, _ = self.evaluate_checkpoint(i, current_price, records if late else None)
+                formatted_time = datetime.fromtimestamp(float(checkpoint.last_update)).strftime('%Y-%m-%d %H:%M:%S')
+                for id, position_value in zip(ids, position_values):
+                    self.logger.info(f"{id} position_value: {position_value}, time: {formatted_time}")
                 checkpoint.is_update = True
         
         # handle last checkpoint
         checkpoint = self.checkpoints[-1]
         roi_data = {}
         win_data = {}
-        timestamp = int(time.time())
-        msg = f'{addr}{pub_key}{timestamp}'
-        message = format_data(msg)
-        signature = sr25519.sign(  # type: ignore
-            (keypair.public_key, keypair.private_key), message).hex()
-        current_timestamp = checkpoint.last_update + 24*3600
-        if current_timestamp < timestamp:
-            latest_price = get_latest_price(addr, pub_key, timestamp, signature, current_timestamp)
-        else:
-            latest_price = get_latest_price(addr, pub_key, timestamp, signature)
-        for order in checkpoint.orders:
-            if order.Nonce not in checkpoint.processed:
-                self.process_order(order, latest_price)
-                checkpoint.processed.append(order.Nonce)
-        for id, account in self.accounts.items():
-            if account.FirstTrade > 0:
-                roi, win_rate, position = evaluate_account(account, latest_price)
-                position_value = roi * account.InitialBalance / 100 + account.InitialBalance
-                roi_data[id] = roi
-                win_data[id] = win_rate
-                checkpoint.cur_ret[id] = position_value
-                checkpoint.roi[id] = roi
-                if len(self.checkpoints) == 1:
-                    checkpoint.prev_ret[id] = 10.0
-                else:
-                    prev_point = self.checkpoints[-2]
-                    checkpoint.prev_ret[id] = prev_point.cur_ret.get(id, 10.0)
-                self.logger.info(f"{id} roi data: {roi}, latest position_value: {position_value}")
+        latest_price = day_prices[checkpoint.last_update]
+        self.book.apply_records(checkpoint.take_pending(), self.ids, latest_price)
+        ids, position_values, rois, win_rates = self.evaluate_checkpoint(len(self.checkpoints) - 1, latest_price)
+        for id, position_value, roi, win_rate in zip(ids, position_values, rois, win_rates):
+            roi_data[id] = roi
+            win_data[id] = win_rate
+            self.logger.info(f"{id} roi data: {roi}, latest position_value: {position_value}")
         checkpoint.is_update = True
         
         self.update_time = checkpoint.last_update
         # delete old checkpoint
         if len(self.checkpoints) > 30:
+            for old in self.checkpoints[:-30]:
+                del self.checkpoint_days[old.last_update // 86400]
             self.checkpoints = self.checkpoints[-30:]
+            self.history.keep_last(30)
         
-        #write to disk
+        self.save_snapshot()
         return roi_data, win_data
 
-    
-    def generate_returns(self):
-        result = {}
-        result_change = {}
-        mdd_list = []
+    def restore(self) -> bool:
+        """
+        Load the state saved by the last run, once, before the first step touches it.
+        Returns True if a snapshot was loaded.
+        """
+        if self.restored:
+            return False
+        self.restored = True
+        try:
+            state = self.snapshot_store.load()
+            if state is None:
+                return False
+            self.set_state(state)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error(f'load snapshot error: {e}, rebuilding from the order store')
+            self.checkpoints = []
+            self.checkpoint_days = {}
+            self.history = CheckpointHistory()
+            self.last_order = (0, 0)
+            self.update_time = 0
+            self.book.clear()
+            self.ids = IdTable()
+            return False
+        since = int(time.time()) - self.order_window.span
+        self.order_window.add_records(encode_rows(self.order_store.iter_rows(since), self.ids), self.ids)
+        self.logger.info(f'snapshot loaded, accounts: {len(self.book)}, checkpoints: {len(self.checkpoints)}, '
+                         f'last order: {self.last_order}')
+        return True
+
+    def save_snapshot(self) -> None:
+        try:
+            self.snapshot_store.save(self.get_state())
+        except OSError as e:
+            self.logger.error(f'save snapshot error: {e}')
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """
+        Accounts, checkpoints and the order high-water mark as arrays.
+
+        Only the checkpoints the next fetch can still add to (or that were not processed yet)
+        keep their orders, older days are already folded into the accounts and their orders
+        stay in the order store.
+        """
+        state = self.book.get_state()
+        keep_from = catchup_start(self.last_order[0] - ORDER_FETCH_OVERLAP)
+        orders = []
+        processed = []
         for checkpoint in self.checkpoints:
-            for id in checkpoint.cur_ret.keys():
-                if id not in result:
-                    result[id] = []
-                    result_change[id] = []
-                if id in mdd_list:
-                    continue
-                if checkpoint.cur_ret[id] < 0:
-                    mdd_list.append(id)
-                    self.logger.info(f'The position of {id} is lower than 0')
-                return_change = (checkpoint.cur_ret[id] - checkpoint.prev_ret.get(id, 10.0)) / checkpoint.prev_ret.get(id, 10.0)
-                return_value = (checkpoint.cur_ret[id] - checkpoint.prev_ret.get(id, 10.0))
-                result[id].append(return_value)
-                result_change[id].append(return_change)
-        return result, result_change, mdd_list
-    
-    def process_order(self, order: Order, latest_price: Dict[str, float]):
-        address = order.MinerId
-        token = order.Token
-        # validate miner
-        if address not in self.accounts.keys():
-            return
-        account = self.accounts.get(address)
-        if account.FirstTrade == 0 or account.FirstTrade > order.TimeStamp:
-            account.FirstTrade = order.TimeStamp
-        # calculate winrate, only calculate open order
-        if not order.isClose:
-            if order.Price4H == 0:
-                order.Price4H = latest_price.get(token, 0)
-            account.TokenRate[order.Nonce] = order.Token
-            if order.Price < order.Price4H and order.Direction == 1:
-                account.WinRate[order.Nonce] = 1
-            elif order.Price > order.Price4H and order.Direction == -1:
-                account.WinRate[order.Nonce] = 1
+            if checkpoint.is_update and checkpoint.last_update < keep_from:
+                orders.append(np.empty(0, dtype=ORDER_DTYPE))
+                processed.append(0)
             else:
-                account.WinRate[order.Nonce] = 0
+                orders.append(checkpoint.orders)
+                processed.append(checkpoint.processed)
+        state["orders"] = np.concatenate(orders) if orders else np.empty(0, dtype=ORDER_DTYPE)
+        state["checkpoint_orders_end"] = np.cumsum([len(x) for x in orders], dtype=np.int64)
+        state["checkpoint_processed"] = np.array(processed, dtype=np.int64)
+        state["checkpoint_last_update"] = np.array([x.last_update for x in self.checkpoints], dtype=np.int64)
+        state["checkpoint_is_update"] = np.array([x.is_update for x in self.checkpoints], dtype=bool)
+        state.update(self.history.get_state(len(self.book)))
+        state["ids"] = np.array(self.ids.ids, dtype=str)
+        state["last_order"] = np.array(self.last_order, dtype=np.int64)
+        state["update_time"] = np.array(self.update_time, dtype=np.int64)
+        return state
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> None:
+        self.book.set_state(state)
+        self.ids = IdTable(state["ids"].tolist())
+        ends = state["checkpoint_orders_end"].tolist()
+        starts = [0] + ends[:-1]
+        checkpoints = []
+        for i, last_update in enumerate(state["checkpoint_last_update"].tolist()):
+            checkpoint = PositionCheckpoint(last_update=last_update, orders=state["orders"][starts[i]:ends[i]].copy(),
+                                            processed=int(state["checkpoint_processed"][i]))
+            checkpoint.is_update = bool(state["checkpoint_is_update"][i])
+            checkpoints.append(checkpoint)
+        self.history.set_state(state)
+        if len(self.history) != len(checkpoints):
+            raise ValueError("checkpoint history does not match the checkpoints")
+        self.checkpoints = checkpoints
+        self.checkpoint_days = {checkpoint.last_update // 86400: checkpoint for checkpoint in checkpoints}
+        self.last_order = tuple(state["last_order"].tolist())
+        self.update_time = int(state["update_time"])
+
+
+    def evaluate_checkpoint(self, position: int, prices: Dict[str, float], records: np.ndarray = None):
+        """
+        Mark every account that has traded to market and record its position value and roi in the
+        checkpoint's history row, only the accounts of the miners in `records` when given. Returns
+        the addresses evaluated with their position values, rois and win rates.
+        """
+        rows, roi, position_value, win_rates = self.book.evaluate(prices)
+        if records is not None:
+            miners = [self.book.index.get(self.ids.ids[code]) for code in np.unique(records["MinerId"]).tolist()]
+            keep = np.isin(rows, [row for row in miners if row is not None])
+            rows, roi, position_value, win_rates = rows[keep], roi[keep], position_value[keep], win_rates[keep]
+        self.history.record(position, rows, position_value, roi)
+        ids = [self.book.addresses[row] for row in rows.tolist()]
+        return ids, position_value.tolist(), roi.tolist(), win_rates.tolist()
 
-        # tranfer_fee
-        if token in MAIN_TOKENS:
-            fee = 0.05 / 100
+    def get_checkpoint_price(self, addr: str, pub_key: str, keypair: Keypair, last_update: int) -> Dict[str, float]:
+        """
+        Token prices at the end of the checkpoint day, or the live prices while the day is open.
+
+        The closing prices of a finished day never change, so they are served from the local
+        price store once fetched.
+        """
+        close_time = last_update + 24*3600
+        timestamp = int(time.time())
+        closed = close_time + PRICE_SETTLE_TIME <= timestamp
+        day = last_update // 86400
+        if closed:
+            prices = self.price_store.load_prices(day)
+            if len(prices) == len(DEFAULT_TOKENS):
+                return prices
+
+        msg = f'{addr}{pub_key}{timestamp}'
+        message = format_data(msg)
+        signature = sr25519.sign(  # type: ignore
+            (keypair.public_key, keypair.private_key), message).hex()
+        if close_time < timestamp:
+            prices = get_latest_price(addr, pub_key, timestamp, signature, close_time)
         else:
-            fee = 0.1 / 100 * order.Leverage
-
-        # calculate portfolio
-        asset = account.Portfolio.get(token, {})
-        if order.isClose:
-            new_asset = {
-                "asset" : 0.0,
-            }
-            balance = asset.get("asset", 0)
-            avg_price = account.AvgPrice.get(token, 0)
-            leverage = account.Leverage.get(token, 1)
-            cost = 0
-            if avg_price == 0:
-                return
-            if balance > 0 :
-                # usd = balance * order.Price
-                usd = balance * avg_price  * (1 + leverage * (order.Price-avg_price)/avg_price)
-                cost = balance * avg_price 
-            else:
-                usd = (-balance) * avg_price  * (1 - leverage * (order.Price-avg_price)/avg_price)
-                cost = (-balance) * avg_price
-            new_asset["usd"] = usd
-            account.Portfolio[token] = new_asset
-            account.AvgPrice[token] = 0
-            account.Leverage[token] = 1
-            account.update_balance(usd - cost)
+            prices = get_latest_price(addr, pub_key, timestamp, signature)
+        if closed and len(prices) == len(DEFAULT_TOKENS):
+            self.price_store.save_prices(day, prices)
+        return prices
+
+    def prefetch_checkpoint_prices(self, addr: str, pub_key: str, keypair: Keypair,
+                                   last_updates: List[int]) -> Dict[int, Dict[str, float]]:
+        """Fetch the prices of several checkpoints concurrently, keyed by checkpoint last_update."""
+        if len(last_updates) == 1:
+            return {last_updates[0]: self.get_checkpoint_price(addr, pub_key, keypair, last_updates[0])}
+        with ThreadPoolExecutor(max_workers=max(API_CONCURRENCY, 1)) as executor:
+            prices = executor.map(lambda x: self.get_checkpoint_price(addr, pub_key, keypair, x), last_updates)
+            return dict(zip(last_updates, prices))
+
+    def generate_returns(self):
+        """
+        Per miner, the return and relative change of every checkpoint until the one where its
+        position value first drops below 0, and the miners for which it did.
+        """
+        with self.lock:
+            columns, returns, changes, failed = self.history.returns(len(self.book))
+            addresses = list(self.book.addresses)
+        ids = [addresses[column] for column in columns]
+        mdd_list = [addresses[column] for column in failed]
+        for id in mdd_list:
+            self.logger.info(f'The position of {id} is lower than 0')
+        return dict(zip(ids, returns)), dict(zip(ids, changes)), mdd_list
+
+    def closed_epoch(self):
+        """
+        Names the set of checkpoints behind the returns of generate_returns. While it stays the
+        same only the returns of the last checkpoint change.
+        """
+        if not self.checkpoints:
+            return None
+        return len(self.checkpoints), self.checkpoints[0].last_update, self.checkpoints[-1].last_update
+
+    def process_order(self, order: Order, latest_price: Dict[str, float]):
+        self.book.apply_order(order, latest_price)
+
+
+def apply_order(account: Account, order: Order, latest_price: Dict[str, float]):
+    """Reference per-account replay of one order, AccountBook.apply_order is the one in use."""
+    token = order.Token
+    if account.FirstTrade == 0 or account.FirstTrade > order.TimeStamp:
+        account.FirstTrade = order.TimeStamp
+    # calculate winrate, only calculate open order
+    if not order.isClose:
+        if order.Price4H == 0:
+            order.Price4H = latest_price.get(token, 0)
+        account.Trades += 1
+        account.TokenTrades[token] = account.TokenTrades.get(token, 0) + 1
+        if (order.Price < order.Price4H and order.Direction == 1) or \
+                (order.Price > order.Price4H and order.Direction == -1):
+            account.Wins += 1
+            account.TokenWins[token] = account.TokenWins.get(token, 0) + 1
+
+    # tranfer_fee
+    if token in MAIN_TOKENS:
+        fee = 0.05 / 100
+    else:
+        fee = 0.1 / 100 * order.Leverage
+
+    # calculate portfolio
+    asset = account.Portfolio.get(token, {})
+    if order.isClose:
+        new_asset = {
+            "asset" : 0.0,
+        }
+        balance = asset.get("asset", 0)
+        avg_price = account.AvgPrice.get(token, 0)
+        leverage = account.Leverage.get(token, 1)
+        cost = 0
+        if avg_price == 0:
+            return
+        if balance > 0 :
+            # usd = balance * order.Price
+            usd = balance * avg_price  * (1 + leverage * (order.Price-avg_price)/avg_price)
+            cost = balance * avg_price 
         else:
-            if order.Direction == 1:
-                usd_balance = asset.get("usd", 0)
-                if usd_balance > 0:  
+            usd = (-balance) * avg_price  * (1 - leverage * (order.Price-avg_price)/avg_price)
+            cost = (-balance) * avg_price
+        new_asset["usd"] = usd
+        account.Portfolio[token] = new_asset
+        account.AvgPrice[token] = 0
+        account.Leverage[token] = 1
+        account.update_balance(usd - cost)
+    else:
+        if order.Direction == 1:
+            usd_balance = asset.get("usd", 0)
+            if usd_balance > 0:  
+                new_asset = {
+                    "usd" : 0.0,
+                    "asset": usd_balance * (1 - fee) / order.Price 
+                }
+                account.Portfolio[token] = new_asset
+                account.AvgPrice[token] = order.Price
+                account.Leverage[token] = order.Leverage
+            else:
+                token_balance = asset.get("asset", 0)
+                if token_balance < 0:
+                    avg_price = account.AvgPrice.get(token, 0)
+                    leverage = account.Leverage.get(token, 1)
+                    if avg_price == 0:
+                        return
+                    usd = (-token_balance) * avg_price  * (1 - leverage * (order.Price-avg_price)/avg_price)
+                    amount = usd  * (1 - fee) / order.Price
                     new_asset = {
-                        "usd" : 0.0,
-                        "asset": usd_balance * (1 - fee) / order.Price 
+                        "asset": amount,
+                        "usd": 0.0,
                     }
                     account.Portfolio[token] = new_asset
                     account.AvgPrice[token] = order.Price
                     account.Leverage[token] = order.Leverage
-                else:
-                    token_balance = asset.get("asset", 0)
-                    if token_balance < 0:
-                        avg_price = account.AvgPrice.get(token, 0)
-                        leverage = account.Leverage.get(token, 1)
-                        if avg_price == 0:
-                            return
-                        usd = (-token_balance) * avg_price  * (1 - leverage * (order.Price-avg_price)/avg_price)
-                        amount = usd  * (1 - fee) / order.Price
-                        new_asset = {
-                            "asset": amount,
-                            "usd": 0.0,
-                        }
-                        account.Portfolio[token] = new_asset
-                        account.AvgPrice[token] = order.Price
-                        account.Leverage[token] = order.Leverage
+        else:
+            usd_balance = asset.get("usd", 0)
+            if usd_balance > 0:  
+                new_asset = {
+                    "usd" : 0.0,
+                    "asset": usd_balance  * (1 - fee) / order.Price * (-1)
+                }
+                account.Portfolio[token] = new_asset
+                account.AvgPrice[token] = order.Price
+                account.Leverage[token] = order.Leverage
             else:
-                usd_balance = asset.get("usd", 0)
-                if usd_balance > 0:  
+                token_balance = asset.get("asset", 0)
+                if token_balance > 0:
+                    avg_price = account.AvgPrice.get(token, 0)
+                    leverage = account.Leverage.get(token, 1)
+                    if avg_price == 0:
+                        return
+                    usd = token_balance * avg_price  * (1 + leverage * (order.Price-avg_price)/avg_price)
+                    amount = usd  * (1 - fee) / order.Price
                     new_asset = {
-                        "usd" : 0.0,
-                        "asset": usd_balance  * (1 - fee) / order.Price * (-1)
+                        "asset": amount * (-1),
+                        "usd": 0.0,
                     }
                     account.Portfolio[token] = new_asset
                     account.AvgPrice[token] = order.Price
-                    account.Leverage[token] = order.Leverage
-                else:
-                    token_balance = asset.get("asset", 0)
-                    if token_balance > 0:
-                        avg_price = account.AvgPrice.get(token, 0)
-                        leverage = account.Leverage.get(token, 1)
-                        if avg_price == 0:
-                            return
-                        usd = token_balance * avg_price  * (1 + leverage * (order.Price-avg_price)/avg_price)
-                        amount = usd  * (1 - fee) / order.Price
-                        new_asset = {
-                            "asset": amount * (-1),
-                            "usd": 0.0,
-                        }
-                        account.Portfolio[token] = new_asset
-                        account.AvgPrice[token] = order.Price
-                        account.Leverage[token] = order.Leverage 
-
-        self.accounts[address] = account       
-        return
+                    account.Leverage[token] = order.Leverage 
+
+    return
 
 
 def evaluate_account(account: Account, prices: Dict[str, float]):
+    """Reference per-account valuation, AccountBook.mark_to_market is the one in use."""
     unrealized: float = 0
     position = {}
     for token, asset in account.Portfolio.items():
@@ -350,34 +662,38 @@ def evaluate_account(account: Account, prices: Dict[str, float]):
             "status": status,
             "roi": (position_value - 10.0) / 10.0 * 100,
             "value": position_value,
-            "total": 0,
-            "win": 0
+            "total": account.TokenTrades.get(token, 0),
+            "win": account.TokenWins.get(token, 0)
         }
         position[token] = position_data
 
     pnl = account.Profit + unrealized
     roi = pnl / account.InitialBalance * 100
 
-    win = 0
-    total_trades = len(account.WinRate.keys())
-    for value in account.WinRate.values():
-        if value > 0:
-            win += 1
-    win_rate = float(win / total_trades) if total_trades > 0 else 0.0
-
-    for id, value in account.WinRate.items():
-        token = account.TokenRate.get(id, "")
-        if token == "":
-            continue
-        position[token]["total"] = position[token].get("total") + 1
-        if value > 0:
-            position[token]["win"] = position[token].get("win") + 1
+    win_rate = float(account.Wins / account.Trades) if account.Trades > 0 else 0.0
     return roi, win_rate, position
 
+def catchup_start(timestamp: int) -> int:
+    """Start of the day before the one of `timestamp`, the oldest day a catch-up fetch re-reads."""
+    return max(timestamp // 86400 - 1, 0) * 86400
+
+
+def init_api_client(config: Config) -> ApiClient:
+    """Create the pooled client for the trade services from an already parsed config."""
+    global API_CLIENT, API_CONCURRENCY
+    API_CLIENT = ApiClient(config.api.get("url"))
+    API_CONCURRENCY = int(config.api.get("concurrency"))
+    return API_CLIENT
+
+
+def get_api_client() -> ApiClient:
+    if API_CLIENT is None:
+        init_api_client(Config('env/config.ini'))
+    return API_CLIENT
+
+
 def get_latest_price(addr: str, pub_key: str, timestamp: int, signature: str, latesttime: int = 0) -> Union[dict, None]:
-    config_file = 'env/config.ini'
-    config = Config(config_file)
-    url = config.api.get("url") + "getlatestprice"
+    client = get_api_client()
     params = {
         "userId": addr,
         "pubKey": pub_key,
@@ -386,85 +702,160 @@ def get_latest_price(addr: str, pub_key: str, timestamp: int, signature: str, la
     } 
     if latesttime > 0: 
         params["latesttime"] = latesttime
+    attempt = 0
     while True:
-        try:     
-            resp = requests.get(url, params=params, timeout=60)
-            if resp.status_code != 200:
-                print(f"get price error: {resp.status_code}")
-                time.sleep(5)
-                continue
-        except Exception as e:
-                print(f"http error: {e}")
-                time.sleep(10)
-                continue
-        json_resp = json.loads(resp.text)
-        if json_resp.get("code") == 200 and json_resp.get("data"):
-            result = {}
-            for price_data in json_resp["data"]:
-                price = price_data['Price']
-                token = price_data['TokenAddress']
-                result[token] = price
-            return result
+        # the price is needed to go on, keep retrying until the api answers
+        resp = client.get("getlatestprice", params=params, retries=-1)
+        if resp.status_code == 200:
+            json_resp = json.loads(resp.text)
+            if json_resp.get("code") == 200 and json_resp.get("data"):
+                result = {}
+                for price_data in json_resp["data"]:
+                    price = price_data['Price']
+                    token = price_data['TokenAddress']
+                    result[token] = price
+                return result
+            print(f"get price error: {json_resp.get('code')}, {json_resp.get('msg')}")
+        else:
+            print(f"get price error: {resp.status_code}")
+        time.sleep(client.backoff(attempt))
+        attempt += 1
     
-def get_recent_orders(addr: str, pub_key: str, timestamp: int, signature: str, tradetime: int = 0) -> Union[List, None]:
-    config_file = 'env/config.ini'
-    config = Config(config_file)
-    url = config.api.get("url") + "getalltrades"
+def get_recent_orders(addr: str, pub_key: str, timestamp: int, signature: str, tradetime: int = 0,
+                      backfill: bool = False) -> List[Order]:
+    """
+    Every order traded since `tradetime`, sorted by TimeStamp. Each page is retried up to
+    ORDERS_PAGE_RETRIES times, ApiError is raised when one still fails, never a partial list.
+    """
+    client = get_api_client()
+    if backfill and API_CONCURRENCY > 1:
+        return run_coroutine(
+            get_recent_orders_async(client, addr, pub_key, timestamp, signature, tradetime, API_CONCURRENCY))
+
     order_list = []
     page = 1
-    limit = 5000
+    limit = ORDERS_PAGE_LIMIT
 
     while True:
-        params = {
-            "userId": addr,
-            "pubKey": pub_key,
-            "timestamp": timestamp,
-            "sig": signature,
-            "page": page,
-            "limit": limit,
-        }
-        if tradetime > 0:
-            params["tradetime"] = tradetime
-        try:
-            resp = requests.get(url, params=params, timeout=60)
-            if resp.status_code != 200:
-                print(f"get trades error: {resp.status_code}, retry page: {page}")
-                time.sleep(10)
-                continue
-            json_resp = json.loads(resp.text)
-        except Exception as e:
-            print(f"http error: {e}")
-            return order_list
-
-        if json_resp.get("code") == 200 and json_resp.get("data"):
-            orders = json_resp["data"]
-            print(f"fetch data page: {page}")
-            for order_data in orders:
-                order = Order(
-                    MinerId=order_data.get("MinerID", ""),
-                    Token=order_data.get("TokenAddress", ""),
-                    isClose=(order_data.get("PositionManager", "") == "close"),
-                    Direction=order_data.get("Direction", 0),
-                    Nonce=order_data.get("Nonce", 0),
-                    Price=order_data.get("TradePrice", 0),
-                    Price4H=order_data.get("TradePrice4H", 0),
-                    TimeStamp=order_data.get("Timestamp", 0),
-                    Leverage=order_data.get("Leverage", 1),
-                )
-                order_list.append(order)
-                
-            if len(orders) < limit:
-                break
+        params = _orders_page_params(addr, pub_key, timestamp, signature, tradetime, page, limit)
+        orders = client.call(lambda: _check_orders_page(client.get("getalltrades", params=params, retries=0), page),
+                             retries=ORDERS_PAGE_RETRIES)
+        print(f"fetch data page: {page}")
+        for order_data in orders:
+            order_list.append(_parse_order(order_data))
+        if len(orders) < limit:
+            break
         page += 1
     if len(order_list) > 0:
         order_list.sort(key=lambda x: x.TimeStamp)
     return order_list
 
 
-def get_miner_registertime(addr: str, pub_key: str, timestamp: int, signature: str, starttime: int) -> dict:
-    config_file = 'env/config.ini'
-    config = Config(config_file)
-    url = config.api.get("url") + "getregistertime"
+async def get_recent_orders_async(client: ApiClient, addr: str, pub_key: str, timestamp: int, signature: str,
+                                  tradetime: int = 0, concurrency: int = 4) -> List[Order]:
+    """
+    Page through getalltrades with at most `concurrency` requests in flight.
+
+    Workers take page numbers in increasing order until one page comes back short. Pages
+    are then concatenated in page order and sorted by TimeStamp, which gives the same list
+    as the sequential pager. A page that still fails after its retries stops the workers
+    and raises ApiError.
+    """
+    limit = ORDERS_PAGE_LIMIT
+    pages = {}
+    state = {"next": 1, "last": None, "error": None}
+
+    async def worker(session: aiohttp.ClientSession):
+        while state["error"] is None:
+            page = state["next"]
+            if state["last"] is not None and page > state["last"]:
+                return
+            state["next"] += 1
+            params = _orders_page_params(addr, pub_key, timestamp, signature, tradetime, page, limit)
+
+            async def fetch():
+                json_resp = await client.request_async(session, "GET", "getalltrades", retries=0, params=params)
+                return _check_orders_json(json_resp, page)
+
+            try:
+                data = await client.call_async(fetch, retries=ORDERS_PAGE_RETRIES)
+            except Exception as e:
+                state["error"] = e
+                return
+            pages[page] = data
+            if len(data) < limit and (state["last"] is None or page < state["last"]):
+                state["last"] = page
+
+    timeout = aiohttp.ClientTimeout(total=client.timeout)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    if state["error"] is not None:
+        raise ApiError(f"get trades error: {state['error']}") from state["error"]
+
+    order_list = []
+    for page in range(1, state["last"] + 1):
+        order_list.extend(_parse_order(order_data) for order_data in pages[page])
+    print(f"fetch data pages: {state['last']}, orders: {len(order_list)}")
+    order_list.sort(key=lambda x: x.TimeStamp)
+    return order_list
+
+
+def _check_orders_page(resp, page: int) -> list:
+    if resp.status_code != 200:
+        raise ApiError(f"get trades error: {resp.status_code}, page: {page}")
+    return _check_orders_json(json.loads(resp.text), page)
+
+
+def _check_orders_json(json_resp, page: int) -> list:
+    """The orders of one getalltrades answer, ApiError unless the api reports success."""
+    if not isinstance(json_resp, dict) or json_resp.get("code") != 200:
+        code, msg = (json_resp.get("code"), json_resp.get("msg")) if isinstance(json_resp, dict) else (None, None)
+        raise ApiError(f"get trades error: {code}, {msg}, page: {page}")
+    return json_resp.get("data") or []
+
+
+def _orders_page_params(addr: str, pub_key: str, timestamp: int, signature: str, tradetime: int, page: int,
+                        limit: int) -> dict:
+    params = {
+        "userId": addr,
+        "pubKey": pub_key,
+        "timestamp": timestamp,
+        "sig": signature,
+        "page": page,
+        "limit": limit,
+    }
+    if tradetime > 0:
+        params["tradetime"] = tradetime
+    return params
+
+
+def _parse_order(order_data: dict) -> Order:
+    return Order(
+        MinerId=order_data.get("MinerID", ""),
+        Token=order_data.get("TokenAddress", ""),
+        isClose=(order_data.get("PositionManager", "") == "close"),
+        Direction=order_data.get("Direction", 0),
+        Nonce=order_data.get("Nonce", 0),
+        Price=order_data.get("TradePrice", 0),
+        Price4H=order_data.get("TradePrice4H", 0),
+        TimeStamp=order_data.get("Timestamp", 0),
+        Leverage=order_data.get("Leverage", 1),
+    )
+
+
+def run_coroutine(coro):
+    """Run a coroutine to completion, also when called from inside a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def get_miner_registertime(addr: str, pub_key: str, timestamp: int, signature: str, starttime: int) -> Union[dict, None]:
+    """Register times of the miners registered since starttime, None when the api call failed."""
     result = dict()
     params = {
         "userId": addr,
@@ -473,12 +864,18 @@ def get_miner_registertime(addr: str, pub_key: str, timestamp: int, signature: s
         "sig": signature,
         "starttime": starttime
     }
-    resp = requests.get(url, params=params, timeout=25)
+    try:
+        resp = get_api_client().get("getregistertime", params=params, timeout=25)
+    except ApiError as e:
+        print(f"http error: {e}")
+        return None
     if resp.status_code != 200:
-        return result
+        return None
     json_resp = json.loads(resp.text)
+    if json_resp.get("code") != 200:
+        return None
 
-    if json_resp.get("code") == 200 and json_resp.get("data"):
+    if json_resp.get("data"):
         for data in json_resp["data"]:
             address = data.get('Address')
             register_time = data.get('RegisterTime')
@@ -1,5 +1,5 @@
 import argparse
-import asyncio
+import functools
 from datetime import datetime
 import numpy
 import pandas
@@ -19,9 +19,14 @@ from os.path import dirname, realpath
 from loguru import logger
 from threading import Timer
 
+from chain import ChainCache, get_max_weight_age, get_netuid
 from config import Config
-from stats import calculate_serenity
+from shard import ShardedBook
+from storage import VoteStore
+from stats import incremental_serenity
 from trade import *
+from vote import ThrottledVoter, VoteSubmitter
+from weights import DEFAULT_SHARES, DEFAULT_TIERS, allocate_weights, parse_tiers
 from eliminate import *
 
 logger.add("logs/log_{time:YYYY-MM-DD}.log", rotation="1 day")
@@ -29,7 +34,7 @@ logger.add("logs/log_{time:YYYY-MM-DD}.log", rotation="1 day")
 ELIMINATE_MINER = dict()
 ELIMINATE_FILE = str()
 MDD_DATA = dict()
-PROTECT_ADDRESS = list()
+PROTECT_ADDRESS = set()
 NOT_ACTIVE_ELIMINATION_TARGET_TIME = 0
 COPY_TRADING_ELIMINATION_TARGET_TIME = 0
 PROTECT_ADDRESS_TARGET_TIME = 0
@@ -39,8 +44,9 @@ DEFAULT_WEIGHT = 5
 
 
 def set_weights(
-        score_dict: dict[int, float], netuid: int, client: CommuneClient, key: Keypair, elimated_ids: list[int]
-) -> None:
+        score_dict: dict[int, float], netuid: int, client: CommuneClient, key: Keypair, elimated_ids: list[int],
+        tiers: list[int] = DEFAULT_TIERS, shares: list[float] = DEFAULT_SHARES
+) -> dict[int, int]:
     """
     Set weights for miners based on their scores.
 
@@ -49,58 +55,19 @@ def set_weights(
         netuid (int): The network UID.
         client (CommuneClient): The CommuneX client.
         key (Keypair): The keypair for signing transactions.
+        tiers (list[int]): Rank boundaries of the weight tiers, per 100 miners.
+        shares (list[float]): Share of the total weight each tier splits.
     """
+    elimated_ids = set(elimated_ids)
     filtered_score_dict = {miner_id: score for miner_id, score in score_dict.items() if miner_id not in elimated_ids}
-
-    # Create a new dictionary to store the weighted scores
-    sorted_score = sorted(filtered_score_dict.items(), key=lambda x: x[1], reverse=True)
-    sorted_ids = [key for key, value in sorted_score]
-    total_miners = len(sorted_score)
-
-    if total_miners < 100:
-        top_3_threshold = int(total_miners * 0.03)
-        top_10_threshold = int(total_miners * 0.1)
-        top_25_threshold = int(total_miners * 0.25)
-        top_50_threshold = int(total_miners * 0.5)
-    else:
-        top_3_threshold = 3
-        top_10_threshold = 10
-        top_25_threshold = 25
-        top_50_threshold = 50
-
-    # Add the weighted score to the new dictionary
-    weighted_scores = {}
-    for i, (miner_uid, score) in enumerate(sorted_score):
-        if i < top_3_threshold:
-            total_score_in_group = sum(filtered_score_dict[uid[0]] for uid in sorted_score[:top_3_threshold])
-            weight_share = score / total_score_in_group
-            weighted_scores[miner_uid] = int(weight_share * 0.25 * 1000)
-        elif i < top_10_threshold:
-            total_score_in_group = sum(
-                filtered_score_dict[uid[0]] for uid in sorted_score[top_3_threshold:top_10_threshold])
-            weight_share = score / total_score_in_group
-            weighted_scores[miner_uid] = int(weight_share * 0.25 * 1000)
-        elif i < top_25_threshold:
-            total_score_in_group = sum(
-                filtered_score_dict[uid[0]] for uid in sorted_score[top_10_threshold:top_25_threshold])
-            weight_share = score / total_score_in_group
-            weighted_scores[miner_uid] = int(weight_share * 0.25 * 1000)
-        elif i < top_50_threshold:
-            total_score_in_group = sum(
-                filtered_score_dict[uid[0]] for uid in sorted_score[top_25_threshold:top_50_threshold])
-            weight_share = score / total_score_in_group
-            weighted_scores[miner_uid] = int(weight_share * 0.25 * 1000)
-        else:
-            weighted_scores[miner_uid] = 0
-
-    remain_weight = 1000 - sum(weighted_scores.values())
-    for item in sorted_score[:top_50_threshold]:
-        uid = item[0]
-        score = weighted_scores.get(uid, 0)
-        weighted_scores[uid] = int(score + (remain_weight / top_50_threshold))
+    miner_ids = list(filtered_score_dict.keys())
+    order, weights = allocate_weights(numpy.fromiter(filtered_score_dict.values(), dtype=float,
+                                                     count=len(filtered_score_dict)), tiers, shares)
+    sorted_ids = [miner_ids[i] for i in order.tolist()]
+    weights = weights.tolist()
 
     # filter out 0 weights
-    weighted_scores = {k: v for k, v in weighted_scores.items() if v > 0}
+    weighted_scores = {uid: weight for uid, weight in zip(sorted_ids, weights) if weight > 0}
     uids = list(weighted_scores.keys())
     weights = list(weighted_scores.values())
 
@@ -109,30 +76,10 @@ def set_weights(
         client.vote(key=key, uids=uids, weights=weights, netuid=netuid)
 
     for id in sorted_ids:
-        if id not in weighted_scores.keys():
-            weighted_scores[id] = 0
+        weighted_scores.setdefault(id, 0)
     return weighted_scores
 
 
-def get_netuid(client: CommuneClient, subnet_name: str = "OpenScope"):
-    """
-    Retrieves the network UID of the subnet.
-
-    Args:
-        client (CommuneClient): The CommuneX client.
-        subnet_name (str, optional): The name of the subnet. Defaults to "OpenScope".
-
-    Returns:
-        int: The network UID of the subnet.
-    """
-
-    subnets = client.query_map_subnet_names()
-    for netuid, name in subnets.items():
-        if name == subnet_name:
-            return netuid
-    raise ValueError(f"Subnet {subnet_name} not found")
-
-
 class TradeValidator(Module):
     """A class for calculating roi data using a Openscope network.
     """
@@ -144,6 +91,10 @@ class TradeValidator(Module):
             client: CommuneClient,
             account_manager: AccountManager,
             call_timeout: int = 60,
+            chain_cache: ChainCache | None = None,
+            tiers: list[int] = DEFAULT_TIERS,
+            shares: list[float] = DEFAULT_SHARES,
+            voter: ThrottledVoter | VoteSubmitter | None = None,
     ) -> None:
         super().__init__()
         self.client = client
@@ -151,6 +102,12 @@ class TradeValidator(Module):
         self.netuid = netuid
         self.call_timeout = call_timeout
         self.account_manager = account_manager
+        self.register_cache = RegisterTimeCache(key)
+        self.chain_cache = ChainCache(client, netuid) if chain_cache is None else chain_cache
+        self.tiers = tiers
+        self.shares = shares
+        # votes go through the voter when there is one, straight to the client otherwise
+        self.voter = client if voter is None else voter
 
     def get_modules(self, client: CommuneClient, netuid: int) -> dict[int, str]:
         """Retrieves all module addresses from the subnet.
@@ -165,58 +122,62 @@ class TradeValidator(Module):
         module_addreses = client.query_map_address(netuid)
         return module_addreses
 
-    async def validate_step(
+    def validate_step(
             self, config: Config, netuid: int
     ) -> list[dict[str, str]]:
         # modules_adresses = self.get_modules(self.client, netuid)
-        modules_keys = self.client.query_map_key(netuid)
+        modules_keys = self.chain_cache.get_keys()
         val_ss58 = self.key.ss58_address
         if val_ss58 not in modules_keys.values():
             raise ValueError(
                 f"validator key {val_ss58} is not registered in subnet"
             )
-        # Validation
-        score_dict: dict[int, float] = {}
-
         # == Validation loop / Scoring ==
-        self.account_manager.load_positions_in_memory()
         uid_map = {}
         for uid, address in modules_keys.items():
-            account = self.account_manager.accounts.get(address, {})
-            if account == {}:
-                account = init_account()
-                self.account_manager.accounts[address] = account
+            self.account_manager.add_account(address)
             uid_map[address] = uid
 
         timestamp = int(time.time())
-        tradetime = self.account_manager.get_update_time()
+        tradetime = self.account_manager.last_order[0]
         pub_key = keypair.public_key.hex()
         msg = f'{val_ss58}{pub_key}{timestamp}'
         message = format_data(msg)
         signature = sr25519.sign(  # type: ignore
             (keypair.public_key, keypair.private_key), message).hex()  # type: ignore
         logger.info(f'fetch recent orders start, timestamp: {tradetime}')
-        orders = get_recent_orders(val_ss58, pub_key, timestamp, signature, tradetime)
-        logger.info(f'fetch recent orders: {len(orders)}')
-        self.account_manager.group_orders_by_day(orders=orders)
+        orders = self.account_manager.fetch_orders(val_ss58, pub_key, timestamp, signature)
+        added = self.account_manager.group_records_by_day(orders)
+        logger.info(f'fetch recent orders: {len(orders)}, new: {added}')
 
         roi_data, win_data = self.account_manager.process_orders_by_day(val_ss58, pub_key, keypair)
+        logger.info(f'api stats: {get_api_client().get_stats()}')
+        return_data, change_data, mdd_list = self.account_manager.generate_returns()
+        score_dict = self.score_miners(return_data, change_data, mdd_list, uid_map)
+        if not score_dict:
+            logger.info("No miner managed to give a valid answer")
+            return {}
+        weighted_scores = self.vote(score_dict, uid_map)
+        if isinstance(self.voter, VoteSubmitter):
+            logger.info(f'vote stats: {self.voter.get_stats()}')
+        return weighted_scores, modules_keys, win_data, roi_data
+
+    def score_miners(self, return_data: dict[str, list], change_data: dict[str, list], mdd_list: list,
+                     uid_map: dict[str, int]) -> dict[int, float]:
+        """Score every registered miner by the serenity of its checkpoint returns, keyed by uid."""
+        score_dict: dict[int, float] = {}
         serenity_data = {}
         mdd_data = {}
         global MDD_DATA
-        return_data, change_data, mdd_list = self.account_manager.generate_returns()
-        for id, return_list in return_data.items():
-            change_list = change_data[id]
-            if id in mdd_list:
-                continue
-            returns = pandas.Series(return_list)
-            changes = pandas.Series(change_list)
-            serenity_value, mdd_value = calculate_serenity(returns, changes)
-            if numpy.isnan(serenity_value):
-                serenity_value = 0.0
-            serenity_data[id] = float(serenity_value)
-            mdd_data[id] = float(mdd_value)
-            logger.info(f'id: {id}, serenity: {float(serenity_value)}, mdd: {float(mdd_value)}')
+        mdd_list = set(mdd_list)
+        # one batch per shard of the account book, the whole book when it is not sharded; only the
+        # last checkpoint's returns are new while the closed checkpoints stay the same
+        items = {id: (return_list, change_data[id]) for id, return_list in return_data.items() if id not in mdd_list}
+        serenity_fn = functools.partial(incremental_serenity, self.account_manager.closed_epoch())
+        for id, (serenity_value, mdd_value) in self.account_manager.book.map_miners(serenity_fn, items).items():
+            serenity_data[id] = serenity_value
+            mdd_data[id] = mdd_value
+            logger.info(f'id: {id}, serenity: {serenity_value}, mdd: {mdd_value}')
         MDD_DATA = copy.copy(mdd_data)
         # add eliminated address
         scores = self.generate_scores(mdd_data, serenity_data)
@@ -234,11 +195,9 @@ class TradeValidator(Module):
                 )
                 continue
             score_dict[uid] = scores.get(address, 0)
+        return score_dict
 
-        if not score_dict:
-            logger.info("No miner managed to give a valid answer")
-            return {}
-
+    def vote(self, score_dict: dict[int, float], uid_map: dict[str, int]) -> dict[int, int]:
         elimated_ids = []
         for address, status in ELIMINATE_MINER.items():
             if not status['status']:
@@ -250,7 +209,8 @@ class TradeValidator(Module):
                 continue
             elimated_ids.append(uid)
         if len(self.account_manager.checkpoints) > 2:
-            weighted_scores = set_weights(score_dict, self.netuid, self.client, self.key, elimated_ids)
+            weighted_scores = set_weights(score_dict, self.netuid, self.voter, self.key, elimated_ids,
+                                          self.tiers, self.shares)
         else:
             weighted_scores = {}
             for uid in score_dict.keys():
@@ -258,8 +218,8 @@ class TradeValidator(Module):
             uids = list(weighted_scores.keys())
             weights = list(weighted_scores.values())
             logger.info(f"weights for the following uids: {uids}")
-            self.client.vote(key=self.key, uids=uids, weights=weights, netuid=self.netuid)
-        return weighted_scores, modules_keys, win_data, roi_data
+            self.voter.vote(key=self.key, uids=uids, weights=weights, netuid=self.netuid)
+        return weighted_scores
 
     def generate_scores(self, mdd_data: dict[str, float], serenity_data: dict[str, float]):
         score_dict = {}
@@ -297,7 +257,7 @@ class TradeValidator(Module):
     def task_get_protect_address(self):
         global ELIMINATE_MINER, PROTECT_ADDRESS
         logger.info(f"task_get_protect_address begin")
-        PROTECT_ADDRESS = get_protected_miner(keypair)
+        PROTECT_ADDRESS = get_protected_miner(self.register_cache)
         logger.info(f'PROTECT_ADDRESS: {len(PROTECT_ADDRESS)}')
         for address in PROTECT_ADDRESS:
             ELIMINATE_MINER[address] = {'status': False, 'timestamp': self.unixtime2str(), 'reason': 'protect_address'}
@@ -313,7 +273,7 @@ class TradeValidator(Module):
             logger.info(f'elimination:: mdd_elimination: {address}, mdd_data: {mdd_data}')
         else:
             logger.info(f'mdd_elimination get nothing')
-        eliminate_address = set(address) - set(PROTECT_ADDRESS)
+        eliminate_address = set(address) - PROTECT_ADDRESS
         for x in eliminate_address:
             self.account_manager.del_account(address=x)
             logger.info(f'task_mdd_elimination address del_account: {x}')
@@ -324,22 +284,25 @@ class TradeValidator(Module):
     def task_roi_elimination(self):
         global ELIMINATE_MINER
         logger.info(f"task_roi_elimination begin")
-        address = roi_elimination(checkpoints=account_manager.checkpoints)
-        roi_data = {}
+        # the main loop grows and shifts the history arrays, hold it off while they are read
+        with account_manager.lock:
+            history = account_manager.history
+            addresses = account_manager.book.addresses
+            address = roi_elimination(account_manager.checkpoints, history, addresses)
+            roi_data = {}
+            if address:
+                columns = {account_manager.book.index[x] for x in address}
+                for day, value in enumerate(account_manager.checkpoints):
+                    last_update_day = self.unixtime2str(value.last_update, t_format='%Y-%m-%d')
+                    roi_data[last_update_day] = {}
+                    for column in history.columns(day).tolist():
+                        if column in columns:
+                            roi_data[last_update_day][addresses[column]] = float(history.roi[day, column])
         if address:
-            for value in account_manager.checkpoints:
-                last_update = value.last_update
-                rois = value.roi
-                last_update_day = self.unixtime2str(last_update, t_format='%Y-%m-%d')
-                roi_data[last_update_day] = {}
-                for k, roi in rois.items():
-                    if k in address:
-                        roi_data[last_update_day][k] = roi
-
             logger.info(f'elimination:: roi_elimination: {address}, roi_data: {roi_data}')
         else:
             logger.info(f'roi_elimination get nothing')
-        eliminate_address = set(address) - set(PROTECT_ADDRESS)
+        eliminate_address = set(address) - PROTECT_ADDRESS
         for x in eliminate_address:
             self.account_manager.del_account(address=x)
             logger.info(f'task_roi_elimination address del_account: {x}')
@@ -350,12 +313,12 @@ class TradeValidator(Module):
     def task_copy_trading_elimination(self):
         global ELIMINATE_MINER
         logger.info(f"task_copy_trading_elimination begin")
-        copy_maps = copy_trading_elimination(keypair)
+        copy_maps, clusters = copy_trading_elimination(self.account_manager.order_window)
         if copy_maps:
-            logger.info(f'elimination:: copy_trading_elimination: {copy_maps}')
+            logger.info(f'elimination:: copy_trading_elimination: {copy_maps}, clusters: {clusters}')
         else:
             logger.info(f'copy_trading_elimination get nothing')
-        eliminate_address = set(copy_maps.keys()) - set(PROTECT_ADDRESS)
+        eliminate_address = set(copy_maps.keys()) - PROTECT_ADDRESS
         for x in eliminate_address:
             if x not in ELIMINATE_MINER or not ELIMINATE_MINER[x]['status']:
                 ELIMINATE_MINER[x] = {'status': True, 'timestamp': self.unixtime2str(), 'reason': 'copy_trading_elimination'}
@@ -364,12 +327,12 @@ class TradeValidator(Module):
     def task_not_active_elimination(self):
         global ELIMINATE_MINER
         logger.info(f"task_not_active_elimination begin")
-        address = not_active_elimination(keypair)
+        address = not_active_elimination(self.register_cache, self.account_manager.order_window)
         if address:
             logger.info(f'elimination:: not_active_elimination: {address}')
         else:
             logger.info(f'not_active_elimination get nothing')
-        eliminate_address = set(address) - set(PROTECT_ADDRESS)
+        eliminate_address = set(address) - PROTECT_ADDRESS
         for x in eliminate_address:
             if x not in ELIMINATE_MINER or not ELIMINATE_MINER[x]['status']:
                 ELIMINATE_MINER[x] = {'status': True, 'timestamp': self.unixtime2str(), 'reason': 'not_active_elimination'}
@@ -423,7 +386,7 @@ ROI_ELIMINATION_TARGET_TIME: {ROI_ELIMINATION_TARGET_TIME}''')
             start_time = time.time()
             formatted_start_time = datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S')
             print(f"check validator time: {formatted_start_time}")
-            weighted_scores = asyncio.run(self.validate_step(config, self.netuid))
+            weighted_scores = self.validate_step(config, self.netuid)
             print(f"vote data: {weighted_scores}")
             if not start_task_flag:
                 logger.info(f'start task exec task_mdd_elimination')
@@ -444,17 +407,36 @@ if __name__ == '__main__':
     else:
         config_file = args.config
     config = Config(config_file=config_file)
+    init_api_client(config)
     use_testnet = True if config.validator.get("testnet") == "1" else False
     c_client = CommuneClient(get_node_url(use_testnet=use_testnet))
-    net_uid = get_netuid(c_client)
+    net_uid = get_netuid(c_client, network="testnet" if use_testnet else "mainnet")
     keypair = classic_load_key(config.validator.get("keyfile"))
 
-    account_manager = AccountManager(config=config, logger=logger)
+    processes = int(config.validator.get("processes"))
+    book = ShardedBook(DEFAULT_TOKENS, MAIN_TOKENS, processes) if processes > 1 else None
+    account_manager = AccountManager(config=config, logger=logger, book=book)
+    tiers, shares = parse_tiers(config.validator.get("weight_tiers"), config.validator.get("weight_shares"))
+    chain_cache = ChainCache(c_client, net_uid)
+    # refresh the vote halfway to the chain's weight expiry unless configured
+    vote_max_age = config.validator.get("vote_max_age")
+    vote_max_age = int(vote_max_age) if vote_max_age else get_max_weight_age(c_client, net_uid) // 2
+    voter = ThrottledVoter(c_client, VoteStore(), lambda: chain_cache.block,
+                           min_change=int(config.validator.get("vote_min_change")), max_age=vote_max_age, logger=logger)
+    # votes are sent from their own thread, scoring never waits on the node
+    submitter = VoteSubmitter(voter, retries=int(config.validator.get("vote_retries")),
+                              timeout=float(config.validator.get("vote_timeout")), logger=logger)
+    submitter.start()
     validator = TradeValidator(
         keypair,
         net_uid,
         c_client,
         account_manager,
         call_timeout=60,
+        chain_cache=chain_cache,
+        tiers=tiers,
+        shares=shares,
+        voter=submitter,
     )
+    validator.chain_cache.start()
     validator.validation_loop(config)
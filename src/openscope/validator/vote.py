@@ -0,0 +1,189 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from communex.client import CommuneClient
+from substrateinterface import Keypair
+
+from storage import VoteStore
+
+
+def weight_distance(a: Dict[int, int], b: Dict[int, int]) -> int:
+    """L1 distance of two uid -> weight votes, a uid missing from one counts as weight 0 there."""
+    return sum(abs(a.get(uid, 0) - b.get(uid, 0)) for uid in a.keys() | b.keys())
+
+
+class ThrottledVoter:
+    """
+    Stands in for CommuneClient.vote, only sending votes that moved far enough from the last one.
+
+    A vote whose L1 distance to the last vote sent is at most `min_change` is skipped, unless
+    the last vote is `max_age` blocks old, so the weights are refreshed before the chain lets
+    them expire. The last vote is kept in `store`, a restart compares against it as well.
+    """
+
+    def __init__(self, client: CommuneClient, store: VoteStore, get_block: Callable[[], int], min_change: int = 0,
+                 max_age: int = 0, logger=None):
+        self.client = client
+        self.store = store
+        self.get_block = get_block
+        self.min_change = min_change
+        self.max_age = max_age
+        self.logger = logger
+        self.last_vote, self.last_block = store.load_vote()
+
+    def should_vote(self, weights: Dict[int, int], block: int) -> bool:
+        if not self.last_vote or block <= 0 or block < self.last_block:
+            return True
+        if self.max_age > 0 and block - self.last_block >= self.max_age:
+            return True
+        return weight_distance(weights, self.last_vote) > self.min_change
+
+    def vote(self, key: Keypair, uids: List[int], weights: List[int], netuid: int):
+        """Send the vote unless it is too close to the last one; None when it was skipped."""
+        vote = dict(zip(uids, weights))
+        block = self.get_block()
+        if not self.should_vote(vote, block):
+            if self.logger:
+                self.logger.info(f'vote skipped, change {weight_distance(vote, self.last_vote)} <= {self.min_change}, '
+                                 f'last vote at block {self.last_block}')
+            return None
+        response = self.client.vote(key=key, uids=uids, weights=weights, netuid=netuid)
+        self.last_vote, self.last_block = vote, block
+        try:
+            self.store.save_vote(vote, block)
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f'save vote error: {e}')
+        return response
+
+
+class VoteSubmitter:
+    """
+    Sends votes from a background thread, so a slow or hanging node never holds up scoring.
+
+    vote() only puts the vote in a single slot and returns; a vote still waiting when the next
+    one comes in is dropped, only the latest weights matter. Each attempt gets `timeout` seconds
+    and a failed one is retried `retries` times with jittered exponential backoff, unless a newer
+    vote arrived meanwhile. The latency and outcome of every vote are kept for get_stats().
+    """
+
+    def __init__(self, voter, retries: int = 3, timeout: float = 60, backoff_base: float = 2.0,
+                 backoff_max: float = 60.0, logger=None):
+        self.voter = voter
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.logger = logger
+        self.pending: Optional[tuple] = None
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        # the last vote call, a timed out one may still be running
+        self.inflight: Optional[threading.Thread] = None
+        self.counts = {"queued": 0, "ok": 0, "failed": 0, "timeout": 0, "superseded": 0, "retries": 0}
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_outcome = None
+
+    def vote(self, key: Keypair, uids: List[int], weights: List[int], netuid: int) -> None:
+        with self.condition:
+            if self.pending is not None:
+                self.counts["superseded"] += 1
+            self.pending = (key, list(uids), list(weights), netuid)
+            self.counts["queued"] += 1
+            self.condition.notify()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def get_stats(self) -> Dict[str, object]:
+        with self.condition:
+            result = dict(self.counts)
+            done = self.counts["ok"] + self.counts["failed"] + self.counts["timeout"]
+            result["avg_latency"] = self.total_latency / done if done else 0.0
+            result["max_latency"] = self.max_latency
+            result["last_outcome"] = self.last_outcome
+        return result
+
+    def submit(self, key: Keypair, uids: List[int], weights: List[int], netuid: int) -> str:
+        """Send one vote with retries, returns its outcome: ok, failed, timeout or superseded."""
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            outcome, error = self._attempt(key, uids, weights, netuid)
+            if outcome == "ok" or attempt >= self.retries:
+                break
+            if self.logger:
+                self.logger.warning(f'vote attempt {attempt + 1} {outcome}: {error}')
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.stopped, self.backoff(attempt))
+                if self.pending is not None or self.stopped:
+                    outcome = "superseded"
+                    break
+                self.counts["retries"] += 1
+            attempt += 1
+        latency = time.monotonic() - start
+        with self.condition:
+            self.counts[outcome] += 1
+            self.last_outcome = outcome
+            if outcome != "superseded":
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+        if self.logger:
+            log = self.logger.info if outcome in ("ok", "superseded") else self.logger.error
+            log(f'vote {outcome} after {attempt + 1} attempts in {latency:.2f}s, uids: {len(uids)}')
+        return outcome
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** min(attempt, 32)))
+
+    def _attempt(self, key: Keypair, uids: List[int], weights: List[int], netuid: int):
+        """
+        One vote call in its own daemon thread, given up after `timeout` seconds. A substrate
+        call cannot be interrupted, a hung one is left to finish or fail on its own, and no
+        other call starts before it ended, so an older vote never lands after a newer one.
+        """
+        if self.inflight is not None and self.inflight.is_alive():
+            self.inflight.join(self.timeout)
+            if self.inflight.is_alive():
+                return "timeout", "the previous vote call is still running"
+        result = {}
+
+        def call():
+            try:
+                self.voter.vote(key=key, uids=uids, weights=weights, netuid=netuid)
+                result["outcome"] = "ok"
+            except Exception as e:
+                result["outcome"], result["error"] = "failed", e
+
+        self.inflight = threading.Thread(target=call, daemon=True)
+        self.inflight.start()
+        self.inflight.join(self.timeout)
+        if self.inflight.is_alive():
+            return "timeout", f"no answer in {self.timeout}s"
+        return result["outcome"], result.get("error")
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.stopped)
+                if self.stopped:
+                    return
+                request, self.pending = self.pending, None
+            try:
+                self.submit(*request)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f'vote submitter error: {e}')
@@ -0,0 +1,57 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+# rank boundaries of the weight tiers, per 100 miners, and the share of the total weight each tier splits
+DEFAULT_TIERS = (3, 10, 25, 50)
+DEFAULT_SHARES = (0.25, 0.25, 0.25, 0.25)
+TOTAL_WEIGHT = 1000
+
+
+def parse_tiers(tiers: str, shares: str) -> Tuple[List[int], List[float]]:
+    """Tier boundaries and shares from their comma separated config values."""
+    tiers = [int(value) for value in tiers.split(",")]
+    shares = [float(value) for value in shares.split(",")]
+    if len(tiers) != len(shares):
+        raise ValueError(f"{len(tiers)} weight tiers but {len(shares)} shares")
+    if tiers != sorted(tiers):
+        raise ValueError(f"weight tiers must be ascending: {tiers}")
+    return tiers, shares
+
+
+def tier_thresholds(total_miners: int, tiers: Sequence[int]) -> List[int]:
+    """Rank each tier ends at: the top tier% of the miners below 100 miners, the top tier miners from 100 on."""
+    if total_miners < 100:
+        return [int(total_miners * tier / 100) for tier in tiers]
+    return list(tiers)
+
+
+def allocate_weights(scores: np.ndarray, tiers: Sequence[int] = DEFAULT_TIERS,
+                     shares: Sequence[float] = DEFAULT_SHARES) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Integer weights of the miners by score rank.
+
+    Every tier splits its share of TOTAL_WEIGHT by score, truncated to an integer, and what the
+    truncation leaves over is spread evenly over the miners of all tiers. Miners past the last
+    tier get 0, as does a tier whose scores sum to 0.
+
+    Returns the miner positions from best to worst score, ties in the order given, and their weights.
+    """
+    scores = np.asarray(scores, dtype=float)
+    order = np.argsort(-scores, kind="stable")
+    ranked = scores[order]
+    weights = np.zeros(len(scores), dtype=np.int64)
+    thresholds = tier_thresholds(len(scores), tiers)
+    start = 0
+    for end, share in zip(thresholds, shares):
+        group = ranked[start:end]
+        # the builtin sum, so the totals round exactly as the per-miner loop did
+        total_score_in_group = sum(group.tolist())
+        if len(group) and total_score_in_group != 0:
+            weights[start:end] = (group / total_score_in_group * share * TOTAL_WEIGHT).astype(np.int64)
+        start = max(start, end)
+    top = thresholds[-1] if thresholds else 0
+    if top > 0:
+        remain_weight = TOTAL_WEIGHT - int(weights.sum())
+        weights[:top] = (weights[:top] + remain_weight / top).astype(np.int64)
+    return order, weights